@@ -1,8 +1,3 @@
-from azure.cli.core.commands.client_factory import get_mgmt_service_client
-from azure.mgmt.resource.resources import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.storage.blob import BlockBlobService
 import time
 import logging
 import autoscaler.utils as utils
@@ -1,30 +1,44 @@
-from azure.cli.core.util import get_file_json
-from azure.cli.core.commands.client_factory import get_mgmt_service_client
-from azure.mgmt.resource.resources import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
 import logging
 import autoscaler.utils as utils
 
 from autoscaler.capacity import get_capacity_for_instance_type
+from autoscaler.kube import uncordon_nodes
+from autoscaler.label_index import get_pool_labels
 
 logger = logging.getLogger(__name__)
 
 class AgentPool(object):
 
-    def __init__(self, pool_name, instance_type, nodes):
+    def __init__(self, pool_name, instance_type, nodes, unit_capacity=None):
+        """
+        unit_capacity - KubeResource available to workload pods on a new node of the pool,
+                        the capacity data of the instance type when not given
+        """
         self.name = pool_name
         self.nodes = nodes
         self.unschedulable_nodes = list(filter(lambda n: n.unschedulable, self.nodes))
         self.max_size = 100
         self.instance_type = instance_type
+        self._unit_capacity = unit_capacity
+        self.indexes = set(node.index for node in nodes)
+        # indexes of the nodes being created by a deployment in flight
+        self.reserved_indexes = set()
+        # region of the nodes, e.g. southcentralus, None when the template doesn't set it
+        self.location = None
 
     @property
     def actual_capacity(self):
         return len(self.nodes)
     
+    @property
+    def labels(self):
+        return get_pool_labels(self)
+
     @property
     def unit_capacity(self):
         #Within a pool, every node should have the same capacity
+        if self._unit_capacity is not None:
+            return self._unit_capacity
         return get_capacity_for_instance_type(self.instance_type)
     
     def reclaim_unschedulable_nodes(self, new_desired_capacity):
@@ -35,17 +49,14 @@ class AgentPool(object):
         num_unschedulable = len(self.unschedulable_nodes)
         num_schedulable = self.actual_capacity - num_unschedulable
      
-        if num_schedulable < desired_capacity:
-            for node in self.unschedulable_nodes:
-                if node.uncordon():
-                    num_schedulable += 1
-                    # Uncordon only what we need
-                    if num_schedulable == desired_capacity:
-                        break
+        # Uncordon only what we need, retrying with the remaining nodes if some fail
+        candidates = list(self.unschedulable_nodes)
+        while num_schedulable < desired_capacity and candidates:
+            batch = candidates[:desired_capacity - num_schedulable]
+            candidates = candidates[len(batch):]
+            results = uncordon_nodes(batch)
+            num_schedulable += sum(1 for node in batch if results[node])
 
     def has_node_with_index(self, index):
-        for node in self.nodes:
-            if node.index == index:
-                return True
-        return False
+        return index in self.indexes
     
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+module to share the ARM request budget of the subscription between the calls of the autoscaler
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from autoscaler.config import Config
+
+logger = logging.getLogger(__name__)
+
+READ = 'reads'
+WRITE = 'writes'
+
+# lower goes first
+SCALE_UP = 0
+ROUTINE = 1
+CLEANUP = 2
+
+_REMAINING_HEADER = 'x-ms-ratelimit-remaining-subscription-{}'
+
+
+class TokenBucket(object):
+    """
+    allows bursts of up to capacity calls, then rate calls per second
+    """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, rate=None):
+        """
+        takes a token when there is one, and returns 0.
+        Otherwise returns the time in seconds until the next token, at the given rate
+        (defaults to the rate of the bucket).
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / (rate or self.rate)
+
+
+class ArmBudget(object):
+    """
+    schedules the ARM calls of the process so that they stay within the request budget
+    of the subscription (reads and writes per hour, as reported by ARM in the
+    x-ms-ratelimit-remaining-subscription-* headers of every response):
+    - calls take a token from the bucket of their kind, which smooths bursts
+    - waiting calls go by priority: scale-up, routine, then cleanup
+    - once the remaining budget is under the low watermark, calls other than scale-up
+      are spread over the rest of the window, so that the end of the budget is kept for scale-up
+    - after a 429, calls of the throttled kind wait for the time given in Retry-After
+    """
+
+    def __init__(self, read_rate=Config.ARM_READS_PER_SECOND, write_rate=Config.ARM_WRITES_PER_SECOND,
+                 burst=Config.ARM_BURST, low_watermark=Config.ARM_BUDGET_LOW_WATERMARK,
+                 window=Config.ARM_BUDGET_WINDOW, clock=time.time):
+        self.low_watermark = low_watermark
+        self.window = window
+        self.remaining = {READ: None, WRITE: None}
+        self.throttled = {READ: 0, WRITE: 0}
+        self._clock = clock
+        self._buckets = {READ: TokenBucket(read_rate, burst, clock),
+                         WRITE: TokenBucket(write_rate, burst, clock)}
+        self._paused_until = {READ: 0, WRITE: 0}
+        self._waiting = {READ: [], WRITE: []}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def _wait_time(self, kind, priority):
+        now = self._clock()
+        if now < self._paused_until[kind]:
+            return self._paused_until[kind] - now
+        rate = None
+        remaining = self.remaining[kind]
+        if priority != SCALE_UP and remaining is not None and remaining < self.low_watermark:
+            rate = min(self._buckets[kind].rate, max(remaining, 1) / float(self.window))
+        return self._buckets[kind].take(rate)
+
+    def acquire(self, kind, priority=ROUTINE):
+        """
+        blocks until a call of the given kind and priority can be made
+        """
+        ticket = (priority, next(self._counter))
+        with self._cond:
+            heapq.heappush(self._waiting[kind], ticket)
+            try:
+                while True:
+                    if self._waiting[kind][0] == ticket:
+                        wait = self._wait_time(kind, priority)
+                        if not wait:
+                            return
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[kind].remove(ticket)
+                heapq.heapify(self._waiting[kind])
+                self._cond.notify_all()
+
+    def call(self, kind, priority, func, *args, **kwargs):
+        self.acquire(kind, priority)
+        return func(*args, **kwargs)
+
+    def observe(self, status_code, headers):
+        """
+        updates the budget from an ARM response
+        """
+        with self._cond:
+            for kind in (READ, WRITE):
+                value = headers.get(_REMAINING_HEADER.format(kind))
+                if value is not None:
+                    try:
+                        self.remaining[kind] = int(value)
+                    except ValueError:
+                        pass
+            if status_code == 429:
+                try:
+                    retry_after = int(headers.get('Retry-After', 0))
+                except ValueError:
+                    retry_after = 0
+                retry_after = retry_after or Config.ARM_THROTTLED_PAUSE
+                # a throttled write doesn't tell which budget ran out when no header is left
+                kinds = [k for k in (READ, WRITE) if self.remaining[k] == 0] or [READ, WRITE]
+                for kind in kinds:
+                    self.throttled[kind] += 1
+                    self._paused_until[kind] = max(self._paused_until[kind], self._clock() + retry_after)
+                logger.warn('ARM throttled the autoscaler, pausing {} for {}s'.format(
+                    ' and '.join(kinds), retry_after))
+            self._cond.notify_all()
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+        requests response hook, to be added to the hooks of the configuration of the ARM clients
+        """
+        self.observe(response.status_code, response.headers)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'arm_remaining_reads': self.remaining[READ],
+                'arm_remaining_writes': self.remaining[WRITE],
+                'arm_throttled_reads': self.throttled[READ],
+                'arm_throttled_writes': self.throttled[WRITE],
+                'arm_waiting_calls': len(self._waiting[READ]) + len(self._waiting[WRITE]),
+            }
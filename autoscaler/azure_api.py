@@ -1,45 +1,58 @@
 import requests
 import logging
-import azure.cli.core.azlogging as azlogging
-from azure.cli.core.util import CLIError
-from azure.cli.core.profiles import ResourceType
-from azure.mgmt.resource.resources import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.storage.blob import BlockBlobService
-from azure.common import AzureHttpError
+import threading
+
+from autoscaler.arm_budget import ArmBudget, READ, WRITE, SCALE_UP, ROUTINE, CLEANUP
+
+# the azure SDKs are only imported on first use, they are slow to import and the
+# autoscaler spends most of its time sleeping
 
 logger = logging.getLogger(__name__)
 resource_management_client = None
 compute_management_client = None
 storage_management_client = None
+_logged_in_as = None
+_login_lock = threading.Lock()
+# the request budget is per subscription, so it is shared by the clusters of the process
+budget = ArmBudget()
+
+_RESOURCE_MANAGER_URL = "https://management.azure.com/"
+
+def _create_client(client_class, credentials, subscription_id):
+    client = client_class(credentials, subscription_id, base_url=_RESOURCE_MANAGER_URL)
+    client.config.hooks.append(budget.response_hook)
+    return client
 
 def login(username, password, tenant, subscriptionId):
-    from azure.common.client_factory import get_client_from_json_dict
+    from azure.common.credentials import ServicePrincipalCredentials
+    from azure.mgmt.resource.resources import ResourceManagementClient
+    from azure.mgmt.compute import ComputeManagementClient
+    from azure.mgmt.storage import StorageManagementClient
     global resource_management_client
     global compute_management_client
     global storage_management_client
+    global _logged_in_as
 
-    config_dict = {
-        "clientId": username,
-        "clientSecret": password,
-        "subscriptionId": subscriptionId,
-        "tenantId": tenant,
-        "activeDirectoryEndpointUrl": "https://login.microsoftonline.com",
-        "resourceManagerEndpointUrl": "https://management.azure.com/",
-        "activeDirectoryGraphResourceId": "https://graph.windows.net/",
-        "sqlManagementEndpointUrl": "https://management.core.windows.net:8443/",
-        "galleryEndpointUrl": "https://gallery.azure.com/",
-        "managementEndpointUrl": "https://management.core.windows.net/"
-    }
-    resource_management_client = get_client_from_json_dict(ResourceManagementClient, config_dict)
-    compute_management_client = get_client_from_json_dict(ComputeManagementClient, config_dict)
-    storage_management_client = get_client_from_json_dict(StorageManagementClient, config_dict)
+    with _login_lock:
+        # clusters of the same process share the clients, and so their connection pools
+        if _logged_in_as == (username, tenant, subscriptionId):
+            return
+        credentials = ServicePrincipalCredentials(
+            client_id=username,
+            secret=password,
+            tenant=tenant,
+            resource=_RESOURCE_MANAGER_URL)
+        resource_management_client = _create_client(ResourceManagementClient, credentials, subscriptionId)
+        compute_management_client = _create_client(ComputeManagementClient, credentials, subscriptionId)
+        storage_management_client = _create_client(StorageManagementClient, credentials, subscriptionId)
+        _logged_in_as = (username, tenant, subscriptionId)
     
 def download_template(resource_group_name, acs_deployment):
+    budget.acquire(WRITE, ROUTINE)
     return resource_management_client.deployments.export_template(resource_group_name, acs_deployment).template
 
 def download_parameters(resource_group_name, acs_deployment):
+    budget.acquire(READ, ROUTINE)
     deployment = resource_management_client.deployments.get(resource_group_name, acs_deployment)
     parameters = deployment.properties.parameters
     for parameter in parameters:
@@ -47,19 +60,76 @@ def download_parameters(resource_group_name, acs_deployment):
     return parameters
 
 def create_deployment(resource_group_name, deployment_name, properties):
+    budget.acquire(WRITE, SCALE_UP)
     return resource_management_client.deployments.create_or_update(resource_group_name,
                 deployment_name,
                 properties, raw=False)
 
-def delete_resources_for_node(node, resource_group_name):
+def list_running_deployments(resource_group_name):
+    """
+    returns the names of the deployments of the resource group which are running
+    """
+    budget.acquire(READ, ROUTINE)
+    deployments = resource_management_client.deployments.list_by_resource_group(
+        resource_group_name, filter="provisioningState eq 'Running'")
+    return [d.name for d in deployments]
+
+def list_virtual_machines(resource_group_name):
+    budget.acquire(READ, ROUTINE)
+    return list(compute_management_client.virtual_machines.list(resource_group_name))
+
+def list_network_interfaces(resource_group_name):
+    """
+    returns the names of the network interfaces of the resource group
+    """
+    budget.acquire(READ, ROUTINE)
+    resources = resource_management_client.resources.list_by_resource_group(
+        resource_group_name, filter="resourceType eq 'Microsoft.Network/networkInterfaces'")
+    return [r.name for r in resources]
+
+def list_managed_disks(resource_group_name):
+    budget.acquire(READ, ROUTINE)
+    return list(compute_management_client.disks.list_by_resource_group(resource_group_name))
+
+def get_nic_name(vm_name):
+    name_parts = vm_name.split('-')
+    return '{}-{}-{}-nic-{}'.format(
+        name_parts[0], name_parts[1], name_parts[2], name_parts[3])
+
+def delete_network_interface(resource_group_name, nic_name):
+    logger.info('Deleting NIC {}'.format(nic_name))
+    budget.acquire(WRITE, CLEANUP)
+    delete_nic_op = resource_management_client.resources.delete(resource_group_name,
+                                                                'Microsoft.Network',
+                                                                '',
+                                                                'networkInterfaces',
+                                                                nic_name,
+                                                                '2016-03-30')
+    delete_nic_op.wait()
+
+def delete_managed_disk(resource_group_name, disk_name):
+    logger.info('Deleting managed disk {}'.format(disk_name))
+    budget.acquire(WRITE, CLEANUP)
+    delete_managed_disk_op = compute_management_client.disks.delete(resource_group_name, disk_name)
+    delete_managed_disk_op.wait()
+
+def delete_resources_for_node(node, resource_group_name, vm_details=None):
+    """
+    deletes the VM of the node, its NIC and its OS disk.
+    vm_details - the VM as listed in bulk, fetched when not given
+    """
+    from azure.storage.blob import BlockBlobService
+    from azure.common import AzureHttpError
     global resource_management_client
     global compute_management_client
     global storage_management_client
 
     logger.info('deleting node {}'.format(node.name))
 
-    vm_details = compute_management_client.virtual_machines.get(
-        resource_group_name, node.name, None)
+    if vm_details is None:
+        budget.acquire(READ, CLEANUP)
+        vm_details = compute_management_client.virtual_machines.get(
+            resource_group_name, node.name, None)
     os_disk = vm_details.storage_profile.os_disk
 
     managed_disk_name = None
@@ -78,6 +148,7 @@ def delete_resources_for_node(node, resource_group_name):
 
     # delete vm
     logger.info('Deleting VM for {}'.format(node.name))
+    budget.acquire(WRITE, CLEANUP)
     delete_vm_op = resource_management_client.resources.delete(resource_group_name,
                                                                 'Microsoft.Compute',
                                                                 '',
@@ -88,23 +159,14 @@ def delete_resources_for_node(node, resource_group_name):
 
     # delete nic
     logger.info('Deleting NIC for {}'.format(node.name))
-    name_parts = node.name.split('-')
-    nic_name = '{}-{}-{}-nic-{}'.format(
-        name_parts[0], name_parts[1], name_parts[2], name_parts[3])
-    delete_nic_op = resource_management_client.resources.delete(resource_group_name,
-                                                                'Microsoft.Network',
-                                                                '',
-                                                                'networkInterfaces',
-                                                                nic_name,
-                                                                '2016-03-30')
-    delete_nic_op.wait()
+    delete_network_interface(resource_group_name, get_nic_name(node.name))
     
     # delete os blob
     logger.info('Deleting OS disk for {}'.format(node.name))
     if os_disk.managed_disk:
-        delete_managed_disk_op = compute_management_client.disks.delete(resource_group_name, managed_disk_name)
-        delete_managed_disk_op.wait()
+        delete_managed_disk(resource_group_name, managed_disk_name)
     else:        
+        budget.acquire(WRITE, CLEANUP)
         keys = storage_management_client.storage_accounts.list_keys(
             resource_group_name, account_name)
         key = keys.keys[0].value
@@ -2,36 +2,99 @@
 module to handle capacity of resources
 """
 import json
+import logging
 from collections import OrderedDict
 from autoscaler.config import Config
 from autoscaler.kube import KubeResource
 
-# RESOURCE_SPEC should denote the amount of resouces that are available
-# to workload pods on a new, clean node, i.e. resouces used by system pods
-# have to be accounted for
-with open(Config.CAPACITY_DATA, 'r') as f:
-    data = json.loads(f.read(), object_pairs_hook=OrderedDict)
-    RESOURCE_SPEC = {}
-    for instance_type, resource_spec in data.items():
-        resource_spec['cpu'] -= Config.CAPACITY_CPU_RESERVE
-        resource = KubeResource(**resource_spec)
-        RESOURCE_SPEC[instance_type] = resource
+logger = logging.getLogger(__name__)
+
 DEFAULT_TYPE_SELECTOR_KEY = 'beta.kubernetes.io/instance-type'
 
+_resource_spec = None
+
+
+def get_resource_spec():
+    """
+    returns a map of instance type -> KubeResource, loaded from the capacity data on first use.
+    It should denote the amount of resouces that are available
+    to workload pods on a new, clean node, i.e. resouces used by system pods
+    have to be accounted for
+    """
+    global _resource_spec
+    if _resource_spec is None:
+        with open(Config.CAPACITY_DATA, 'r') as f:
+            data = json.loads(f.read(), object_pairs_hook=OrderedDict)
+        resource_spec = OrderedDict()
+        for instance_type, spec in data.items():
+            spec['cpu'] -= Config.CAPACITY_CPU_RESERVE
+            resource_spec[instance_type] = KubeResource(**spec)
+        _resource_spec = resource_spec
+    return _resource_spec
+
 def get_capacity_for_instance_type(instance_type):
-    return RESOURCE_SPEC[instance_type]
+    return get_resource_spec()[instance_type]
 
-def is_possible(pod, agent_pools):
+def is_possible(pod, agent_pools, label_index=None):
     """
     returns whether the pod is possible under the maximum allowable capacity
+    of the pools matching its node selectors
     """
+    eligible_pools = label_index.matching_pools(pod.selectors) if label_index else None
     for pool in agent_pools:
-        if (RESOURCE_SPEC[pool.instance_type] - pod.resources).possible:
+        if eligible_pools is not None and pool.name not in eligible_pools:
+            continue
+        if (pool.unit_capacity - pod.resources).possible:
             return True
 
     return False
 
 def order_by_cost_asc(agent_pools):
-    keys = list(data.keys())
+    keys = list(get_resource_spec().keys())
     return sorted(agent_pools, key=lambda x: keys.index(x.instance_type))
 
+
+class CapacityLearner(object):
+    """
+    learns the capacity available to workload pods on a new node of each instance type,
+    from what is observed on the current nodes: their allocatable resources minus the
+    requests of the pods every node runs (DaemonSet and mirror pods).
+    Instance types without nodes fall back to the capacity data.
+    """
+
+    def __init__(self):
+        self.learned = {}
+
+    def learn(self, nodes, pods_by_node):
+        """
+        nodes - KubeNodes of the cluster
+        pods_by_node - map of node name -> list of KubePods running on this node
+        """
+        learned = {}
+        for node in nodes:
+            if node.allocatable is None or not node.instance_type:
+                continue
+            available = node.allocatable
+            for pod in pods_by_node.get(node.name, []):
+                if pod.is_mirrored() or pod.is_kube_proxy:
+                    available = available - pod.resources
+            # the most loaded node of an instance type tells what a new node can run for sure
+            if node.instance_type in learned:
+                current = learned[node.instance_type].raw
+                keys = set(current) | set(available.raw)
+                available = KubeResource(**dict((k, min(current.get(k, 0), available.get(k, 0)))
+                                                for k in keys))
+            learned[node.instance_type] = available
+
+        for instance_type, available in learned.items():
+            previous = self.learned.get(instance_type)
+            if previous is None or previous.raw != available.raw:
+                static = get_resource_spec().get(instance_type)
+                logger.info('Capacity of {} learned from its nodes: {} (capacity data: {})'.format(
+                    instance_type, available, static))
+            self.learned[instance_type] = available
+
+    def get(self, instance_type):
+        if instance_type in self.learned:
+            return self.learned[instance_type]
+        return get_capacity_for_instance_type(instance_type)
@@ -4,18 +4,32 @@ import logging
 import math
 import time
 import sys
+import threading
 import pykube
 import os
 
-from autoscaler.azure_api import login, download_parameters, download_template
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from autoscaler.azure_api import login, download_parameters, download_template, \
+    list_running_deployments, list_virtual_machines, budget
+from autoscaler.config import Config
 from autoscaler.engine_scaler import EngineScaler
 import autoscaler.capacity as capacity
+from autoscaler.equivalence import group_pods, fit_count
+from autoscaler.fingerprint import LoopSkipper
+from autoscaler.free_capacity import FreeCapacityIndex
+from autoscaler.ledger import CapacityLedger
 from autoscaler.kube import KubePod, KubeNode, KubeResource, KubePodStatus
 import autoscaler.utils as utils
 from autoscaler.deployments import Deployments
+from autoscaler.policy import PolicySet, load_policies
+from autoscaler.prerender import TemplatePrerenderer
+from autoscaler.reconciler import Reconciler
+from autoscaler.slo import SchedulingTracker
+from autoscaler.recorder import LoopRecorder
+from autoscaler.state import ControllerState
 from autoscaler.template_processing import delete_master_vm_extension
 
-from msrestazure.azure_exceptions import CloudError
 
 # we are interested in all pods, incl. system ones
 pykube.Pod.objects.namespace = None
@@ -29,6 +43,16 @@ pykube.http.requests.packages.urllib3.connection.match_hostname = backports.ssl_
 
 logger = logging.getLogger(__name__)
 
+# parts of the loop, which can run on their own intervals
+SCALE_UP = 'scale-up'
+MAINTENANCE = 'maintenance'
+LOOP_PHASES = (SCALE_UP, MAINTENANCE)
+# listings needed by each part of the loop
+PHASE_LISTINGS = {
+    SCALE_UP: ('nodes', 'pods', 'running_deployments'),
+    MAINTENANCE: ('nodes', 'pods', 'running_deployments', 'virtual_machines'),
+}
+
 class Cluster(object):
     def __init__(self, kubeconfig, idle_threshold, spare_agents, 
                  service_principal_app_id, service_principal_secret, service_principal_tenant_id, subscription_id,
@@ -36,7 +60,8 @@ class Cluster(object):
                  instance_init_time, resource_group, notifier, ignore_pools,
                  acs_deployment='azuredeploy',
                  scale_up=True, maintainance=True,
-                 over_provision=5, dry_run=False):
+                 over_provision=5, dry_run=False, consolidate=False, record_file=None,
+                 state_file=None, policy_file=None):
 
         # config
         self.kubeconfig = kubeconfig
@@ -46,7 +71,6 @@ class Cluster(object):
         self.subscription_id = subscription_id
         self.client_private_key = client_private_key
         self.ca_private_key = ca_private_key
-        self._drained = {}
         self.resource_group = resource_group
         self.acs_deployment = acs_deployment
         self.agent_pools = {}
@@ -59,8 +83,27 @@ class Cluster(object):
         self.maintainance = maintainance
         self.notifier = notifier
         self.dry_run = dry_run
-        self.deployments = Deployments()
+        self.state = ControllerState(state_file)
+        self.policies = load_policies(policy_file) if policy_file else PolicySet()
+        for name, deletion in self.state.get_operations('deletion').items():
+            logger.warn('Deletion of {} started at {} was interrupted'.format(name, deletion['started']))
+        self.tracker = SchedulingTracker()
+        self.deployments = Deployments(self.state, self.tracker)
         self.ignore_pools = ignore_pools
+        self.consolidate = consolidate
+        self.api = None
+        # virtual machines of the resource group, as listed at the beginning of the last loop
+        self.virtual_machines = None
+        self.reconciler = Reconciler(resource_group, dry_run=dry_run)
+        self.capacity_learner = capacity.CapacityLearner()
+        self.ledger = CapacityLedger()
+        self.recorder = LoopRecorder(record_file) if record_file else None
+        # created once the template is downloaded
+        self.prerenderer = None
+        # phases -> LoopSkipper, the loops of each phase are compared with the previous one
+        self.loop_skippers = collections.defaultdict(lambda: LoopSkipper(Config.LOOP_FINGERPRINT_BUCKET))
+        # held while the loops make decisions, see process()
+        self.lock = threading.RLock()
 
     def login(self):
         subscriptions = login(
@@ -73,6 +116,10 @@ class Cluster(object):
         self.arm_parameters = download_parameters(self.resource_group, self.acs_deployment)
         #downloaded parameters do not include SecureStrings parameters, so we need to fill them manually
         self.fill_parameters_secure_strings()
+        if self.recorder:
+            self.recorder.record_template(self.arm_template)
+        if Config.PRERENDER_STEPS:
+            self.prerenderer = TemplatePrerenderer(self.arm_template, self.arm_parameters)
 
         #firstConsecutiveStaticIP parameter is used as the private IP for the master
         os.environ["PYKUBE_KUBERNETES_SERVICE_HOST"] = self.arm_parameters['firstConsecutiveStaticIP']['value']
@@ -108,39 +155,187 @@ class Cluster(object):
 
         self.arm_template = delete_master_vm_extension(self.arm_template)
 
-    def loop(self, debug):
+    def loop(self, debug, phases=LOOP_PHASES):
         """
         runs one loop of scaling to current needs.
+        phases - parts of the loop to run, see process()
         returns True if successfully scaled.
         """
-        logger.info("++++ Running Scaling Loop ++++++")
+        logger.info("++++ Running Scaling Loop ({}) ++++++".format(', '.join(phases)))
 
         if debug:
             # In debug mode, we don't want to catch error. Let the app crash
             # explicitly
             logger.info('Debug mode is on')
-            return self.loop_logic()
+            return self.loop_logic(phases)
         else:
             try:
-                return self.loop_logic()
+                return self.loop_logic(phases)
             except Exception as e:
                 logger.error("Unexpected error: {}, {}".format(sys.exc_info()[0], e))
                 return False
     
     def create_kube_node(self, node):
         kube_node = KubeNode(node)
-        kube_node.capacity = capacity.get_capacity_for_instance_type(kube_node.instance_type)
+        if kube_node.allocatable is not None:
+            kube_node.capacity = kube_node.allocatable
+        else:
+            kube_node.capacity = capacity.get_capacity_for_instance_type(kube_node.instance_type)
         return kube_node
 
-    def loop_logic(self):
-        pykube_nodes = pykube.Node.objects(self.api)
+    def fetch(self, deadline=Config.LOOP_FETCH_DEADLINE, names=None):
+        """
+        lists the nodes, pods, running deployments and virtual machines of the cluster concurrently,
+        so that it takes as long as the slowest call.
+        names - listings to make, all of them by default
+        returns a dict of name -> result, without the calls which failed or didn't complete
+        within deadline seconds
+        """
+        calls = {
+            'nodes': lambda: list(pykube.Node.objects(self.api)),
+            'pods': lambda: list(pykube.Pod.objects(self.api)),
+            'running_deployments': lambda: list_running_deployments(self.resource_group),
+            'virtual_machines': lambda: list_virtual_machines(self.resource_group),
+        }
+        if names is not None:
+            calls = dict((name, call) for name, call in calls.items() if name in names)
+
+        def timed(name):
+            start = time.time()
+            result = calls[name]()
+            logger.debug('Listed {} in {:.2f}s'.format(name, time.time() - start))
+            return result
+
+        executor = ThreadPoolExecutor(max_workers=len(calls))
+        futures = dict((executor.submit(timed, name), name) for name in calls)
+        done, not_done = wait(futures, timeout=deadline)
+        # calls past the deadline are abandoned, their threads exit when the calls return
+        executor.shutdown(wait=False)
+
+        results = {}
+        for future in not_done:
+            logger.warn('Listing {} did not complete within {}s'.format(futures[future], deadline))
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logger.warn('Failed to list {}: {}'.format(futures[future], e))
+        return results
+
+    def loop_logic(self, phases=LOOP_PHASES):
+        names = set()
+        for phase in phases:
+            names.update(PHASE_LISTINGS[phase])
+        results = self.fetch(names=names)
+        pykube_nodes = results.get('nodes')
         if not pykube_nodes:
             logger.warn(
                 'Failed to list nodes. Please check kube configuration. Terminating scale loop.')
             return False
+        pykube_pods = results.get('pods')
+        if pykube_pods is None:
+            logger.warn('Failed to list pods. Terminating scale loop.')
+            return False
+        with self.lock:
+            # when the running deployments are unknown, the ones started by this process are still tracked
+            if 'running_deployments' in results:
+                self.deployments.set_running_deployments(results['running_deployments'])
+            else:
+                self.deployments.running_deployments = []
+            # scale-up loops keep the virtual machines listed by the last maintenance loop
+            if 'virtual_machines' in names:
+                self.virtual_machines = results.get('virtual_machines')
+            if self.virtual_machines is not None:
+                logger.info("Virtual machines: {}".format(len(self.virtual_machines)))
+            logger.info("ARM budget: {}".format(budget.metrics()))
+
+            if self.recorder:
+                self.recorder.record([n.obj for n in pykube_nodes], [p.obj for p in pykube_pods],
+                                     self.arm_parameters, self.deployments, self.get_config(),
+                                     state=self.state)
+
+        return self.process(pykube_nodes, pykube_pods, phases=tuple(phases))
+
+    def get_config(self):
+        """
+        returns the options driving the scaling decisions
+        """
+        return {
+            'spare_agents': self.spare_agents,
+            'idle_threshold': self.idle_threshold,
+            'over_provision': self.over_provision,
+            'ignore_pools': self.ignore_pools,
+            'scale_up': self.scale_up,
+            'maintainance': self.maintainance,
+            'consolidate': self.consolidate,
+            'policies': self.policies.to_dict(),
+        }
+
+    def process(self, pykube_nodes, pykube_pods, now=None, phases=LOOP_PHASES):
+        """
+        runs the scaling logic on the listed nodes and pods.
+        now - reference time of the loop, defaults to the current time
+        phases - parts of the scaling logic to run, SCALE_UP and/or MAINTENANCE.
+        Decisions are made under the lock of the cluster, so that the loops of each phase see
+        the changes of the other one, but deployments are submitted and waited for, and nodes
+        drained and deleted, after releasing it
+        """
+        with self.lock:
+            planned = self.plan(pykube_nodes, pykube_pods, now, phases)
+        if planned is not None:
+            scaler, all_nodes, maintenance = planned
+            submitted = scaler.scale_out is not None
+            try:
+                scaler.apply_scale_up(self.lock)
+            finally:
+                if submitted and self.state:
+                    with self.lock:
+                        self.state.save()
+            if maintenance is not None:
+                scaler.apply_maintenance(maintenance)
+                logger.info("++++ Maintenance Ends ++++++")
+                with self.lock:
+                    self.reconcile(all_nodes, scaler)
+                    if self.state:
+                        self.state.save()
+        return True
 
+    def plan(self, pykube_nodes, pykube_pods, now, phases):
+        """
+        scales up, and plans the maintenance of the nodes.
+        returns (scaler, nodes, maintenance plan), with a None plan when maintenance doesn't run,
+        or None when the loop was skipped
+        """
         all_nodes = list(filter(utils.is_agent, map(self.create_kube_node, pykube_nodes)))
 
+        pods = list(map(KubePod, pykube_pods))
+
+        running_or_pending_assigned_pods = [
+            p for p in pods if (p.status == KubePodStatus.RUNNING or p.status == KubePodStatus.CONTAINER_CREATING) or (
+                p.status == KubePodStatus.PENDING and p.node_name
+            )
+        ]
+
+        pods_by_node = {}
+        for pod in running_or_pending_assigned_pods:
+            pods_by_node.setdefault(pod.node_name, []).append(pod)
+        for node in all_nodes:
+            for pod in pods_by_node.get(node.name, []):
+                node.count_pod(pod)
+        self.capacity_learner.learn(all_nodes, pods_by_node)
+        self.ledger.settle(all_nodes, now)
+        logger.info("Nodes being created and deleted: {}".format(self.ledger.summary()))
+        if self.tracker.observe(pods, all_nodes, now):
+            logger.info("Time to schedule: {}".format(self.tracker.summary()))
+
+        loop_skipper = self.loop_skippers[phases]
+        skip, fingerprint = loop_skipper.should_skip(all_nodes, pods, self.deployments, now)
+        logger.info("Loops skipped: {}/{} ({:.0%})".format(
+            loop_skipper.skipped, loop_skipper.loops, loop_skipper.skip_rate))
+        if skip:
+            logger.info("Nothing changed since the previous loop, skipping it")
+            return None
+
         scaler = EngineScaler(
             resource_group=self.resource_group,
             nodes=all_nodes,
@@ -152,51 +347,92 @@ class Cluster(object):
             over_provision=self.over_provision,
             spare_count=self.spare_agents,
             idle_threshold=self.idle_threshold,
-            notifier=self.notifier)
-
-        pods = list(map(KubePod, pykube.Pod.objects(self.api)))
-
-        running_or_pending_assigned_pods = [
-            p for p in pods if (p.status == KubePodStatus.RUNNING or p.status == KubePodStatus.CONTAINER_CREATING) or (
-                p.status == KubePodStatus.PENDING and p.node_name
-            )
-        ]
-
-        for node in all_nodes:
-            for pod in running_or_pending_assigned_pods:
-                if pod.node_name == node.name:
-                    node.count_pod(pod)
-        pods_to_schedule = self.get_pods_to_schedule(pods, scaler.agent_pools)
+            notifier=self.notifier,
+            consolidate=self.consolidate,
+            state=self.state,
+            virtual_machines=self.virtual_machines,
+            capacity_learner=self.capacity_learner,
+            tracker=self.tracker,
+            policies=self.policies,
+            prerenderer=self.prerenderer,
+            ledger=self.ledger)
+        scaler.now = now
+        if self.state:
+            self.state.retain(node.name for node in all_nodes)
+
+        pods_to_schedule = self.get_pods_to_schedule(pods, scaler.agent_pools, scaler.label_index)
         logger.info("Pods to schedule: {}".format(len(pods_to_schedule)))
 
-        if self.scale_up:
+        if self.scale_up and SCALE_UP in phases:
             logger.info("++++ Scaling Up Begins ++++++")
             self.scale(pods_to_schedule, all_nodes, scaler)
             logger.info("++++ Scaling Up Ends ++++++")
-        if self.maintainance:
+            self.prerender(scaler)
+        maintenance = None
+        if self.maintainance and MAINTENANCE in phases:
             logger.info("++++ Maintenance Begins ++++++")
-            self.maintain(pods_to_schedule,
-                          running_or_pending_assigned_pods, scaler)
-            logger.info("++++ Maintenance Ends ++++++")
+            maintenance = self.maintain(pods_to_schedule,
+                                        running_or_pending_assigned_pods, scaler)
 
-        return True
+        if self.state:
+            self.state.save()
+        loop_skipper.done(fingerprint)
+        return scaler, all_nodes, maintenance
 
-    def get_pending_pods(self, pods, nodes):
+
+    def prerender(self, scaler):
+        """
+        renders the templates of the next scale-outs while the loop sleeps
+        """
+        if not self.prerenderer or not self.scale_up or self.dry_run:
+            return
+        if self.deployments.is_in_progress():
+            # the pools change when it finishes
+            return
+        logger.info("Pre-rendered templates: {}".format(self.prerenderer.stats()))
+        self.prerenderer.schedule(scaler.agent_pools, scaler.scalable_pools)
+
+    def reconcile(self, nodes, scaler):
+        """
+        cleans up the resources left behind by VM deletions, every RECONCILE_INTERVAL seconds
+        """
+        if self.virtual_machines is None or not self.reconciler.is_due():
+            return
+        if self.deployments.is_in_progress():
+            # the NICs of VMs being created would look orphaned
+            logger.info('A deployment is in progress, skipping reconciliation')
+            return
+        self.reconciler.reconcile(self.virtual_machines, nodes,
+                                  set(pool.name for pool in scaler.scalable_pools))
+
+    def get_pending_pods(self, pods, nodes, label_index=None):
         pending_pods = []
-        # for each pending & unassigned job, try to fit them on current machines or count requested
-        #   resources towards future machines
-        for pod in pods:
-            fitting = None
-            for node in nodes:
-                if node.can_fit(pod.resources):
-                    fitting = node
+        index = FreeCapacityIndex(nodes)
+        # for each class of identical pending & unassigned jobs, try to fit them on current machines
+        #   or count requested resources towards future machines
+        for pod_class in group_pods(pods):
+            predicate = None
+            if label_index and pod_class.selectors:
+                predicate = label_index.matching_nodes(pod_class.selectors).__contains__
+            group = tuple(sorted(pod_class.selectors.items()))
+            requests = pod_class.resources.raw
+            class_pods = pod_class.pods
+            while class_pods:
+                fitting = index.find(requests, predicate, group)
+                if fitting is None:
+                    pending_pods.extend(class_pods)
                     break
-            if fitting is None:
-                pending_pods.append(pod)
-            else:
-                fitting.count_pod(pod)
-                logger.info("{pod} fits on {node}".format(pod=pod,
-                                                          node=fitting))
+                # the node stays the best fit until it is full, place as many pods as it takes at once
+                count = max(1, fit_count(index.free(fitting), requests, len(class_pods)))
+                index.place(fitting, dict((k, v * count) for k, v in requests.items()))
+                for pod in class_pods[:count]:
+                    fitting.count_pod(pod)
+                if count == 1:
+                    logger.info("{pod} fits on {node}".format(pod=class_pods[0], node=fitting))
+                else:
+                    logger.info("{pod} and {count} identical pods fit on {node}".format(
+                        pod=class_pods[0], count=count - 1, node=fitting))
+                class_pods = class_pods[count:]
         logger.info("Pending pods: {}".format(len(pending_pods)))
         for pod in pending_pods:
             logger.debug(pod.name)
@@ -210,11 +446,15 @@ class Cluster(object):
         logger.info("Nodes: {}".format(len(nodes)))
         logger.info("To schedule: {}".format(len(pods_to_schedule)))
 
-        pending_pods = self.get_pending_pods(pods_to_schedule, nodes)
+        # the free capacity of the nodes being deleted won't last
+        nodes = [node for node in nodes if not self.ledger.is_removing(node)]
+        pending_pods = self.get_pending_pods(pods_to_schedule, nodes, scaler.label_index)
         if len(pending_pods) > 0:
             scaler.fulfill_pending(pending_pods)
+        else:
+            scaler.fill_min_size()
 
-    def get_pods_to_schedule(self, pods, agent_pools):
+    def get_pods_to_schedule(self, pods, agent_pools, label_index=None):
         """
         given a list of KubePod objects,
         return a map of (selectors hash -> pods) to be scheduled
@@ -227,17 +467,17 @@ class Cluster(object):
         # we only consider a pod to be schedulable if it's pending and
         # unassigned and feasible
         pods_to_schedule = []
-        for pod in pending_unassigned_pods:
-            if capacity.is_possible(pod, agent_pools):
-                pods_to_schedule.append(pod)
+        for pod_class in group_pods(pending_unassigned_pods):
+            if capacity.is_possible(pod_class.representative, agent_pools, label_index):
+                pods_to_schedule.extend(pod_class.pods)
             else:
                 logger.warn(
-                    "Pending pod %s cannot fit. "
+                    "Pending pod %s cannot fit (with %d identical pods). "
                     "Please check that requested resource amount is "
                     "consistent with node size."
-                    "Scheduling skipped." % (pod.name))
+                    "Scheduling skipped." % (pod_class.representative.name, len(pod_class) - 1))
 
         return pods_to_schedule
 
     def maintain(self, pods_to_schedule, running_or_pending_assigned_pods, scaler):
-        scaler.maintain(pods_to_schedule, running_or_pending_assigned_pods)
\ No newline at end of file
+        return scaler.plan_maintenance(pods_to_schedule, running_or_pending_assigned_pods)
\ No newline at end of file
@@ -4,3 +4,25 @@ import os
 class Config(object):
     CAPACITY_DATA = os.environ.get('CAPACITY_DATA', 'data/capacity.json')
     CAPACITY_CPU_RESERVE = float(os.environ.get('CAPACITY_CPU_RESERVE', 0.0))
+    KUBE_API_CONCURRENCY = int(os.environ.get('KUBE_API_CONCURRENCY', 10))
+    DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', 300))
+    RECORD_MAX_BYTES = int(os.environ.get('RECORD_MAX_BYTES', 50 * 1024 * 1024))
+    RECORD_BACKUP_COUNT = int(os.environ.get('RECORD_BACKUP_COUNT', 5))
+    MEMORY_WATCH_INTERVAL = int(os.environ.get('MEMORY_WATCH_INTERVAL', 600))
+    MEMORY_WATCH_TOP = int(os.environ.get('MEMORY_WATCH_TOP', 10))
+    CLUSTER_CONCURRENCY = int(os.environ.get('CLUSTER_CONCURRENCY', 4))
+    LOOP_FETCH_DEADLINE = int(os.environ.get('LOOP_FETCH_DEADLINE', 60))
+    RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL', 600))
+    ARM_CONCURRENCY = int(os.environ.get('ARM_CONCURRENCY', 5))
+    ARM_READS_PER_SECOND = float(os.environ.get('ARM_READS_PER_SECOND', 5))
+    ARM_WRITES_PER_SECOND = float(os.environ.get('ARM_WRITES_PER_SECOND', 1))
+    ARM_BURST = int(os.environ.get('ARM_BURST', 20))
+    ARM_BUDGET_LOW_WATERMARK = int(os.environ.get('ARM_BUDGET_LOW_WATERMARK', 200))
+    ARM_BUDGET_WINDOW = int(os.environ.get('ARM_BUDGET_WINDOW', 3600))
+    ARM_THROTTLED_PAUSE = int(os.environ.get('ARM_THROTTLED_PAUSE', 30))
+    # pool growths (in agents) rendered ahead of time, empty to disable pre-rendering
+    PRERENDER_STEPS = [int(step) for step in os.environ.get('PRERENDER_STEPS', '1,2,4,8').split(',') if step]
+    # loops finding the cluster unchanged skip the scaling logic, for at most this many seconds (0 never skips)
+    LOOP_FINGERPRINT_BUCKET = int(os.environ.get('LOOP_FINGERPRINT_BUCKET', 300))
+    # seconds after which nodes requested or deleted are no longer accounted for if they didn't register or disappear
+    CAPACITY_LEDGER_TTL = int(os.environ.get('CAPACITY_LEDGER_TTL', 1800))
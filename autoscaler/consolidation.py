@@ -0,0 +1,71 @@
+"""
+module to plan the consolidation of under-utilized nodes before scaling in
+"""
+import datetime
+import logging
+
+from autoscaler.free_capacity import FreeCapacityIndex
+
+logger = logging.getLogger(__name__)
+
+
+def _pods_to_move(node_pods):
+    # DaemonSet, static and kube-proxy pods run on every node and don't need to be rescheduled
+    return [p for p in node_pods if not (p.is_mirrored() or p.is_kube_proxy)]
+
+
+def _utilization(node, pods):
+    return sum(p.resources.get('cpu', 0) for p in pods) / max(node.capacity.get('cpu', 0), 1e-9)
+
+
+def plan_consolidation(pool, candidates, pods_by_node, max_removals, now=None):
+    """
+    returns the largest set of candidate nodes (up to max_removals) whose pods can all be
+    rescheduled on the other schedulable nodes of the pool, found by simulating the
+    rescheduling of their pods, least utilized nodes first.
+    params:
+    pool - AgentPool object
+    candidates - list of KubeNode of the pool that may be removed
+    pods_by_node - map of node name -> list of KubePods assigned to this node
+    max_removals - maximum number of nodes to remove
+    now - reference time, defaults to the current time
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    index = FreeCapacityIndex(n for n in pool.nodes if not n.unschedulable)
+
+    ordered_candidates = []
+    for node in candidates:
+        if node not in index:
+            continue
+        pods = _pods_to_move(pods_by_node.get(node.name, []))
+        if all(p.is_drainable(now) for p in pods):
+            ordered_candidates.append((_utilization(node, pods), node, pods))
+    ordered_candidates.sort(key=lambda c: (c[0], c[1].name))
+
+    removed = []
+    receivers = set()
+    for _, node, pods in ordered_candidates:
+        if len(removed) >= max_removals:
+            break
+        if node in receivers:
+            continue
+        free = index.remove(node)
+        placements = []
+        for pod in sorted(pods, key=lambda p: p.resources.get('cpu', 0), reverse=True):
+            target = index.find(pod.resources.raw, predicate=lambda n: n.is_match(pod))
+            if target is None:
+                break
+            index.place(target, pod.resources.raw)
+            placements.append((target, pod))
+
+        if len(placements) == len(pods):
+            removed.append(node)
+            receivers.update(target for target, _ in placements)
+            logger.debug('%s can be consolidated, %s pods rescheduled', node, len(pods))
+        else:
+            for target, pod in placements:
+                index.release(target, pod.resources.raw)
+            index.add(node, free)
+
+    logger.info('Consolidation of pool %s: %s node(s) can be removed', pool.name, len(removed))
+    return removed
@@ -1,24 +1,136 @@
 import logging
-from msrestazure.azure_operation import AzureOperationPoller
+import threading
 
 logger = logging.getLogger(__name__)
 
+DEPLOYMENT_PREFIX = 'autoscaler-deployment-'
+
 class Deployments:
-    def __init__(self):
+    def __init__(self, state=None, tracker=None):
+        """
+        state - optional ControllerState, the deployment in flight is recorded in it
+        tracker - optional SchedulingTracker, told when deployments are submitted and finished
+        """
         self._current_deployment = None
+        # set from start() until the deployment finished
+        self._submitting = False
+        self._previous_pool_sizes = None
         self.requested_pool_sizes = None
+        self.state = state
+        self.tracker = tracker
+        # names of the deployments running on the ARM side, as listed at the beginning of the loop
+        self.running_deployments = []
+        # pool name -> indexes of the nodes created by the deployment in flight
+        self.reserved_indexes = {}
+        # whether the deployment in flight was started before a restart
+        self._restored = False
+        if state:
+            # a deployment was in flight when the autoscaler stopped, don't request it again
+            for deployment in state.get_operations('deployment').values():
+                logger.info('Deployment started at {} was in flight'.format(deployment['started']))
+                self.requested_pool_sizes = deployment['pool_sizes']
+                self._restored = True
+                for pool_name, indexes in deployment.get('reserved_indexes', {}).items():
+                    self.reserved_indexes.setdefault(pool_name, set()).update(indexes)
+
+    def set_running_deployments(self, names):
+        """
+        names - deployments running on the ARM side.
+        Finishes a deployment which finished while nobody waited for it (e.g. started before a
+        restart), releasing the indexes it reserved
+        """
+        self.running_deployments = names
+        if (self.reserved_indexes or self._restored) and not self.is_in_progress():
+            logger.info('Deployment in flight finished, releasing the indexes it reserved')
+            self.release_indexes()
+            if self._restored:
+                # whether it succeeded is unknown, the same pool sizes can be requested again
+                self.requested_pool_sizes = None
+                self._restored = False
+            if self.state:
+                self.state.finish_operation('deployment', 'scale-out')
+
+    def get_reserved_indexes(self, pool_name):
+        return set(self.reserved_indexes.get(pool_name, ()))
+
+    def reserve_indexes(self, pool_name, indexes):
+        """
+        reserves the indexes of the nodes created by the deployment about to be submitted,
+        so that the next deployments don't use them until it succeeded or failed
+        """
+        self.reserved_indexes.setdefault(pool_name, set()).update(indexes)
+        if self.state:
+            self.state.start_operation('deployment', 'scale-out', {
+                'pool_sizes': self.requested_pool_sizes,
+                'reserved_indexes': dict((name, sorted(reserved))
+                                         for name, reserved in self.reserved_indexes.items()),
+            })
+
+    def release_indexes(self):
+        self.reserved_indexes = {}
     
-    def deploy(self, func, new_pool_sizes):
-        if not self._current_deployment or self._current_deployment.done():
-            if self.requested_pool_sizes and self.requested_pool_sizes == new_pool_sizes:
-                #this can happen when a new node is coming online and kubectl isn't ready yet
-                logger.info('Requested a new deployment with unchanged pool sizes, skipping.')
-                return
-            self.requested_pool_sizes = new_pool_sizes   
-            self._current_deployment = func()  
-            if isinstance(self._current_deployment, AzureOperationPoller):
-                self._current_deployment.wait()
-                logger.info('Deployment finished: {}'.format(self._current_deployment.result()))
-            
-        else:
+    def is_in_progress(self):
+        if self._submitting:
+            return True
+        if self._current_deployment and not self._current_deployment.done():
+            return True
+        # e.g. a deployment started before a restart
+        return any(name.startswith(DEPLOYMENT_PREFIX) for name in self.running_deployments)
+
+    def start(self, new_pool_sizes):
+        """
+        records the deployment of new_pool_sizes as in flight, before it is submitted by submit().
+        returns False when it is skipped
+        """
+        if self.is_in_progress():
             logger.info('Another deployment is already in progress')
+            return False
+        if self.requested_pool_sizes and self.requested_pool_sizes == new_pool_sizes:
+            #this can happen when a new node is coming online and kubectl isn't ready yet
+            logger.info('Requested a new deployment with unchanged pool sizes, skipping.')
+            return False
+        self._previous_pool_sizes = self.requested_pool_sizes
+        self.requested_pool_sizes = new_pool_sizes
+        self._submitting = True
+        self._restored = False
+        if self.state:
+            self.state.start_operation('deployment', 'scale-out', {'pool_sizes': new_pool_sizes})
+        if self.tracker:
+            self.tracker.deployment_submitted(new_pool_sizes, self._previous_pool_sizes)
+        return True
+
+    def submit(self, func, lock=None):
+        """
+        submits the deployment recorded by start() and waits for it to finish.
+        lock - held only to record the outcome, so that the other loops of the cluster
+        aren't blocked while the deployment runs
+        """
+        lock = lock or threading.Lock()
+        try:
+            deployment = func()
+            with lock:
+                self._current_deployment = deployment
+            from msrestazure.azure_operation import AzureOperationPoller
+            if isinstance(deployment, AzureOperationPoller):
+                deployment.wait()
+                logger.info('Deployment finished: {}'.format(deployment.result()))
+        except Exception:
+            with lock:
+                # request the same pool sizes again in the next loops
+                self.requested_pool_sizes = self._previous_pool_sizes
+                self._finish()
+            raise
+        with lock:
+            self._finish()
+            if self.tracker:
+                self.tracker.deployment_finished()
+
+    def _finish(self):
+        self._submitting = False
+        self.release_indexes()
+        if self.state:
+            self.state.finish_operation('deployment', 'scale-out')
+
+    def deploy(self, func, new_pool_sizes, lock=None):
+        if self.start(new_pool_sizes):
+            self.submit(func, lock)
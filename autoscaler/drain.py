@@ -0,0 +1,121 @@
+"""
+module to drain nodes through pod evictions
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pykube.exceptions
+
+from autoscaler.config import Config
+
+logger = logging.getLogger(__name__)
+
+# status codes returned by the Eviction subresource
+_EVICTION_ACCEPTED = (200, 201)
+_EVICTION_NOT_FOUND = 404
+_EVICTION_BLOCKED = 429
+
+_INITIAL_BACKOFF = 1
+_MAX_BACKOFF = 30
+_TERMINATION_POLL_INTERVAL = 2
+
+
+class DrainResult(object):
+    def __init__(self, node):
+        self.node = node
+        self.evicted = []
+        self.failed = []
+        self.duration = 0.0
+
+    @property
+    def success(self):
+        return not self.failed
+
+    def __str__(self):
+        return 'DrainResult({}, evicted={}, failed={}, duration={:.1f}s)'.format(
+            self.node, len(self.evicted), len(self.failed), self.duration)
+
+
+def evict_pod(pod, deadline):
+    """
+    evicts the pod, retrying with exponential backoff while a PodDisruptionBudget blocks it,
+    then waits for the pod to be terminated.
+    returns whether the pod was terminated before the deadline.
+    """
+    backoff = _INITIAL_BACKOFF
+    while True:
+        try:
+            status = pod.evict()
+        except pykube.exceptions.HTTPError as ex:
+            logger.warn('Eviction of %s failed: %s', pod, ex)
+            return False
+        if status == _EVICTION_NOT_FOUND:
+            return True
+        if status in _EVICTION_ACCEPTED:
+            break
+        if status != _EVICTION_BLOCKED:
+            logger.warn('Eviction of %s failed with status %s', pod, status)
+            return False
+        if time.time() + backoff > deadline:
+            logger.warn('Eviction of %s still blocked by a disruption budget, giving up', pod)
+            return False
+        logger.debug('Eviction of %s blocked by a disruption budget, retrying in %ss', pod, backoff)
+        time.sleep(backoff)
+        backoff = min(backoff * 2, _MAX_BACKOFF)
+
+    while time.time() < deadline:
+        try:
+            if pod.is_terminated():
+                return True
+        except pykube.exceptions.HTTPError as ex:
+            logger.debug('Failed to check termination of %s: %s', pod, ex)
+        time.sleep(_TERMINATION_POLL_INTERVAL)
+    logger.warn('%s was not terminated before the drain deadline', pod)
+    return False
+
+
+def _timed_evict_pod(pod, deadline):
+    return evict_pod(pod, deadline), time.time()
+
+
+def drain_nodes(pods_by_node, notifier=None,
+                max_workers=Config.KUBE_API_CONCURRENCY, timeout=Config.DRAIN_TIMEOUT):
+    """
+    drains the nodes by evicting their drainable pods, with at most max_workers
+    evictions in flight across all nodes.
+    pods_by_node - map of KubeNode -> list of KubePods running on it
+    returns a map of KubeNode -> DrainResult
+    """
+    start = time.time()
+    deadline = start + timeout
+    results = dict((node, DrainResult(node)) for node in pods_by_node)
+    tasks = []
+    for node, pods in pods_by_node.items():
+        for pod in pods:
+            # DaemonSet and static pods would be recreated right away on the node
+            if pod.is_drainable() and not pod.is_mirrored():
+                tasks.append((node, pod))
+
+    if tasks:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+            futures = [(node, pod, executor.submit(_timed_evict_pod, pod, deadline))
+                       for node, pod in tasks]
+            for node, pod, future in futures:
+                try:
+                    terminated, finished_at = future.result()
+                except Exception as e:
+                    logger.error('Eviction of %s failed: %s', pod, e)
+                    terminated, finished_at = False, time.time()
+                result = results[node]
+                if terminated:
+                    result.evicted.append(pod)
+                else:
+                    result.failed.append(pod)
+                result.duration = max(result.duration, finished_at - start)
+
+    for node, result in results.items():
+        logger.info('drained %s', result)
+        if notifier:
+            notifier.notify_drained_node(node, pods_by_node[node])
+    return results
@@ -9,8 +9,14 @@ from copy import deepcopy
 import autoscaler.utils as utils
 from autoscaler.agent_pool import AgentPool
 from autoscaler.scaler import Scaler, ClusterNodeState
-from autoscaler.template_processing import prepare_template_for_scale_out
+from autoscaler.template_processing import render_scale_out, set_count_parameters, \
+    get_new_nodes_indexes
 from autoscaler.azure_api import delete_resources_for_node, create_deployment
+from autoscaler.kube import cordon_nodes, uncordon_nodes
+from autoscaler.drain import drain_nodes
+from autoscaler.consolidation import plan_consolidation
+from autoscaler.deployments import DEPLOYMENT_PREFIX
+from autoscaler.label_index import LabelIndex
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +26,9 @@ class EngineScaler(Scaler):
     def __init__(
             self, resource_group, nodes,
             over_provision, spare_count, idle_threshold, dry_run,
-            deployments, arm_template, arm_parameters, ignore_pools, notifier):
+            deployments, arm_template, arm_parameters, ignore_pools, notifier,
+            consolidate=False, state=None, virtual_machines=None, capacity_learner=None,
+            tracker=None, policies=None, prerenderer=None, ledger=None):
 
         Scaler.__init__(
             self, resource_group, nodes, over_provision,
@@ -28,9 +36,25 @@ class EngineScaler(Scaler):
 
         self.arm_parameters = arm_parameters
         self.arm_template = arm_template
+        self.consolidate = consolidate
+        self.state = state
+        self.tracker = tracker
+        # TemplatePrerenderer holding the templates of the likely next scale-outs
+        self.prerenderer = prerenderer
+        self.ledger = ledger
+        # pool sizes of the deployment decided by scale_pools, submitted by apply_scale_up
+        self.scale_out = None
+        # pool name -> indexes of the nodes created by the scale-out
+        self.new_node_indexes = {}
+        if policies is not None:
+            self.policies = policies
+        # VM details listed in bulk, by name, so that deletions don't have to get them one by one
+        self.virtual_machines = dict((vm.name, vm) for vm in virtual_machines or [])
+        self.capacity_learner = capacity_learner
         for pool_name in ignore_pools.split(','):
             self.ignored_pool_names[pool_name] = True
         self.agent_pools, self.scalable_pools = self.get_agent_pools(nodes)
+        self.label_index = LabelIndex(nodes, self.agent_pools)
 
     def get_agent_pools(self, nodes):
         params = self.arm_parameters
@@ -44,11 +68,29 @@ class EngineScaler(Scaler):
             pool_name = utils.get_pool_name(node)
             pools[pool_name]['nodes'].append(node)
 
+        # the nodes are labeled with the normalized name of the location, e.g. southcentralus
+        location = params.get('location', {}).get('value') or None
+        if location:
+            location = location.lower().replace(' ', '')
+
         agent_pools = []
         scalable_pools = []
         for pool_name in pools:
             pool_info = pools[pool_name]
-            pool = AgentPool(pool_name, pool_info['size'], pool_info['nodes'])
+            unit_capacity = None
+            if self.capacity_learner:
+                unit_capacity = self.capacity_learner.get(pool_info['size'])
+            pool = AgentPool(pool_name, pool_info['size'], pool_info['nodes'], unit_capacity)
+            pool.max_size = self.policies.get(pool_name).max_size
+            pool.location = location
+            if self.deployments:
+                pool.reserved_indexes = self.deployments.get_reserved_indexes(pool_name)
+            if self.ledger:
+                # the nodes requested by the previous deployments which haven't registered yet
+                pool.reserved_indexes |= self.ledger.requested_indexes(pool_name)
+                # nodes being deleted can't be reclaimed
+                pool.unschedulable_nodes = [n for n in pool.unschedulable_nodes
+                                            if not self.ledger.is_removing(n)]
             agent_pools.append(pool)
             if not pool_name in self.ignored_pool_names:
                 scalable_pools.append(pool)
@@ -58,23 +100,38 @@ class EngineScaler(Scaler):
     def delete_node(self, pool, node, lock):
         pool_sizes = {}
         with lock:
-            for pool in self.agent_pools:
-                pool_sizes[pool.name] = pool.actual_capacity
-            pool_sizes[pool.name] = pool.actual_capacity - 1
+            if self.ledger:
+                self.ledger.start_removal(pool.name, node.name, self.now)
+                removing = len(self.ledger.removing_nodes(pool.name))
+            else:
+                removing = 1
+            for agent_pool in self.agent_pools:
+                pool_sizes[agent_pool.name] = agent_pool.actual_capacity
+            pool_sizes[pool.name] = pool.actual_capacity - removing
             self.deployments.requested_pool_sizes = pool_sizes
 
-        delete_resources_for_node(node, self.resource_group_name)
+        if self.state:
+            self.state.start_operation('deletion', node.name, {'pool': utils.get_pool_name(node)})
+        delete_resources_for_node(node, self.resource_group_name, self.virtual_machines.get(node.name))
+        if self.state:
+            self.state.finish_operation('deletion', node.name)
 
     def scale_pools(self, new_pool_sizes):
         has_changes = False
+        scaled_up = []
         for pool in self.scalable_pools:
-            new_size = new_pool_sizes[pool.name]
-            new_pool_sizes[pool.name] = min(pool.max_size, new_size)
-            if new_pool_sizes[pool.name] == pool.actual_capacity:
-                logger.info("Pool '{}' already at desired capacity ({})".format(
-                    pool.name, pool.actual_capacity))
+            new_size = self.clamp_scale_up(pool, new_pool_sizes[pool.name])
+            new_pool_sizes[pool.name] = new_size
+            in_flight = self.in_flight_count(pool)
+            if new_size == pool.actual_capacity or \
+                    (in_flight and new_size <= pool.actual_capacity + in_flight):
+                logger.info("Pool '{}' already at desired capacity ({}, {} being created)".format(
+                    pool.name, pool.actual_capacity, in_flight))
+                new_pool_sizes[pool.name] = pool.actual_capacity
                 continue
             has_changes = True
+            if new_size > pool.actual_capacity:
+                scaled_up.append(pool.name)
 
             if not self.dry_run:
                 if new_size > pool.actual_capacity:
@@ -84,94 +141,179 @@ class EngineScaler(Scaler):
                     pool.name, new_size, pool.actual_capacity))
 
         if not self.dry_run and has_changes:
-            self.deployments.deploy(lambda: self.deploy_pools(
-                new_pool_sizes), new_pool_sizes)
+            if self.deployments.start(new_pool_sizes):
+                # skipped scale-ups don't restart the cooldowns
+                if self.state:
+                    for pool_name in scaled_up:
+                        self.state.record_scale(pool_name, 'up', self.now)
+                self.reserve_new_nodes(new_pool_sizes)
+                self.scale_out = new_pool_sizes
 
-    def deploy_pools(self, new_pool_sizes):
-        from azure.mgmt.resource.resources.models import DeploymentProperties, TemplateLink
+    def reserve_new_nodes(self, new_pool_sizes):
+        """
+        reserves the indexes of the nodes the scale-out creates, so that the other loops count them
+        """
+        set_count_parameters(self.arm_parameters, self.scalable_pools, new_pool_sizes)
         for pool in self.scalable_pools:
-            if new_pool_sizes[pool.name] == 0:
-                # This is required as 0 is not an accepted value for the Count parameter,
-                # but setting the offset to 1 actually prevent the deployment
-                # from changing anything
-                self.arm_parameters[pool.name +
-                                    'Count'] = {'value': 1}
-                self.arm_parameters[pool.name +
-                                    'Offset'] = {'value': 1}
-            else:
-                # We don't need to set the offset parameter as we are directly specifying each
-                # resource in the template instead of using Count func
-                self.arm_parameters[pool.name +
-                                    'Count'] = {'value': new_pool_sizes[pool.name]}
+            indexes = get_new_nodes_indexes(pool, new_pool_sizes[pool.name])
+            if indexes:
+                self.deployments.reserve_indexes(pool.name, indexes)
+                self.new_node_indexes[pool.name] = indexes
+                if self.ledger:
+                    self.ledger.request(pool.name, indexes, self.now)
 
-        template = prepare_template_for_scale_out(
-            self.arm_template, self.agent_pools, new_pool_sizes)
+    def apply_scale_up(self, lock=None):
+        """
+        submits the deployment decided by scale_pools and waits for it to finish.
+        lock - lock of the cluster, held only to record the outcome of the deployment
+        """
+        if self.scale_out is None:
+            return
+        new_pool_sizes, self.scale_out = self.scale_out, None
+        try:
+            self.deployments.submit(lambda: self.deploy_pools(new_pool_sizes), lock)
+        except Exception:
+            if self.ledger:
+                # the nodes won't register, the next loops can request them again
+                for pool_name, indexes in self.new_node_indexes.items():
+                    self.ledger.cancel(pool_name, indexes)
+            raise
+
+    def deploy_pools(self, new_pool_sizes):
+        from azure.mgmt.resource.resources.models import DeploymentProperties, TemplateLink
+        rendered = None
+        if self.prerenderer:
+            rendered = self.prerenderer.get(self.agent_pools, new_pool_sizes)
+        if rendered:
+            logger.info('Using the pre-rendered template')
+            template, parameters = rendered
+        else:
+            template, parameters = render_scale_out(
+                self.arm_template, self.arm_parameters, self.agent_pools, new_pool_sizes)
 
         properties = DeploymentProperties(template=template, template_link=None,
-                                          parameters=self.arm_parameters, mode='incremental')
+                                          parameters=parameters, mode='incremental')
 
         deployment_id = str(uuid.uuid4()).split('-')[0]
-        deployment_name = "autoscaler-deployment-{}".format(deployment_id)       
+        deployment_name = "{}{}".format(DEPLOYMENT_PREFIX, deployment_id)       
         logger.info('Deployment {} started...'.format(deployment_name))
         return create_deployment(self.resource_group_name,
                                     deployment_name,
                                     properties)
 
+    def consolidate_pool(self, pool, node_states, pods_by_node, max_nodes_to_drain):
+        """
+        lets the consolidation planner decide which busy or under-utilized nodes should be drained,
+        depending on whether their pods can be rescheduled on the rest of the pool.
+        node_states is updated in place.
+        """
+        candidates = [n for n in pool.nodes if node_states[n] in (
+            ClusterNodeState.BUSY, ClusterNodeState.UNDER_UTILIZED_DRAINABLE)]
+        removable = plan_consolidation(pool, candidates, pods_by_node, max(0, max_nodes_to_drain),
+                                       self.current_time())
+        for node in candidates:
+            if node in removable:
+                if node_states[node] == ClusterNodeState.BUSY:
+                    node_states[node] = ClusterNodeState.CONSOLIDATABLE
+            elif node_states[node] == ClusterNodeState.UNDER_UTILIZED_DRAINABLE:
+                node_states[node] = ClusterNodeState.UNDER_UTILIZED_UNPACKABLE
+
     def maintain(self, pods_to_schedule, running_or_pending_assigned_pods):
         """
         maintains running instances:
         - determines if idle nodes should be drained and terminated
         """
+        self.apply_maintenance(self.plan_maintenance(pods_to_schedule, running_or_pending_assigned_pods))
+
+    def plan_maintenance(self, pods_to_schedule, running_or_pending_assigned_pods):
+        """
+        decides which nodes should be cordoned, uncordoned, drained and deleted.
+        returns the plan to give to apply_maintenance
+        """
 
         logger.info("++++ Maintaining Nodes ++++++")
 
         delete_queue = []
+        cordon_queue = []
+        drain_queue = []
+        uncordon_queue = []
         pods_by_node = {}
         for p in running_or_pending_assigned_pods:
             pods_by_node.setdefault(p.node_name, []).append(p)
 
         for pool in self.scalable_pools:
+            policy = self.policies.get(pool.name)
+            spare_count = self.spare_count if policy.spare_agents is None else policy.spare_agents
+            schedulable_count = pool.actual_capacity - len(pool.unschedulable_nodes)
                 # maximum nomber of nodes we can drain without hiting our spare
                 # capacity
-            max_nodes_to_drain = pool.actual_capacity - len(pool.unschedulable_nodes) - self.spare_count
+            max_nodes_to_drain = schedulable_count - spare_count
+            # the policy bounds the nodes deleted in this loop, and the nodes taken out of
+            # the pool (cordoned or drained) so that the pool doesn't go under its minimum size
+            max_nodes_to_delete, scale_down_policy = self.allowed_scale_down(pool)
+            max_nodes_to_remove = min(max_nodes_to_delete, schedulable_count - policy.min_size)
+            removal_policy = scale_down_policy
+            if schedulable_count - policy.min_size < max_nodes_to_delete:
+                removal_policy = 'min_size'
+            # decision -> [number of nodes, policy]
+            clamped = {}
+
+            node_states = self.get_pool_node_states(pool, pods_by_node, pods_to_schedule)
+            if self.consolidate and not pods_to_schedule:
+                self.consolidate_pool(pool, node_states, pods_by_node,
+                                     min(max_nodes_to_drain, max_nodes_to_remove))
 
             for node in pool.nodes:
-                state = self.get_node_state(
-                    node, pods_by_node.get(node.name, []), pods_to_schedule)
+                state = node_states[node]
+                if self.ledger and self.ledger.is_removing(node):
+                    logger.info("node: %-*s is being deleted" % (75, node))
+                    continue
 
-                if state == ClusterNodeState.UNDER_UTILIZED_DRAINABLE:
-                    if max_nodes_to_drain == 0:
+                if state in (ClusterNodeState.UNDER_UTILIZED_DRAINABLE, ClusterNodeState.CONSOLIDATABLE):
+                    if max_nodes_to_drain <= 0:
+                        state = ClusterNodeState.SPARE_AGENT
+                    elif max_nodes_to_remove <= 0:
+                        clamped.setdefault('drain', [0, removal_policy])[0] += 1
+                        state = ClusterNodeState.SPARE_AGENT
+                elif state == ClusterNodeState.IDLE_SCHEDULABLE:
+                    if max_nodes_to_remove <= 0:
+                        clamped.setdefault('cordon', [0, removal_policy])[0] += 1
+                        state = ClusterNodeState.SPARE_AGENT
+                elif state == ClusterNodeState.IDLE_UNSCHEDULABLE:
+                    if max_nodes_to_delete <= 0:
+                        clamped.setdefault('delete', [0, scale_down_policy])[0] += 1
                         state = ClusterNodeState.SPARE_AGENT
 
                 logger.info("node: %-*s state: %s" % (75, node, state))
 
                 # state machine & why doesnt python have case?
                 if state in (ClusterNodeState.POD_PENDING, ClusterNodeState.BUSY,
-                             ClusterNodeState.SPARE_AGENT, ClusterNodeState.GRACE_PERIOD):
+                             ClusterNodeState.SPARE_AGENT, ClusterNodeState.GRACE_PERIOD,
+                             ClusterNodeState.UNDER_UTILIZED_UNPACKABLE):
                     # do nothing
                     pass
-                elif state == ClusterNodeState.UNDER_UTILIZED_DRAINABLE:
+                elif state in (ClusterNodeState.UNDER_UTILIZED_DRAINABLE, ClusterNodeState.CONSOLIDATABLE):
+                    max_nodes_to_drain -= 1
+                    max_nodes_to_remove -= 1
                     if not self.dry_run:
-                        node.cordon()
-                        notifier = self.notifier or None
-                        node.drain(pods_by_node.get(node.name, []),
-                                   notifier)
-                        max_nodes_to_drain -= 1
+                        drain_queue.append(node)
                     else:
                         logger.info(
                             '[Dry run] Would have drained and cordoned %s', node)
                 elif state == ClusterNodeState.IDLE_SCHEDULABLE:
+                    max_nodes_to_remove -= 1
                     if not self.dry_run:
-                        node.cordon()
+                        cordon_queue.append(node)
                     else:
                         logger.info('[Dry run] Would have cordoned %s', node)
                 elif state == ClusterNodeState.BUSY_UNSCHEDULABLE:
                     # this is duplicated in original scale logic
                     if not self.dry_run:
-                        node.uncordon()
+                        uncordon_queue.append(node)
                     else:
                         logger.info('[Dry run] Would have uncordoned %s', node)
                 elif state == ClusterNodeState.IDLE_UNSCHEDULABLE:
+                    max_nodes_to_delete -= 1
                     if not self.dry_run:
                         delete_queue.append({'node': node, 'pool': pool})
                     else:
@@ -181,6 +323,42 @@ class EngineScaler(Scaler):
                 else:
                     raise Exception("Unhandled state: {}".format(state))
 
+            for decision, (count, policy_name) in clamped.items():
+                self.record_clamp(pool.name, decision, count, 0, policy_name)
+            if self.state and not self.dry_run and any(item['pool'] is pool for item in delete_queue):
+                self.state.record_scale(pool.name, 'down', self.now)
+
+        return {
+            'cordon': cordon_queue,
+            'uncordon': uncordon_queue,
+            'drain': drain_queue,
+            'delete': delete_queue,
+            'pods_by_node': pods_by_node,
+        }
+
+    def apply_maintenance(self, plan):
+        """
+        updates, drains and deletes the nodes as planned by plan_maintenance
+        """
+        cordon_queue = plan['cordon']
+        uncordon_queue = plan['uncordon']
+        drain_queue = plan['drain']
+        delete_queue = plan['delete']
+        pods_by_node = plan['pods_by_node']
+
+        # node updates are independent from each other, so they are sent concurrently
+        cordoned = cordon_nodes(cordon_queue + drain_queue)
+        uncordon_nodes(uncordon_queue)
+        if self.state:
+            for node in drain_queue:
+                if cordoned[node]:
+                    self.state.start_drain(node.name)
+            for node in uncordon_queue:
+                self.state.stop_drain(node.name)
+        notifier = self.notifier or None
+        drain_nodes(dict((node, pods_by_node.get(node.name, []))
+                         for node in drain_queue if cordoned[node]), notifier)
+
         threads = []
         lock = Lock()
         for item in delete_queue:
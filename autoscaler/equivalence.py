@@ -0,0 +1,72 @@
+"""
+module to group identical pending pods, so that the scaling logic handles them once per group
+"""
+import collections
+import json
+
+
+def equivalence_key(pod):
+    """
+    pods with the same key can be scheduled on the same nodes: same requests, node selectors and tolerations
+    """
+    return (tuple(sorted(pod.resources.raw.items())),
+            tuple(sorted(pod.selectors.items())),
+            json.dumps(pod.tolerations, sort_keys=True))
+
+
+class PodClass(object):
+    """
+    pods with the same equivalence key, e.g. the pods of a large Job or Deployment
+    """
+
+    def __init__(self, key, pods):
+        self.key = key
+        self.pods = pods
+
+    @property
+    def representative(self):
+        return self.pods[0]
+
+    @property
+    def resources(self):
+        return self.pods[0].resources
+
+    @property
+    def selectors(self):
+        return self.pods[0].selectors
+
+    def __len__(self):
+        return len(self.pods)
+
+    def __str__(self):
+        return '{} pod(s) like {}'.format(len(self.pods), self.pods[0])
+
+
+def group_pods(pods):
+    """
+    returns the PodClasses of the pods, in the order their first pod was given
+    """
+    classes = collections.OrderedDict()
+    for pod in pods:
+        key = equivalence_key(pod)
+        if key in classes:
+            classes[key].pods.append(pod)
+        else:
+            classes[key] = PodClass(key, [pod])
+    return list(classes.values())
+
+
+def fit_count(free, requests, limit):
+    """
+    returns how many times requests fit in free (dicts of resource -> amount), at most limit
+    """
+    count = limit
+    for k, v in requests.items():
+        if v > 0:
+            count = min(count, int(free.get(k, 0) / v))
+    count = max(count, 0)
+    keys = set(free) | set(requests)
+    # the division can be off by one on floats, the result is checked like the pods were subtracted
+    while count and not all(free.get(k, 0) - requests.get(k, 0) * count >= 0 for k in keys):
+        count -= 1
+    return count
@@ -0,0 +1,80 @@
+"""
+module to tell whether anything the scaling decisions depend on changed since the previous loop
+"""
+import calendar
+import datetime
+import hashlib
+import logging
+
+from autoscaler.kube import KubePodStatus
+
+logger = logging.getLogger(__name__)
+
+
+def _time_bucket(now, bucket):
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return int(calendar.timegm(now.utctimetuple()) // bucket)
+
+
+def cluster_fingerprint(nodes, pods, deployments, now=None, bucket=300):
+    """
+    returns a digest of the state the scaling decisions depend on:
+    - the nodes, their schedulability, labels and readiness
+    - the pending pods with their requests and selectors, and where the other pods run
+    - the deployments in flight
+    - the time, in buckets of bucket seconds, for the decisions depending on the age of nodes and pods
+    """
+    lines = []
+    for node in nodes:
+        lines.append('node {} {} {} {}'.format(
+            node.name, node.unschedulable, node.ready_time, sorted(node.selectors.items())))
+    for pod in pods:
+        if pod.status == KubePodStatus.PENDING and not pod.node_name:
+            lines.append('pending {} {} {}'.format(
+                pod.uid, sorted(pod.resources.raw.items()), sorted(pod.selectors.items())))
+        else:
+            lines.append('pod {} {} {}'.format(pod.uid, pod.status, pod.node_name))
+    lines.sort()
+    lines.append('deployments {} {} {} {}'.format(
+        deployments.is_in_progress(),
+        sorted((deployments.requested_pool_sizes or {}).items()),
+        sorted((name, sorted(indexes)) for name, indexes in deployments.reserved_indexes.items()),
+        sorted(deployments.running_deployments)))
+    lines.append('time {}'.format(_time_bucket(now, bucket)))
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+class LoopSkipper(object):
+    """
+    remembers the fingerprint of the last loop which ran the scaling logic, so that the next
+    loops skip it while nothing changed, and counts the loops skipped
+    """
+
+    def __init__(self, bucket):
+        """
+        bucket - seconds after which a loop runs even if nothing changed, 0 to never skip
+        """
+        self.bucket = bucket
+        self.loops = 0
+        self.skipped = 0
+        self.last_fingerprint = None
+
+    def should_skip(self, nodes, pods, deployments, now=None):
+        """
+        returns (skip, fingerprint), the fingerprint is to be given to done() once the loop ran
+        """
+        self.loops += 1
+        if not self.bucket:
+            return False, None
+        fingerprint = cluster_fingerprint(nodes, pods, deployments, now, self.bucket)
+        if fingerprint == self.last_fingerprint:
+            self.skipped += 1
+            return True, fingerprint
+        return False, fingerprint
+
+    def done(self, fingerprint):
+        self.last_fingerprint = fingerprint
+
+    @property
+    def skip_rate(self):
+        return float(self.skipped) / self.loops if self.loops else 0.0
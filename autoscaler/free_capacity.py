@@ -0,0 +1,103 @@
+"""
+module to index the free capacity of nodes
+"""
+import bisect
+
+
+def _fits(free, requests):
+    for k in set(free) | set(requests):
+        if free.get(k, 0) - requests.get(k, 0) < 0:
+            return False
+    return True
+
+
+class FreeCapacityIndex(object):
+    """
+    index of the free capacity of a set of nodes, ordered by free cpu, so that
+    nodes that can't fit the cpu requested by a pod are never looked at.
+    """
+
+    def __init__(self, nodes=()):
+        self._free = {}
+        self._keys = []
+        # requests known not to fit anywhere, per caller provided group.
+        # free capacity only shrinks when placing pods, so they stay valid
+        # until a node is added or requests are released
+        self._unfit = {}
+        for node in nodes:
+            self.add(node)
+
+    def _key(self, node):
+        return (self._free[node].get('cpu', 0), node.name)
+
+    def _insert(self, node, free):
+        self._free[node] = free
+        bisect.insort(self._keys, (self._key(node), node))
+
+    def _pop(self, node):
+        i = bisect.bisect_left(self._keys, (self._key(node),))
+        while self._keys[i][1] != node:
+            i += 1
+        self._keys.pop(i)
+        return self._free.pop(node)
+
+    def add(self, node, free=None):
+        if free is None:
+            free = dict((k, v - node.used_capacity.raw.get(k, 0))
+                        for k, v in node.capacity.raw.items())
+        self._unfit.clear()
+        self._insert(node, free)
+
+    def remove(self, node):
+        """
+        removes the node from the index, returns its free capacity
+        """
+        return self._pop(node)
+
+    def free(self, node):
+        return self._free[node]
+
+    def __contains__(self, node):
+        return node in self._free
+
+    def __len__(self):
+        return len(self._free)
+
+    def find(self, requests, predicate=None, group=None):
+        """
+        returns the node with the least free cpu that fits the requests, or None.
+        requests - dict of resource -> requested amount
+        predicate - optional function filtering eligible nodes
+        group - optional hashable identifying the predicate, when given requests
+                covering ones which already didn't fit in the same group are
+                rejected without scanning the nodes
+        """
+        unfit = self._unfit.get(group) if group is not None else None
+        if unfit and any(_fits(requests, other) for other in unfit):
+            return None
+        i = bisect.bisect_left(self._keys, ((requests.get('cpu', 0), ''),))
+        for _, node in self._keys[i:]:
+            if (predicate is None or predicate(node)) and _fits(self._free[node], requests):
+                return node
+        if group is not None:
+            self._unfit.setdefault(group, []).append(requests)
+        return None
+
+    def place(self, node, requests):
+        """
+        accounts the requests against the free capacity of the node
+        """
+        free = self._pop(node)
+        for k, v in requests.items():
+            free[k] = free.get(k, 0) - v
+        self._insert(node, free)
+
+    def release(self, node, requests):
+        """
+        gives back requests previously placed on the node
+        """
+        free = self._pop(node)
+        for k, v in requests.items():
+            free[k] = free.get(k, 0) + v
+        self._unfit.clear()
+        self._insert(node, free)
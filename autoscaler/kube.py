@@ -5,6 +5,7 @@ from dateutil.parser import parse as dateutil_parse
 import pykube.exceptions
 
 import autoscaler.utils as utils
+from autoscaler.config import Config
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +20,19 @@ class KubePodStatus(object):
 _CORDON_LABEL = 'openai/cordoned-by-autoscaler'
 
 
+def get_condition_time(obj, condition_type):
+    """
+    returns when the condition of the pod or node became true, None if it isn't
+    """
+    for condition in obj.get('status', {}).get('conditions', []):
+        if condition.get('type') == condition_type and condition.get('status') == 'True':
+            transition_time = condition.get('lastTransitionTime')
+            if isinstance(transition_time, datetime.datetime):
+                return transition_time
+            return dateutil_parse(transition_time) if transition_time else None
+    return None
+
+
 class KubePod(object):
     _DRAIN_GRACE_PERIOD = datetime.timedelta(seconds=60*60)
 
@@ -32,11 +46,17 @@ class KubePod(object):
         self.status = pod.obj['status']['phase']
         self.uid = metadata['uid']
         self.selectors = pod.obj['spec'].get('nodeSelector', {})
+        self.tolerations = pod.obj['spec'].get('tolerations', [])
         self.labels = metadata.get('labels', {})
         self.annotations = metadata.get('annotations', {})
         self.owner = self.labels.get('owner', None)
         self.creation_time = dateutil_parse(metadata['creationTimestamp'])
         self.start_time = dateutil_parse(pod.obj['status']['startTime']) if 'startTime' in pod.obj['status'] else None
+        self.scheduled_time = get_condition_time(pod.obj, 'PodScheduled')
+        self.created_by = json.loads(self.annotations.get('kubernetes.io/created-by', '{}'))
+        # TODO: Fix this kube-proxy issue, see
+        # https://github.com/openai/kubernetes-ec2-autoscaler/issues/23
+        self.is_kube_proxy = 'kube-proxy' in self.name
 
         # TODO: refactor
         requests = list(map(lambda c: c.get('resources', {}).get('requests', {}),
@@ -49,31 +69,61 @@ class KubePod(object):
         self.resources = KubeResource(pods=1, **resource_requests)
 
     def is_mirrored(self):
-        created_by = json.loads(self.annotations.get('kubernetes.io/created-by', '{}'))
-        is_daemonset = created_by.get('reference', {}).get('kind') == 'DaemonSet'
+        is_daemonset = self.created_by.get('reference', {}).get('kind') == 'DaemonSet'
         return is_daemonset or self.annotations.get('kubernetes.io/config.mirror')
 
     def is_replicated(self):
-        created_by = json.loads(self.annotations.get('kubernetes.io/created-by', '{}'))
-        return created_by
+        return self.created_by
 
     def is_critical(self):
         return utils.parse_bool_label(self.labels.get('openai/do-not-drain'))
 
-    def is_in_drain_grace_period(self):
+    def is_in_drain_grace_period(self, now=None):
         """
         determines whether the pod is in a grace period for draining
         this prevents us from draining pods that are too new
         """
-        return not self.start_time or (datetime.datetime.now(self.start_time.tzinfo) - self.start_time) < self._DRAIN_GRACE_PERIOD
+        if not self.start_time:
+            return True
+        now = now or datetime.datetime.now(self.start_time.tzinfo)
+        return (now - self.start_time) < self._DRAIN_GRACE_PERIOD
 
-    def is_drainable(self):
-        return self.is_replicated() and not self.is_critical() and not self.is_in_drain_grace_period()
+    def is_drainable(self, now=None):
+        return self.is_replicated() and not self.is_critical() and not self.is_in_drain_grace_period(now)
 
     def delete(self):
         logger.info('Deleting Pod %s/%s', self.namespace, self.name)
         return self.original.delete()
 
+    def evict(self):
+        """
+        requests the eviction of the pod through the Eviction subresource,
+        which honors PodDisruptionBudgets.
+        returns the HTTP status code: 201 if accepted, 429 if blocked by a PDB, 404 if already gone
+        """
+        logger.info('Evicting Pod %s/%s', self.namespace, self.name)
+        eviction = {
+            'apiVersion': 'policy/v1beta1',
+            'kind': 'Eviction',
+            'metadata': {'name': self.name, 'namespace': self.namespace}
+        }
+        r = self.original.api.post(**self.original.api_kwargs(
+            operation='eviction', data=json.dumps(eviction)))
+        return r.status_code
+
+    def is_terminated(self):
+        """
+        whether the pod is gone, or has been replaced by another pod with the same name
+        """
+        api = self.original.api
+        r = api.get(**self.original.api_kwargs())
+        if r.status_code == 404:
+            return True
+        api.raise_for_status(r)
+        obj = r.json()
+        return obj['metadata']['uid'] != self.uid or \
+            obj['status']['phase'] in (KubePodStatus.SUCCEEDED, KubePodStatus.FAILED)
+
     def __hash__(self):
         return hash(self.uid)
 
@@ -101,9 +151,12 @@ class KubeNode(object):
 
         # self.capacity = KubeResource(**node.obj['status']['capacity'])       
         self.capacity = None
+        allocatable = node.obj.get('status', {}).get('allocatable')
+        self.allocatable = KubeResource(**allocatable) if allocatable else None
         self.used_capacity = KubeResource()
         self.unschedulable = node.obj['spec'].get('unschedulable', False)
         self.creation_time = dateutil_parse(metadata['creationTimestamp'])
+        self.ready_time = get_condition_time(node.obj, 'Ready')
         self.instance_index = utils.get_instance_index(node)
 
     def _get_instance_data(self):
@@ -122,13 +175,21 @@ class KubeNode(object):
         return ('', None)
 
     def drain(self, pods, notifier=None):
-        for pod in pods:
-            if pod.is_drainable():
-                pod.delete()
+        from autoscaler.drain import drain_nodes
+        return drain_nodes({self: pods}, notifier)[self]
 
-        logger.info("drained %s", self)
-        if notifier:
-            notifier.notify_drained_node(self, pods)
+    def _patch(self, patch):
+        """
+        applies a merge patch to the node in a single request, without reloading it first
+        """
+        api = self.original.api
+        r = api.patch(**self.original.api_kwargs(
+            headers={'Content-Type': 'application/merge-patch+json'},
+            data=json.dumps(patch)))
+        api.raise_for_status(r)
+        self.original.set_obj(r.json())
+        self.selectors = self.original.obj['metadata'].get('labels', {})
+        self.unschedulable = self.original.obj['spec'].get('unschedulable', False)
 
     def uncordon(self):
         if not utils.parse_bool_label(self.selectors.get(_CORDON_LABEL)):
@@ -136,9 +197,10 @@ class KubeNode(object):
             return False
 
         try:
-            self.original.reload()
-            self.original.obj['spec']['unschedulable'] = False
-            self.original.update()
+            self._patch({
+                'spec': {'unschedulable': False},
+                'metadata': {'labels': {_CORDON_LABEL: None}}
+            })
             logger.info("uncordoned %s", self)
             return True
         except pykube.exceptions.HTTPError as ex:
@@ -147,10 +209,10 @@ class KubeNode(object):
 
     def cordon(self):
         try:
-            self.original.reload()
-            self.original.obj['spec']['unschedulable'] = True
-            self.original.obj['metadata']['labels'][_CORDON_LABEL] = 'true'
-            self.original.update()
+            self._patch({
+                'spec': {'unschedulable': True},
+                'metadata': {'labels': {_CORDON_LABEL: 'true'}}
+            })
             logger.info("cordoned %s", self)
             return True
         except pykube.exceptions.HTTPError as ex:
@@ -194,6 +256,20 @@ class KubeNode(object):
         return "{}".format(self.name)
 
 
+def cordon_nodes(nodes, max_workers=Config.KUBE_API_CONCURRENCY):
+    """
+    cordons the nodes concurrently, returns a dict of node -> success
+    """
+    return utils.run_concurrently(lambda node: node.cordon(), nodes, max_workers)
+
+
+def uncordon_nodes(nodes, max_workers=Config.KUBE_API_CONCURRENCY):
+    """
+    uncordons the nodes concurrently, returns a dict of node -> success
+    """
+    return utils.run_concurrently(lambda node: node.uncordon(), nodes, max_workers)
+
+
 class KubeResource(object):
 
     def __init__(self, **kwargs):
@@ -0,0 +1,88 @@
+"""
+module to match pod node selectors against nodes and agent pools
+"""
+
+# labels which are specific to a node, and so never shared by a whole pool
+_NODE_SPECIFIC_LABELS = ('kubernetes.io/hostname', 'openai/cordoned-by-autoscaler')
+# labels set by the kubelet whose value can't be known before a node of the pool exists
+_UNKNOWN_LABELS = ('kubernetes.io/hostname', 'failure-domain.beta.kubernetes.io/region',
+                   'failure-domain.beta.kubernetes.io/zone')
+
+
+class LabelIndex(object):
+    """
+    inverted index of label (key, value) -> nodes and pools carrying this label
+    """
+
+    def __init__(self, nodes, pools):
+        self.nodes = set()
+        self.pool_names = set()
+        self._nodes_by_label = {}
+        self._pools_by_label = {}
+        # label key -> pools whose nodes carry the label with a value which isn't known
+        self._pools_by_unknown_key = {}
+        for node in nodes:
+            self.nodes.add(node)
+            for label in node.selectors.items():
+                self._nodes_by_label.setdefault(label, set()).add(node)
+        for pool in pools:
+            self.pool_names.add(pool.name)
+            for label in pool.labels.items():
+                self._pools_by_label.setdefault(label, set()).add(pool.name)
+            for key in get_pool_unknown_labels(pool):
+                self._pools_by_unknown_key.setdefault(key, set()).add(pool.name)
+
+    def _match(self, selectors, index, everything, unknown_keys=None):
+        if not selectors:
+            return everything
+        unknown_keys = unknown_keys or {}
+        sets = [index.get(label, set()) | unknown_keys.get(label[0], set()) for label in selectors.items()]
+        sets.sort(key=len)
+        return set.intersection(*sets)
+
+    def matching_nodes(self, selectors):
+        """
+        returns the set of nodes matching all the selectors
+        """
+        return self._match(selectors, self._nodes_by_label, self.nodes)
+
+    def matching_pools(self, selectors):
+        """
+        returns the names of the pools whose nodes would match all the selectors,
+        or might match them when the value of a label is unknown
+        """
+        return self._match(selectors, self._pools_by_label, self.pool_names, self._pools_by_unknown_key)
+
+
+def get_pool_labels(pool):
+    """
+    returns the labels carried by every node of the pool: the ones set by acs-engine,
+    refined with the labels shared by the current nodes of the pool
+    """
+    labels = {
+        'agentpool': pool.name,
+        'kubernetes.io/role': 'agent',
+        'beta.kubernetes.io/os': 'linux',
+        'beta.kubernetes.io/arch': 'amd64',
+        'beta.kubernetes.io/instance-type': pool.instance_type,
+    }
+    if pool.location:
+        labels['failure-domain.beta.kubernetes.io/region'] = pool.location
+    if pool.nodes:
+        shared = dict(pool.nodes[0].selectors)
+        for node in pool.nodes[1:]:
+            shared = dict((k, v) for k, v in shared.items() if node.selectors.get(k) == v)
+        for k in _NODE_SPECIFIC_LABELS:
+            shared.pop(k, None)
+        labels.update(shared)
+    return labels
+
+
+def get_pool_unknown_labels(pool):
+    """
+    returns the keys of the labels the nodes of an empty pool will carry, with values which
+    can't be known yet (e.g. the hostname or the zone of the nodes)
+    """
+    if pool.nodes:
+        return set()
+    return set(_UNKNOWN_LABELS) - set(get_pool_labels(pool))
@@ -0,0 +1,111 @@
+"""
+module to account for the capacity being added to and removed from the pools
+"""
+import datetime
+import logging
+import threading
+
+import autoscaler.utils as utils
+from autoscaler.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class CapacityLedger(object):
+    """
+    tracks, per pool, the nodes requested from ARM which haven't registered yet, and the nodes
+    being deleted which are still listed, so that the loops don't count them as missing or
+    available capacity. Nodes registered or gone settle their entry, and entries expire after
+    ttl seconds (e.g. a VM which never joined the cluster).
+    """
+
+    def __init__(self, ttl=Config.CAPACITY_LEDGER_TTL):
+        self.ttl = ttl
+        # pool name -> node index -> expiry time
+        self.adding = {}
+        # pool name -> node name -> expiry time
+        self.removing = {}
+        self._lock = threading.Lock()
+
+    def _expiry(self, now):
+        return (now or _now()) + datetime.timedelta(seconds=self.ttl)
+
+    def request(self, pool_name, indexes, now=None):
+        """
+        indexes - indexes of the nodes requested for the pool
+        """
+        with self._lock:
+            expires = self._expiry(now)
+            for index in indexes:
+                self.adding.setdefault(pool_name, {})[index] = expires
+
+    def cancel(self, pool_name, indexes):
+        """
+        indexes - indexes of nodes requested by a deployment which failed, they won't register
+        """
+        with self._lock:
+            entries = self.adding.get(pool_name, {})
+            for index in indexes:
+                entries.pop(index, None)
+            if not entries:
+                self.adding.pop(pool_name, None)
+
+    def start_removal(self, pool_name, node_name, now=None):
+        with self._lock:
+            self.removing.setdefault(pool_name, {})[node_name] = self._expiry(now)
+
+    def settle(self, nodes, now=None):
+        """
+        nodes - agents listed by the loop.
+        closes the entries of the nodes which registered or disappeared, and the expired ones
+        """
+        now = now or _now()
+        registered = set()
+        names = set()
+        for node in nodes:
+            registered.add((utils.get_pool_name(node), node.index))
+            names.add(node.name)
+        with self._lock:
+            for pool_name, entries in self.adding.items():
+                for index, expires in list(entries.items()):
+                    if (pool_name, index) in registered:
+                        del entries[index]
+                    elif expires <= now:
+                        logger.warn('Node {} of pool {} was requested but never registered'.format(
+                            index, pool_name))
+                        del entries[index]
+            for pool_name, entries in self.removing.items():
+                for name, expires in list(entries.items()):
+                    if name not in names:
+                        del entries[name]
+                    elif expires <= now:
+                        logger.warn('Node {} is still listed long after its deletion'.format(name))
+                        del entries[name]
+            self.adding = dict((k, v) for k, v in self.adding.items() if v)
+            self.removing = dict((k, v) for k, v in self.removing.items() if v)
+
+    def requested_indexes(self, pool_name):
+        with self._lock:
+            return set(self.adding.get(pool_name, ()))
+
+    def removing_nodes(self, pool_name):
+        with self._lock:
+            return set(self.removing.get(pool_name, ()))
+
+    def is_removing(self, node):
+        with self._lock:
+            return node.name in self.removing.get(utils.get_pool_name(node), ())
+
+    def summary(self):
+        """
+        returns a map of pool name -> number of nodes being added and removed
+        """
+        with self._lock:
+            pools = set(self.adding) | set(self.removing)
+            return dict((pool, {'adding': len(self.adding.get(pool, ())),
+                                'removing': len(self.removing.get(pool, ()))})
+                        for pool in sorted(pools))
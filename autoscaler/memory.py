@@ -0,0 +1,165 @@
+"""
+module to watch the memory of the autoscaler, to find what grows over time
+"""
+import collections
+import datetime
+import gc
+import json
+import logging
+import resource
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from autoscaler.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss():
+    """
+    returns the current resident set size in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # peak RSS is the best we can get without procfs, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_objects_by_type():
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+
+class MemoryWatchdog(object):
+    """
+    periodically records the allocations which grew the most since the previous
+    check (tracemalloc) and the number of live objects by type, and compares the
+    RSS with a memory budget.
+    The last report is logged, and served as JSON on localhost when a port is given.
+    Without tracing, only the RSS is compared with the budget: tracemalloc slows down
+    every allocation of the process.
+    """
+
+    def __init__(self, budget=None, interval=Config.MEMORY_WATCH_INTERVAL,
+                 top=Config.MEMORY_WATCH_TOP, port=None, trace=True):
+        """
+        budget - maximum RSS in bytes, None for no budget
+        trace - whether to trace the allocations and write the reports
+        interval - minimum time in seconds between two reports
+        top - number of allocation sites and types reported
+        port - localhost port to serve the last report on (0 for any free port), None to only log it
+        """
+        self.budget = budget
+        self.interval = interval
+        self.top = top
+        self.port = port
+        self.trace = trace
+        self.report = None
+        self._last_check = None
+        self._snapshot = None
+        self._counts = None
+        self._server = None
+
+    def start(self):
+        if not self.trace:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot()
+        self._counts = count_objects_by_type()
+        self._last_check = time.time()
+        if self.port is not None:
+            self._serve()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self.trace:
+            tracemalloc.stop()
+
+    def check(self, force=False):
+        """
+        writes a new report if the interval elapsed since the previous one.
+        returns False if the memory budget is exceeded, True otherwise
+        """
+        if self.trace and (force or self._last_check is None or time.time() - self._last_check >= self.interval):
+            self.report = self._build_report()
+            self._last_check = time.time()
+            self._log_report(self.report)
+
+        rss = get_rss()
+        if self.budget and rss > self.budget:
+            logger.warn('Memory budget exceeded: RSS is {:.1f}MB, budget is {:.1f}MB'.format(
+                rss / 2**20, self.budget / 2**20))
+            return False
+        return True
+
+    def _build_report(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        counts = count_objects_by_type()
+        report = {
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'rss': get_rss(),
+            'budget': self.budget,
+            'traced': tracemalloc.get_traced_memory()[0],
+            'top_allocations': [
+                {
+                    'location': str(stat.traceback[0]),
+                    'size': stat.size,
+                    'size_diff': stat.size_diff,
+                    'count_diff': stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self.top]
+            ],
+            'top_types': [
+                {'type': name, 'count': count, 'count_diff': count - self._counts.get(name, 0)}
+                for name, count in counts.most_common(self.top)
+            ],
+        }
+        self._snapshot = snapshot
+        self._counts = counts
+        return report
+
+    def _log_report(self, report):
+        logger.info('Memory: RSS {:.1f}MB, traced {:.1f}MB'.format(
+            report['rss'] / 2**20, report['traced'] / 2**20))
+        for stat in report['top_allocations']:
+            logger.info('Memory growth: {size_diff:+} B ({count_diff:+} blocks) at {location}'.format(**stat))
+        for stat in report['top_types']:
+            logger.debug('Objects: {type}: {count} ({count_diff:+})'.format(**stat))
+
+    def _serve(self):
+        watchdog = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/memory':
+                    self.send_error(404)
+                    return
+                body = json.dumps(watchdog.report or {}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = HTTPServer(('127.0.0.1', self.port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving memory reports on http://127.0.0.1:{}/memory'.format(
+            self._server.server_address[1]))
@@ -0,0 +1,50 @@
+"""
+module to load the list of clusters driven by a single autoscaler
+"""
+from autoscaler.utils import get_file_json
+
+# options which can be set per cluster, the ones given on the command line are the defaults
+CLUSTER_OPTIONS = (
+    'resource_group', 'acs_deployment', 'kubeconfig', 'client_private_key', 'ca_private_key',
+    'spare_agents', 'idle_threshold', 'over_provision', 'ignore_pools', 'scale_up',
+    'maintainance', 'consolidate', 'dry_run', 'record_file', 'state_file',
+    'policy_file',
+)
+
+
+def load_targets(path, defaults):
+    """
+    loads a JSON file of the form
+    {"clusters": [{"name": "eu", "resource_group": "k8s-eu", "kubeconfig": "/etc/kube/eu", ...}, ...]}
+    and returns a list of (name, cluster options, sleep), with the defaults filled in.
+    name defaults to the resource group, sleep to the one of the defaults.
+    """
+    config = get_file_json(path)
+    targets = []
+    names = set()
+    files = set()
+    for i, entry in enumerate(config.get('clusters', [])):
+        unknown = set(entry) - set(CLUSTER_OPTIONS) - set(('name', 'sleep'))
+        if unknown:
+            raise ValueError('Unknown options for cluster #{}: {}'.format(i, ', '.join(sorted(unknown))))
+        options = dict((k, v) for k, v in defaults.items() if k in CLUSTER_OPTIONS)
+        options.update((k, v) for k, v in entry.items() if k in CLUSTER_OPTIONS)
+        if not options.get('resource_group'):
+            raise ValueError('Missing resource_group for cluster #{}'.format(i))
+        if not options.get('kubeconfig'):
+            # the service account only gives access to the cluster the autoscaler runs in
+            raise ValueError('Missing kubeconfig for cluster #{}'.format(i))
+        name = entry.get('name', options['resource_group'])
+        if name in names:
+            raise ValueError('Duplicated cluster name: {}'.format(name))
+        names.add(name)
+        for option in ('record_file', 'state_file'):
+            if not options.get(option):
+                continue
+            if options[option] in files:
+                raise ValueError('Cluster {} shares its {} with another cluster'.format(name, option))
+            files.add(options[option])
+        targets.append((name, options, entry.get('sleep', defaults.get('sleep'))))
+    if not targets:
+        raise ValueError('No cluster listed in {}'.format(path))
+    return targets
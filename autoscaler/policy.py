@@ -0,0 +1,130 @@
+"""
+module to load the scaling policy of each pool
+"""
+import logging
+
+from autoscaler.utils import get_file_json
+
+logger = logging.getLogger(__name__)
+
+POLICY_OPTIONS = (
+    'min_size', 'max_size', 'max_step_up', 'max_step_down',
+    'scale_up_cooldown', 'scale_down_cooldown', 'spare_agents',
+)
+
+
+class PoolPolicy(object):
+    """
+    bounds the size of a pool and how fast it changes:
+    min_size, max_size - number of agents the pool is kept within. A pool under min_size is
+                         brought up to it at once, whatever the cooldown and max_step_up
+    max_step_up, max_step_down - maximum number of agents added or removed in a loop, None for no limit
+    scale_up_cooldown - seconds after a scale-up before the pool is scaled up again
+    scale_down_cooldown - seconds after a scale-up or a scale-down before the pool is scaled down
+    spare_agents - idle agents kept in the pool, None for the --spare-agents option
+    """
+
+    def __init__(self, min_size=0, max_size=100, max_step_up=None, max_step_down=None,
+                 scale_up_cooldown=0, scale_down_cooldown=0, spare_agents=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_step_up = max_step_up
+        self.max_step_down = max_step_down
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.spare_agents = spare_agents
+
+    def to_dict(self):
+        return dict((option, getattr(self, option)) for option in POLICY_OPTIONS)
+
+    def clamp_scale_up(self, current, desired, last_scale_up=None, now=None):
+        """
+        returns (size, reason): the size the pool can be set to instead of desired,
+        and the name of the policy which changed it, None if it was allowed.
+        Topping the pool up to min_size deliberately bypasses the cooldown and max_step_up,
+        they only limit the agents added above it
+        """
+        if desired < self.min_size:
+            return self.min_size, 'min_size'
+        if desired > self.max_size:
+            size, reason = self.max_size, 'max_size'
+        else:
+            size, reason = desired, None
+        if size <= current:
+            return size, reason
+        if current >= self.min_size and last_scale_up and now and \
+                (now - last_scale_up).total_seconds() < self.scale_up_cooldown:
+            return current, 'scale_up_cooldown'
+        if self.max_step_up is not None and size - max(current, self.min_size) > self.max_step_up:
+            return max(current, self.min_size) + self.max_step_up, 'max_step_up'
+        return size, reason
+
+    def allowed_scale_down(self, current, last_scale_up=None, last_scale_down=None, now=None):
+        """
+        returns (count, reason): the number of agents the pool can lose in this loop,
+        and the name of the policy which bounds it
+        """
+        count, reason = max(0, current - self.min_size), 'min_size'
+        if now:
+            for last in (last_scale_up, last_scale_down):
+                if last and (now - last).total_seconds() < self.scale_down_cooldown:
+                    return 0, 'scale_down_cooldown'
+        if self.max_step_down is not None and self.max_step_down < count:
+            count, reason = self.max_step_down, 'max_step_down'
+        return count, reason
+
+
+class PolicySet(object):
+    """
+    policies of the pools, the default policy applies to the pools which don't have one
+    """
+
+    def __init__(self, default=None, pools=None):
+        self.default = default or PoolPolicy()
+        self.pools = pools or {}
+
+    def get(self, pool_name):
+        return self.pools.get(pool_name, self.default)
+
+    def to_dict(self):
+        return {
+            'default': self.default.to_dict(),
+            'pools': dict((name, policy.to_dict()) for name, policy in self.pools.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        data - {"default": {"max_step_up": 10}, "pools": {"gpupool": {"max_size": 4}, ...}}
+        pool policies inherit the options of the default one.
+        """
+        unknown = set(data) - set(('default', 'pools'))
+        if unknown:
+            raise ValueError('Unknown policy sections: {}'.format(', '.join(sorted(unknown))))
+        defaults = data.get('default', {})
+        default = _create_policy(defaults, {}, 'the default policy')
+        pools = dict((name, _create_policy(options, defaults, 'pool {}'.format(name)))
+                     for name, options in data.get('pools', {}).items())
+        return cls(default, pools)
+
+
+def _create_policy(options, defaults, name):
+    unknown = set(options) - set(POLICY_OPTIONS)
+    if unknown:
+        raise ValueError('Unknown policy options for {}: {}'.format(name, ', '.join(sorted(unknown))))
+    values = dict(defaults)
+    values.update(options)
+    policy = PoolPolicy(**values)
+    if policy.min_size > policy.max_size:
+        raise ValueError('min_size is greater than max_size for {}'.format(name))
+    return policy
+
+
+def load_policies(path):
+    """
+    loads a JSON file of the form
+    {"default": {"max_step_up": 10}, "pools": {"gpupool": {"max_size": 4, "scale_up_cooldown": 600}, ...}}
+    """
+    policies = PolicySet.from_dict(get_file_json(path))
+    logger.info('Loaded the policies of {} pools from {}'.format(len(policies.pools), path))
+    return policies
@@ -0,0 +1,172 @@
+"""
+module to render the templates of the likely next scale-outs ahead of time
+"""
+import logging
+import threading
+import time
+
+from autoscaler.config import Config
+from autoscaler.template_processing import render_scale_out, set_count_parameters
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolSnapshot(object):
+    """
+    what rendering needs from an AgentPool, copied so that the worker doesn't share it with the loop
+    """
+
+    def __init__(self, pool):
+        self.name = pool.name
+        self.actual_capacity = pool.actual_capacity
+        self.indexes = set(pool.indexes)
+        self.reserved_indexes = set(pool.reserved_indexes)
+
+
+def _membership(pools):
+    return tuple(sorted((pool.name, pool.actual_capacity, tuple(sorted(pool.indexes)),
+                         tuple(sorted(pool.reserved_indexes))) for pool in pools))
+
+
+def _sizes_key(new_pool_sizes):
+    return tuple(sorted(new_pool_sizes.items()))
+
+
+class TemplatePrerenderer(object):
+    """
+    renders the deployments of the likely next scale-outs (a few more agents in one of the
+    scalable pools) in a background thread, while the loop sleeps, so that a scale-up submits
+    an already built template.
+    Renders depend on the indexes of the nodes of every pool: when the pools change, the
+    cache is dropped and the next idle time renders them again.
+    """
+
+    def __init__(self, template, parameters, steps=Config.PRERENDER_STEPS):
+        self.template = template
+        self.parameters = parameters
+        self.steps = steps
+        self.hits = 0
+        self.misses = 0
+        self._membership = None
+        # pool sizes key -> (template, parameters)
+        self._cache = {}
+        self._job = None
+        self._busy = False
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def get(self, pools, new_pool_sizes):
+        """
+        returns the (template, parameters) rendered for scaling pools to new_pool_sizes,
+        None when they weren't rendered for the current pools
+        """
+        with self._lock:
+            rendered = None
+            if self._membership == _membership(pools):
+                rendered = self._cache.pop(_sizes_key(new_pool_sizes), None)
+            if rendered is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rendered
+
+    def get_jobs(self, pools, scalable_pools):
+        """
+        returns the pool sizes to render: each scalable pool grown by each step, up to its maximum size
+        """
+        current = dict((pool.name, pool.actual_capacity) for pool in pools)
+        jobs = []
+        for pool in scalable_pools:
+            sizes = sorted(set(min(pool.actual_capacity + step, pool.max_size) for step in self.steps))
+            for size in sizes:
+                if size > pool.actual_capacity:
+                    new_pool_sizes = dict(current)
+                    new_pool_sizes[pool.name] = size
+                    jobs.append(new_pool_sizes)
+        return jobs
+
+    def schedule(self, pools, scalable_pools):
+        """
+        renders the next scale-outs of the pools in the background, replacing the renders
+        which are still pending
+        """
+        membership = _membership(pools)
+        job = (membership, [_PoolSnapshot(pool) for pool in pools],
+               set(pool.name for pool in scalable_pools), dict(self.parameters),
+               self.get_jobs(pools, scalable_pools))
+        with self._lock:
+            if self._membership != membership:
+                if self._cache:
+                    logger.debug('Pools changed, dropping {} pre-rendered templates'.format(len(self._cache)))
+                self._membership = membership
+                self._cache = {}
+            self._job = job
+            self._lock.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='prerender')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._job is None:
+                    self._lock.wait()
+                job, self._job = self._job, None
+                self._busy = True
+            try:
+                self.render(*job)
+            except Exception as e:
+                logger.error('Pre-rendering failed: {}'.format(e), exc_info=True)
+            finally:
+                with self._lock:
+                    self._busy = False
+                    self._lock.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        blocks until the scheduled renders are done, returns False on timeout
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: self._job is None and not self._busy, timeout)
+
+    def _is_current(self, membership):
+        with self._lock:
+            return self._membership == membership and self._job is None
+
+    def render(self, membership, pools, scalable_names, parameters, jobs):
+        """
+        renders the jobs one by one, giving up as soon as the pools changed or another
+        schedule() replaced them
+        """
+        start = time.time()
+        rendered = 0
+        for new_pool_sizes in jobs:
+            if not self._is_current(membership):
+                return
+            key = _sizes_key(new_pool_sizes)
+            with self._lock:
+                if key in self._cache:
+                    continue
+            job_parameters = dict(parameters)
+            set_count_parameters(job_parameters, [p for p in pools if p.name in scalable_names], new_pool_sizes)
+            try:
+                result = render_scale_out(self.template, job_parameters, pools, new_pool_sizes)
+            except ValueError as e:
+                logger.warn('Failed to pre-render the template for {}: {}'.format(new_pool_sizes, e))
+                continue
+            with self._lock:
+                if self._membership != membership:
+                    return
+                self._cache[key] = result
+            rendered += 1
+        if rendered:
+            logger.info('Pre-rendered {} templates in {:.2f}s'.format(rendered, time.time() - start))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'prerender_cached': len(self._cache),
+                'prerender_hits': self.hits,
+                'prerender_misses': self.misses,
+            }
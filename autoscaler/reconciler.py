@@ -0,0 +1,113 @@
+"""
+module to find and clean up the NICs and managed disks left behind by VM deletions
+"""
+import logging
+import re
+import time
+
+import autoscaler.azure_api as azure_api
+import autoscaler.utils as utils
+from autoscaler.config import Config
+
+logger = logging.getLogger(__name__)
+
+_NIC_REGEX = re.compile(r'^(?P<prefix>[^-]+-[^-]+-[^-]+)-nic-(?P<index>\d+)$')
+_DISK_REGEX = re.compile(r'^(?P<vm>[^-]+-[^-]+-[^-]+-\d+)[-_]')
+
+
+def find_orphans(vm_names, nic_names, disks, pool_names):
+    """
+    returns (orphaned NIC names, orphaned managed disk names): the ones named after an agent VM
+    of one of the pools which doesn't exist anymore. Disks attached to a VM are never orphans.
+    vm_names - names of the VMs of the resource group
+    nic_names - names of the NICs of the resource group
+    disks - managed disks of the resource group
+    pool_names - names of the pools whose resources may be cleaned up
+    """
+    vm_names = set(vm_names)
+
+    def is_orphaned_vm(vm_name):
+        return vm_name not in vm_names and vm_name.split('-')[1] in pool_names
+
+    nics = []
+    for name in nic_names:
+        m = _NIC_REGEX.match(name)
+        if m and is_orphaned_vm('{}-{}'.format(m.group('prefix'), m.group('index'))):
+            nics.append(name)
+
+    orphaned_disks = []
+    for disk in disks:
+        m = _DISK_REGEX.match(disk.name)
+        if m and not disk.managed_by and is_orphaned_vm(m.group('vm')):
+            orphaned_disks.append(disk.name)
+    return nics, orphaned_disks
+
+
+class Reconciler(object):
+    """
+    lists the VMs, NICs and disks of the resource group in bulk, and deletes the NICs
+    and disks whose VM is gone, concurrently.
+    Resources have to be found orphaned by two consecutive reconciliations to be deleted,
+    so that the ones of a VM being created are left alone.
+    """
+
+    def __init__(self, resource_group, interval=Config.RECONCILE_INTERVAL,
+                 max_workers=Config.ARM_CONCURRENCY, dry_run=False):
+        self.resource_group = resource_group
+        self.interval = interval
+        self.max_workers = max_workers
+        self.dry_run = dry_run
+        self._last_run = None
+        self._suspects = set()
+
+    def is_due(self):
+        return self._last_run is None or time.time() - self._last_run >= self.interval
+
+    def reconcile(self, virtual_machines, nodes, pool_names):
+        """
+        virtual_machines - VMs of the resource group, as listed in bulk
+        nodes - KubeNodes of the cluster
+        pool_names - names of the pools whose resources may be cleaned up
+        returns the names of the deleted resources
+        """
+        self._last_run = time.time()
+        vm_names = [vm.name for vm in virtual_machines]
+        listed = utils.run_concurrently(lambda f: f(self.resource_group),
+                                        [azure_api.list_network_interfaces, azure_api.list_managed_disks],
+                                        2)
+        if listed[azure_api.list_network_interfaces] is False or listed[azure_api.list_managed_disks] is False:
+            logger.warn('Failed to list the resources of {}, skipping reconciliation'.format(self.resource_group))
+            return []
+
+        node_names = set(n.name for n in nodes)
+        unregistered = [name for name in vm_names
+                        if name not in node_names and name.split('-')[1] in pool_names]
+        if unregistered:
+            logger.info('VMs without node: {}'.format(', '.join(sorted(unregistered))))
+
+        nics, disks = find_orphans(vm_names, listed[azure_api.list_network_interfaces],
+                                   listed[azure_api.list_managed_disks], pool_names)
+        orphans = [('nic', name) for name in nics] + [('disk', name) for name in disks]
+        confirmed = [o for o in orphans if o in self._suspects]
+        self._suspects = set(orphans)
+        logger.info('Orphaned resources: {} NIC(s), {} disk(s), {} confirmed'.format(
+            len(nics), len(disks), len(confirmed)))
+        if not confirmed:
+            return []
+        if self.dry_run:
+            for kind, name in confirmed:
+                logger.info('[Dry run] Would have deleted orphaned {} {}'.format(kind, name))
+            return []
+
+        results = utils.run_concurrently(self._delete, confirmed, self.max_workers)
+        deleted = [name for (kind, name), result in results.items() if result]
+        self._suspects -= set(o for o, result in results.items() if result)
+        return sorted(deleted)
+
+    def _delete(self, orphan):
+        kind, name = orphan
+        if kind == 'nic':
+            azure_api.delete_network_interface(self.resource_group, name)
+        else:
+            azure_api.delete_managed_disk(self.resource_group, name)
+        return True
@@ -0,0 +1,138 @@
+"""
+module to record the inputs of each scaling loop, so that scaling decisions can be replayed offline
+"""
+import datetime
+import glob
+import json
+import logging
+import logging.handlers
+
+from autoscaler.config import Config
+
+logger = logging.getLogger(__name__)
+
+# parameters filled from the autoscaler secrets, never written to the record file
+_SECRET_PARAMETERS = ('servicePrincipalClientId', 'servicePrincipalClientSecret')
+REDACTED = '<redacted>'
+
+
+def _pick(obj, keys):
+    return dict((k, obj[k]) for k in keys if k in obj)
+
+
+def _pick_conditions(status, types):
+    """
+    keeps the conditions of the given types, with the fields telling when they became true
+    """
+    return [_pick(condition, ('type', 'status', 'lastTransitionTime'))
+            for condition in status.get('conditions', []) if condition.get('type') in types]
+
+
+def compact_node(obj):
+    """
+    keeps only the fields of a kubernetes node used by the autoscaler
+    """
+    status = _pick(obj.get('status', {}), ('capacity', 'allocatable'))
+    status['conditions'] = _pick_conditions(obj.get('status', {}), ('Ready',))
+    return {
+        'metadata': _pick(obj['metadata'], ('name', 'labels', 'creationTimestamp')),
+        'spec': _pick(obj.get('spec', {}), ('unschedulable',)),
+        'status': status,
+    }
+
+
+def compact_pod(obj):
+    """
+    keeps only the fields of a kubernetes pod used by the autoscaler
+    """
+    metadata = obj['metadata']
+    annotations = _pick(metadata.get('annotations', {}),
+                        ('kubernetes.io/created-by', 'kubernetes.io/config.mirror'))
+    metadata = _pick(metadata, ('name', 'namespace', 'uid', 'labels', 'creationTimestamp'))
+    metadata['annotations'] = annotations
+    spec = _pick(obj['spec'], ('nodeName', 'nodeSelector', 'tolerations'))
+    spec['containers'] = [{'resources': _pick(c.get('resources', {}), ('requests',))}
+                          for c in obj['spec']['containers']]
+    status = _pick(obj['status'], ('phase', 'startTime'))
+    status['conditions'] = _pick_conditions(obj['status'], ('PodScheduled', 'Ready'))
+    return {
+        'metadata': metadata,
+        'spec': spec,
+        'status': status,
+    }
+
+
+def redact_parameters(parameters):
+    redacted = {}
+    for name, parameter in parameters.items():
+        if name in _SECRET_PARAMETERS or name.endswith('PrivateKey') or name.startswith('etcdPeerPrivateKey'):
+            parameter = {'value': REDACTED}
+        redacted[name] = parameter
+    return redacted
+
+
+class LoopRecorder(object):
+    """
+    appends one compact JSON snapshot per loop to a size-rotated file
+    (path, path.1, ... path.<backup_count>).
+    The ARM template doesn't change between loops, it is written once to <path>.template.json
+    """
+
+    def __init__(self, path, max_bytes=Config.RECORD_MAX_BYTES, backup_count=Config.RECORD_BACKUP_COUNT):
+        self.path = path
+        self._logger = logging.getLogger('{}.{}'.format(__name__, path))
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+
+    def record_template(self, template):
+        with open(template_path(self.path), 'w') as f:
+            json.dump(template, f, separators=(',', ':'))
+
+    def record(self, nodes, pods, arm_parameters, deployments, config, now=None, state=None):
+        """
+        nodes, pods - raw kubernetes objects (dicts)
+        deployments - Deployments object tracking the in-flight deployment
+        config - options of the cluster the loop ran with
+        state - optional ControllerState at the beginning of the loop
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        snapshot = {
+            'time': now.isoformat(),
+            'config': config,
+            'nodes': [compact_node(n) for n in nodes],
+            'pods': [compact_pod(p) for p in pods],
+            'arm_parameters': redact_parameters(arm_parameters),
+            'deployments': {
+                'in_progress': deployments.is_in_progress(),
+                'requested_pool_sizes': deployments.requested_pool_sizes,
+            },
+        }
+        if state:
+            snapshot['state'] = state.to_dict()
+        try:
+            self._logger.info(json.dumps(snapshot, separators=(',', ':')))
+        except Exception as e:
+            # recording must never break the scaling loop
+            logger.warn('Failed to record loop snapshot: {}'.format(e))
+
+
+def template_path(path):
+    return path + '.template.json'
+
+
+def read_snapshots(path):
+    """
+    yields the snapshots recorded in path and its rotated files, oldest first
+    """
+    rotated = sorted(glob.glob(path + '.[0-9]*'),
+                     key=lambda p: int(p.rsplit('.', 1)[1]), reverse=True)
+    for file_path in rotated + [path]:
+        with open(file_path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
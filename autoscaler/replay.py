@@ -0,0 +1,130 @@
+"""
+module to replay recorded loop snapshots offline, with the Azure and Kubernetes calls stubbed
+"""
+import contextlib
+import copy
+import logging
+
+import pykube
+from dateutil.parser import parse as dateutil_parse
+
+import autoscaler.agent_pool as agent_pool
+import autoscaler.engine_scaler as engine_scaler
+from autoscaler.cluster import Cluster
+from autoscaler.policy import PolicySet
+from autoscaler.state import ControllerState
+
+logger = logging.getLogger(__name__)
+
+
+class _InFlightDeployment(object):
+    """
+    stands for a deployment which was still running when the snapshot was recorded
+    """
+
+    def done(self):
+        return False
+
+
+@contextlib.contextmanager
+def stubbed_calls(actions):
+    """
+    replaces the calls changing the cluster by stubs appending (action, details) to actions,
+    calls on empty batches of nodes are not recorded
+    """
+    def record_nodes(action, nodes):
+        if nodes:
+            actions.append((action, sorted(n.name for n in nodes)))
+
+    def cordon_nodes(nodes, **kwargs):
+        record_nodes('cordon', nodes)
+        return dict((n, True) for n in nodes)
+
+    def uncordon_nodes(nodes, **kwargs):
+        record_nodes('uncordon', nodes)
+        return dict((n, True) for n in nodes)
+
+    def drain_nodes(pods_by_node, notifier=None, **kwargs):
+        record_nodes('drain', pods_by_node)
+        return {}
+
+    def create_deployment(resource_group_name, deployment_name, properties):
+        counts = dict((name[:-len('Count')], p['value']) for name, p in properties.parameters.items()
+                      if name.endswith('Count'))
+        actions.append(('deploy', counts))
+
+    def delete_resources_for_node(node, resource_group_name, vm_details=None):
+        actions.append(('delete', node.name))
+
+    stubs = [
+        (engine_scaler, 'cordon_nodes', cordon_nodes),
+        (engine_scaler, 'uncordon_nodes', uncordon_nodes),
+        (engine_scaler, 'drain_nodes', drain_nodes),
+        (engine_scaler, 'create_deployment', create_deployment),
+        (engine_scaler, 'delete_resources_for_node', delete_resources_for_node),
+        (agent_pool, 'uncordon_nodes', uncordon_nodes),
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in stubs]
+    try:
+        for module, name, stub in stubs:
+            setattr(module, name, stub)
+        yield actions
+    finally:
+        for module, name, original in originals:
+            setattr(module, name, original)
+
+
+def create_cluster(snapshot, template=None, **overrides):
+    """
+    creates a Cluster set up like the one which recorded the snapshot.
+    overrides - cluster options to change, to compare decisions.
+    Without the ARM template, the cluster runs in dry run mode.
+    """
+    config = dict(snapshot['config'])
+    config.update((k, v) for k, v in overrides.items() if v is not None)
+    cluster = Cluster(
+        kubeconfig=None,
+        idle_threshold=config['idle_threshold'],
+        spare_agents=config['spare_agents'],
+        service_principal_app_id='replay',
+        service_principal_secret='replay',
+        service_principal_tenant_id='replay',
+        subscription_id='replay',
+        client_private_key='replay',
+        ca_private_key='replay',
+        instance_init_time=600,
+        resource_group='replay',
+        notifier=None,
+        ignore_pools=config['ignore_pools'],
+        scale_up=config['scale_up'],
+        maintainance=config['maintainance'],
+        over_provision=config['over_provision'],
+        consolidate=config['consolidate'],
+        dry_run=template is None)
+    if config.get('policies'):
+        cluster.policies = PolicySet.from_dict(config['policies'])
+    cluster.arm_template = copy.deepcopy(template)
+    cluster.arm_parameters = copy.deepcopy(snapshot['arm_parameters'])
+
+    deployments = snapshot['deployments']
+    cluster.deployments.requested_pool_sizes = deployments['requested_pool_sizes']
+    if deployments['in_progress']:
+        cluster.deployments._current_deployment = _InFlightDeployment()
+    # snapshots recorded without the controller state fall back to node age as idle time
+    cluster.state = ControllerState.from_dict(snapshot['state']) if 'state' in snapshot else None
+    return cluster
+
+
+def replay_snapshot(snapshot, template=None, **overrides):
+    """
+    runs the scaling logic on a recorded snapshot, at the time it was recorded.
+    returns the list of (action, details) the autoscaler would have taken
+    """
+    cluster = create_cluster(snapshot, template, **overrides)
+    nodes = [pykube.Node(None, obj) for obj in snapshot['nodes']]
+    pods = [pykube.Pod(None, obj) for obj in snapshot['pods']]
+
+    actions = []
+    with stubbed_calls(actions):
+        cluster.process(nodes, pods, now=dateutil_parse(snapshot['time']))
+    return actions
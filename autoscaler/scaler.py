@@ -2,15 +2,11 @@ import time
 import datetime
 import logging
 
-from azure.cli.core.commands.client_factory import get_mgmt_service_client
-from azure.mgmt.resource.resources import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.storage.blob import BlockBlobService
-
 import autoscaler.utils as utils
 from autoscaler.agent_pool import AgentPool
 from autoscaler.kube import KubeResource
+from autoscaler.equivalence import group_pods, fit_count
+from autoscaler.policy import PolicySet
 import autoscaler.capacity as capacity
 
 logger = logging.getLogger(__name__)
@@ -27,6 +23,9 @@ class ClusterNodeState(object):
     BUSY = 'busy'
     UNDER_UTILIZED_DRAINABLE = 'under-utilized-drainable'
     UNDER_UTILIZED_UNDRAINABLE = 'under-utilized-undrainable'
+    # states decided by the consolidation planner
+    CONSOLIDATABLE = 'consolidatable'
+    UNDER_UTILIZED_UNPACKABLE = 'under-utilized-unpackable'
 
 
 class Scaler(object):
@@ -50,6 +49,18 @@ class Scaler(object):
         self.max_agent_pool_size = 100
         self.agent_pools = None
         self.scalable_pools = None
+        self.label_index = None
+        # reference time of the loop, the current time when not set (set when replaying snapshots)
+        self.now = None
+        # ControllerState tracking since when nodes are idle, node age is used instead when not set
+        self.state = None
+        # SchedulingTracker told which pods the pools are scaled out for
+        self.tracker = None
+        self.policies = PolicySet()
+        # CapacityLedger of the nodes being added and removed, across loops
+        self.ledger = None
+        # decisions changed by a pool policy in this loop
+        self.clamped = []
         self.ignored_pool_names = {}
     
     def get_agent_pools(self, nodes):
@@ -58,53 +69,139 @@ class Scaler(object):
     def scale_pools(self, pool_sizes):
         raise NotImplementedError()
 
+    def current_time(self):
+        return self.now or datetime.datetime.now(datetime.timezone.utc)
+
+    def fill_min_size(self):
+        """
+        scales the pools under their min_size up to it, for the loops without pending pods
+        """
+        if not any(pool.actual_capacity + self.in_flight_count(pool) < self.policies.get(pool.name).min_size
+                   for pool in self.scalable_pools):
+            return
+        logger.info("Scaling pools up to their min_size")
+        self.scale_pools(dict((pool.name, pool.actual_capacity) for pool in self.agent_pools))
+
+    def in_flight_count(self, pool):
+        """
+        returns the number of nodes requested for the pool which haven't registered yet
+        """
+        return len(pool.reserved_indexes - pool.indexes)
+
+    def record_clamp(self, pool_name, decision, requested, allowed, policy):
+        """
+        records that the policy of the pool changed a decision from requested to allowed
+        """
+        logger.info("Policy '{}' of pool '{}' clamped {} from {} to {}".format(
+            policy, pool_name, decision, requested, allowed))
+        self.clamped.append({'pool': pool_name, 'decision': decision, 'requested': requested,
+                             'allowed': allowed, 'policy': policy})
+
+    def _last_scale(self, pool_name, direction):
+        if self.state is None:
+            return None
+        return self.state.last_scale(pool_name, direction)
+
+    def clamp_scale_up(self, pool, desired):
+        """
+        returns the size the pool can be scaled to given its policy, instead of desired
+        """
+        size, policy = self.policies.get(pool.name).clamp_scale_up(
+            pool.actual_capacity, desired, self._last_scale(pool.name, 'up'), self.current_time())
+        if policy and size != desired:
+            self.record_clamp(pool.name, 'size', desired, size, policy)
+        return size
+
+    def allowed_scale_down(self, pool):
+        """
+        returns (count, policy): how many agents the pool can lose in this loop given its policy,
+        and the policy bounding it
+        """
+        return self.policies.get(pool.name).allowed_scale_down(
+            pool.actual_capacity, self._last_scale(pool.name, 'up'),
+            self._last_scale(pool.name, 'down'), self.current_time())
+
     def get_node_state(self, node, node_pods, pods_to_schedule):
         """
         returns the ClusterNodeState for the given node
         params:
         node - KubeNode object
-        asg - AutoScalingGroup object that this node belongs in. can be None.
         node_pods - list of KubePods assigned to this node
         pods_to_schedule - list of all pending pods
-        running_inst_map - map of all (instance_id -> ec2.Instance object)
-        idle_selector_hash - current map of idle nodes by type. may be modified.
         """
+        now = self.current_time()
+        return self._classify_node(node, self._aggregate_pods(node_pods, now),
+                                   bool(pods_to_schedule), now)
+
+    def get_pool_node_states(self, pool, pods_by_node, pods_to_schedule):
+        """
+        returns a map of node -> ClusterNodeState for every node of the pool.
+        Utilization, drainability and age are computed in a single pass over
+        the pods of each node, with the same reference time for the whole pool.
+        params:
+        pool - AgentPool object
+        pods_by_node - map of node name -> list of KubePods assigned to this node
+        pods_to_schedule - list of all pending pods
+        """
+        now = self.current_time()
+        has_pods_to_schedule = bool(pods_to_schedule)
+        return dict(
+            (node, self._classify_node(
+                node, self._aggregate_pods(pods_by_node.get(node.name, []), now),
+                has_pods_to_schedule, now))
+            for node in pool.nodes)
 
+    def _aggregate_pods(self, node_pods, now):
+        """
+        returns (busy, utilization, drainable) for the pods of a node
+        """
         # we consider a node to be busy if it's running any non-DaemonSet pods
         # TODO: we can be a bit more aggressive in killing pods that are
         # replicated
-        busy_list = [p for p in node_pods if (not p.is_mirrored() and 'kube-proxy' not in p.name)]
+        busy = False
+        drainable = True
+        utilization = {}
+        for pod in node_pods:
+            if pod.is_kube_proxy:
+                continue
+            if not pod.is_mirrored():
+                busy = True
+                for k, v in pod.resources.raw.items():
+                    utilization[k] = utilization.get(k, 0) + v
+            if drainable and not pod.is_drainable(now):
+                drainable = False
+        return busy, utilization, drainable
 
-        age = (datetime.datetime.now(node.creation_time.tzinfo) - node.creation_time).seconds
+    def _classify_node(self, node, aggregates, has_pods_to_schedule, now):
+        busy, utilization, drainable = aggregates
 
-        # TODO: Fix this kube-proxy issue, see
-        # https://github.com/openai/kubernetes-ec2-autoscaler/issues/23
-        undrainable_list = [p for p in node_pods if not (
-            p.is_drainable() or 'kube-proxy' in p.name)]
+        capacity = node.capacity.raw
+        under_utilized = all(
+            self.UTIL_THRESHOLD * capacity.get(k, 0) - utilization.get(k, 0) >= 0
+            for k in set(capacity) | set(utilization))
 
-        utilization = sum((p.resources for p in busy_list), KubeResource())
-        under_utilized = (self.UTIL_THRESHOLD *
-                          node.capacity - utilization).possible 
-        drainable = not undrainable_list
+        if self.state is not None:
+            self.state.set_idle(node.name, not busy or under_utilized, now)
+            idle_time = self.state.idle_duration(node.name, now)
+        else:
+            idle_time = (now - node.creation_time).total_seconds()
 
-        if busy_list and not under_utilized:
+        if busy and not under_utilized:
             if node.unschedulable:
                 state = ClusterNodeState.BUSY_UNSCHEDULABLE
             else:
                 state = ClusterNodeState.BUSY
-        elif pods_to_schedule and not node.unschedulable:
+        elif has_pods_to_schedule and not node.unschedulable:
             state = ClusterNodeState.POD_PENDING
         # elif is_spare_agent:
         #     state = ClusterNodeState.SPARE_AGENT
-        elif age <= self.idle_threshold and not node.unschedulable:
+        elif idle_time <= self.idle_threshold and not node.unschedulable:
             state = ClusterNodeState.GRACE_PERIOD
-        elif under_utilized and (busy_list or not node.unschedulable):
+        elif under_utilized and (busy or not node.unschedulable):
             if drainable:
                 state = ClusterNodeState.UNDER_UTILIZED_DRAINABLE
             else:
                 state = ClusterNodeState.UNDER_UTILIZED_UNDRAINABLE
-                # logger.info('Undrainable pods: {}'.format(
-                #         undrainable_list))
         else:
             if node.unschedulable:
                 state = ClusterNodeState.IDLE_UNSCHEDULABLE
@@ -116,8 +213,12 @@ class Scaler(object):
     # Calculate the number of new VMs needed to accomodate all pending pods
     def fulfill_pending(self, pods):
         logger.info("====Scaling for %s pods ====", len(pods))
-        accounted_pods = dict((p, False) for p in pods)
+        # identical pods are packed together, per equivalence class
+        pod_classes = group_pods(pods)
+        # class -> pods not accounted for by the pools scaled so far
+        remaining = dict((pod_class, list(pod_class.pods)) for pod_class in pod_classes)
         num_unaccounted = len(pods)
+        decisions = {}
         current_pool_sizes = {}
         new_pool_sizes = {}
         ordered_pools = capacity.order_by_cost_asc(self.agent_pools)
@@ -128,57 +229,81 @@ class Scaler(object):
             if pool.name in self.ignored_pool_names or not num_unaccounted:
                 continue
 
-            new_instance_resources = []
-            assigned_pods = []
-            for pod, acc in accounted_pods.items():
-                if acc or not (pool.unit_capacity - pod.resources).possible:
+            # the nodes requested for the pool which haven't registered yet are filled first
+            in_flight = self.in_flight_count(pool)
+            new_instance_resources = [pool.unit_capacity] * in_flight
+            assigned_pods = [[] for _ in range(in_flight)]
+            for pod_class in pod_classes:
+                class_pods = remaining[pod_class]
+                if not class_pods or not (pool.unit_capacity - pod_class.resources).possible:
+                    continue
+                if self.label_index and pool.name not in self.label_index.matching_pools(pod_class.selectors):
                     continue
 
-                found_fit = False
+                requests = pod_class.resources
                 for i, instance in enumerate(new_instance_resources):
-                    if (instance - pod.resources).possible:
-                        new_instance_resources[i] = instance - pod.resources
-                        assigned_pods[i].append(pod)
-                        found_fit = True
+                    if not class_pods:
                         break
-                if not found_fit:
+                    count = fit_count(instance.raw, requests.raw, len(class_pods))
+                    if count:
+                        new_instance_resources[i] = instance - requests * count
+                        assigned_pods[i].extend(class_pods[:count])
+                        class_pods = class_pods[count:]
+                per_instance = max(1, fit_count(pool.unit_capacity.raw, requests.raw, len(class_pods)))
+                while class_pods:
                     new_instance_resources.append(
-                        pool.unit_capacity - pod.resources)
-                    assigned_pods.append([pod])
+                        pool.unit_capacity - requests * per_instance)
+                    assigned_pods.append(class_pods[:per_instance])
+                    class_pods = class_pods[per_instance:]
 
-            # new desired # machines = # running nodes + # machines required to fit jobs that don't
-            # fit on running nodes. This scaling is conservative but won't
-            # create starving
-            units_needed = len(new_instance_resources)
-            units_needed += self.over_provision
+            # new desired # machines = # running nodes + # machines being created + # machines
+            # required to fit jobs that don't fit on running nodes. This scaling is conservative
+            # but won't create starving
+            units_needed = len(new_instance_resources) - in_flight
+            if units_needed or not in_flight:
+                # the nodes being created were over-provisioned when they were requested
+                units_needed += self.over_provision
 
             unavailable_units = max(
-                0, units_needed - (pool.max_size - pool.actual_capacity))
+                0, units_needed - (pool.max_size - pool.actual_capacity - in_flight))
 
             units_requested = units_needed - unavailable_units
+            desired = pool.actual_capacity
+            if units_requested:
+                desired += in_flight + units_requested
+            new_capacity = self.clamp_scale_up(pool, desired)
+            units_requested = max(0, new_capacity - pool.actual_capacity - in_flight)
 
             logger.debug("units_needed: %s", units_needed)
             
             logger.debug("units_requested: %s", units_requested)
 
-            new_capacity = pool.actual_capacity + units_requested
             logger.debug('{} actual capacity: {} , units requested: {}'.format(
                 pool.name, pool.actual_capacity, units_requested))
             new_pool_sizes[pool.name] = new_capacity
 
-            logger.info("New capacity requested for pool {}: {} agents (current capacity: {} agents)".format(
-                pool.name, new_capacity, pool.actual_capacity))
+            logger.info("New capacity requested for pool {}: {} agents (current capacity: {} agents, {} being created)".format(
+                pool.name, new_capacity, pool.actual_capacity, in_flight))
 
-            for i in range(min(len(assigned_pods), units_requested)):
+            accounted = set()
+            for i in range(min(len(assigned_pods), in_flight + units_requested)):
                 for pod in assigned_pods[i]:
-                    accounted_pods[pod] = True
-                    num_unaccounted -= 1
+                    accounted.add(id(pod))
+                    decisions[pod] = pool.name
+            if accounted:
+                num_unaccounted -= len(accounted)
+                for pod_class in pod_classes:
+                    remaining[pod_class] = [p for p in remaining[pod_class] if id(p) not in accounted]
 
             logger.debug("remaining pending: %s", num_unaccounted)
 
         if num_unaccounted:
             logger.warn('Failed to scale sufficiently.')
-            self.notifier.notify_failed_to_scale(selectors_hash, pods)
+            if self.notifier:
+                unaccounted = [p for pod_class in pod_classes for p in remaining[pod_class]]
+                self.notifier.notify_failed_to_scale(unaccounted[0].selectors, unaccounted)
+        if self.tracker:
+            self.tracker.scale_decided(decisions)
         self.scale_pools(new_pool_sizes)
         if self.notifier:
             self.notifier.notify_scale(new_pool_sizes, pods, current_pool_sizes)
@@ -0,0 +1,138 @@
+"""
+module to run periodic tasks, such as the loops of several clusters, on a shared pool of threads
+"""
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """
+    a function called every interval seconds. When it fails (returns False or raises),
+    the delay before the next call doubles, up to max_backoff seconds
+    """
+
+    def __init__(self, name, func, interval, max_backoff=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.max_backoff = max_backoff or interval * 32
+        self.delay = interval
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_duration = None
+        self.last_success = None
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'last_duration': self.last_duration,
+            'last_success': self.last_success,
+            'delay': self.delay,
+        }
+
+
+class Scheduler(object):
+    """
+    runs tasks when they are due, each in its own worker thread, renamed after the task
+    so that log lines can be attributed. A task is never run concurrently with itself,
+    and the failure of a task doesn't affect the others.
+    With fail_fast, the first exception raised by a task stops the scheduler instead,
+    and run() raises it (e.g. for --debug).
+    """
+
+    def __init__(self, max_workers=4, clock=time.time, fail_fast=False):
+        self.max_workers = max_workers
+        self.fail_fast = fail_fast
+        # exception which stopped the scheduler, with fail_fast
+        self.error = None
+        self.tasks = {}
+        self._clock = clock
+        self._queue = []
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def add(self, name, func, interval, max_backoff=None, delay=0):
+        task = Task(name, func, interval, max_backoff)
+        with self._condition:
+            self.tasks[name] = task
+            self._push(task, self._clock() + delay)
+        return task
+
+    def _push(self, task, when):
+        self._seq += 1
+        heapq.heappush(self._queue, (when, self._seq, task))
+        self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _run_task(self, task):
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = task.name
+        start = self._clock()
+        try:
+            success = task.func() is not False
+        except Exception as e:
+            logger.error('Task {} failed: {}'.format(task.name, e), exc_info=True)
+            success = False
+            if self.fail_fast:
+                with self._condition:
+                    if self.error is None:
+                        self.error = e
+                    self._stopped = True
+                    self._condition.notify()
+        finally:
+            thread.name = thread_name
+
+        end = self._clock()
+        with self._condition:
+            task.running = False
+            task.runs += 1
+            task.last_duration = end - start
+            if success:
+                task.consecutive_failures = 0
+                task.last_success = end
+                task.delay = task.interval
+            else:
+                task.failures += 1
+                task.consecutive_failures += 1
+                task.delay = min(task.delay * 2, task.max_backoff)
+                logger.warn('Task {} failed {} time(s) in a row, next run in {}s'.format(
+                    task.name, task.consecutive_failures, task.delay))
+            logger.debug('Task {} took {:.1f}s: {}'.format(task.name, task.last_duration, task.stats()))
+            if task.name in self.tasks:
+                self._push(task, end + task.delay)
+
+    def run(self):
+        """
+        runs the tasks until stop() is called, or a task raises with fail_fast
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self._condition:
+                    while not self._stopped:
+                        now = self._clock()
+                        if self._queue and self._queue[0][0] <= now:
+                            break
+                        timeout = self._queue[0][0] - now if self._queue else None
+                        self._condition.wait(timeout)
+                    if self._stopped:
+                        break
+                    _, _, task = heapq.heappop(self._queue)
+                    task.running = True
+                executor.submit(self._run_task, task)
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,210 @@
+"""
+module to measure the time it takes for pending pods to be scheduled, phase by phase
+"""
+import bisect
+import collections
+import datetime
+import logging
+import threading
+
+import autoscaler.utils as utils
+from autoscaler.kube import KubePodStatus
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (5, 15, 30, 60, 120, 180, 300, 450, 600, 900, 1200, 1800, 3600, float('inf'))
+
+# phases of a pod, from its creation to its scheduling:
+# detection: created -> first seen pending by a loop (loop interval)
+# decision: first seen pending -> scale-up decided for it
+# submission: scale-up decided -> deployment submitted (e.g. waiting for another deployment)
+# registration: deployment submitted -> the node the pod is scheduled on registered (ARM, VM boot)
+# bootstrap: node registered -> node ready (custom script extension, kubelet)
+# binding: node ready (or pod seen pending, for nodes which were already ready) -> pod scheduled
+# total: created -> scheduled
+PHASES = ('detection', 'decision', 'submission', 'registration', 'bootstrap', 'binding', 'total')
+# duration of the deployments, recorded for each pool they scaled out
+DEPLOYMENT_PHASE = 'deployment'
+
+
+def _utc(time):
+    if time is not None and time.tzinfo is None:
+        return time.replace(tzinfo=datetime.timezone.utc)
+    return time
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        returns the upper bound of the bucket of the q-th percentile (0 < q <= 100)
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': dict((str(b), c) for b, c in zip(self.buckets, self.counts)),
+        }
+
+
+class _PodTimeline(object):
+    def __init__(self, created, seen):
+        self.created = created
+        self.seen = seen
+        self.decided = None
+        self.pool = None
+        self.submitted = None
+
+
+class SchedulingTracker(object):
+    """
+    follows the pods seen pending by the loops until they are scheduled, and records how long
+    each phase took in histograms per pool and phase.
+    Times come from the objects themselves when the API server has them (creation, Ready and
+    PodScheduled conditions) and from the loop otherwise, so the loop interval blurs them.
+    """
+
+    def __init__(self):
+        self.histograms = collections.defaultdict(Histogram)
+        # reference time of the current loop, None to use the current time
+        self.now = None
+        self._pods = {}
+        self._deployment = None
+        self._lock = threading.Lock()
+
+    def current_time(self):
+        return self.now or datetime.datetime.now(datetime.timezone.utc)
+
+    def _observe(self, pool, phase, start, end):
+        if start is None or end is None:
+            return
+        self.histograms[(pool, phase)].observe(max(0, (end - start).total_seconds()))
+
+    def observe(self, pods, nodes, now=None):
+        """
+        starts following the pods which are pending and unassigned, records the ones which were
+        scheduled since the previous loop, and forgets the ones which are gone.
+        returns the number of pods recorded as scheduled
+        """
+        with self._lock:
+            self.now = now
+            now = self.current_time()
+            nodes_by_name = dict((node.name, node) for node in nodes)
+            listed = set()
+            scheduled = 0
+            for pod in pods:
+                listed.add(pod.uid)
+                timeline = self._pods.get(pod.uid)
+                if pod.status == KubePodStatus.PENDING and not pod.node_name:
+                    if timeline is None:
+                        self._pods[pod.uid] = _PodTimeline(_utc(pod.creation_time), now)
+                elif timeline is not None and pod.node_name:
+                    node = nodes_by_name.get(pod.node_name)
+                    if node is not None:
+                        self._record(timeline, pod, node, now)
+                        scheduled += 1
+                    del self._pods[pod.uid]
+            for uid in list(self._pods):
+                if uid not in listed:
+                    del self._pods[uid]
+            return scheduled
+
+    def _record(self, timeline, pod, node, now):
+        pool = utils.get_pool_name(node)
+        scheduled = _utc(pod.scheduled_time) or now
+        registered = _utc(node.creation_time)
+        ready = _utc(node.ready_time)
+        self._observe(pool, 'detection', timeline.created, timeline.seen)
+        self._observe(pool, 'total', timeline.created, scheduled)
+        if timeline.decided and registered > timeline.seen:
+            # the pod waited for the node to be created
+            self._observe(pool, 'decision', timeline.seen, timeline.decided)
+            self._observe(pool, 'submission', timeline.decided, timeline.submitted)
+            self._observe(pool, 'registration', timeline.submitted, registered)
+            self._observe(pool, 'bootstrap', registered, ready)
+            self._observe(pool, 'binding', ready, scheduled)
+        else:
+            self._observe(pool, 'binding', max(timeline.seen, ready or timeline.seen), scheduled)
+        logger.debug('{} scheduled on {} {}s after its creation'.format(
+            pod, node, (scheduled - timeline.created).total_seconds()))
+
+    def scale_decided(self, decisions):
+        """
+        decisions - map of KubePod -> name of the pool scaled out for it
+        """
+        with self._lock:
+            now = self.current_time()
+            for pod, pool in decisions.items():
+                timeline = self._pods.get(pod.uid)
+                if timeline is not None and timeline.decided is None:
+                    timeline.decided = now
+                    timeline.pool = pool
+
+    def deployment_submitted(self, pool_sizes, previous_pool_sizes=None):
+        """
+        previous_pool_sizes - pool sizes requested by the previous deployment, to only record
+                              the duration of this one for the pools it scales out
+        """
+        with self._lock:
+            now = self.current_time()
+            pools = [pool for pool, size in pool_sizes.items()
+                     if previous_pool_sizes is None or size > previous_pool_sizes.get(pool, 0)]
+            self._deployment = (now, pools)
+            for timeline in self._pods.values():
+                if timeline.decided and timeline.submitted is None and timeline.pool in pool_sizes:
+                    timeline.submitted = now
+
+    def deployment_finished(self):
+        with self._lock:
+            if self._deployment is None:
+                return
+            submitted, pools = self._deployment
+            self._deployment = None
+            now = self.current_time()
+            for pool in pools:
+                self._observe(pool, DEPLOYMENT_PHASE, submitted, now)
+
+    def report(self):
+        """
+        returns a map of pool -> phase -> histogram summary
+        """
+        with self._lock:
+            report = {}
+            for (pool, phase), histogram in sorted(self.histograms.items()):
+                report.setdefault(pool, {})[phase] = histogram.to_dict()
+            return report
+
+    def summary(self):
+        """
+        returns a one line summary of the 90th percentiles, per pool and phase
+        """
+        with self._lock:
+            parts = []
+            for (pool, phase), histogram in sorted(self.histograms.items()):
+                parts.append('{}/{}: p90<={}s (n={})'.format(
+                    pool, phase, histogram.percentile(90), histogram.count))
+            return ', '.join(parts)
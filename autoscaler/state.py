@@ -0,0 +1,171 @@
+"""
+module to keep the state of the controller across loops and restarts
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+
+from dateutil.parser import parse as dateutil_parse
+
+logger = logging.getLogger(__name__)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ControllerState(object):
+    """
+    tracks, per node, since when it has been idle (i.e. empty or under-utilized) and when its drain started,
+    as well as the operations in flight (deployments, node deletions) and when pools were last scaled.
+    When a path is given, the state is checkpointed to this file and reloaded from it
+    at startup, so that a restart doesn't reset the idle durations.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.idle_since = {}
+        self.drain_started = {}
+        # kind -> key -> details
+        self.operations = {}
+        # pool name -> 'up' or 'down' -> time
+        self.last_scaled = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+        if path and os.path.exists(path):
+            self.load()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'idle_since': dict((k, v.isoformat()) for k, v in self.idle_since.items()),
+                'drain_started': dict((k, v.isoformat()) for k, v in self.drain_started.items()),
+                'operations': json.loads(json.dumps(self.operations)),
+                'last_scaled': dict((pool, dict((d, t.isoformat()) for d, t in times.items()))
+                                    for pool, times in self.last_scaled.items()),
+            }
+
+    @classmethod
+    def from_dict(cls, data, path=None):
+        state = cls(path)
+        state._update(data)
+        return state
+
+    def _update(self, data):
+        self.idle_since = dict((k, dateutil_parse(v)) for k, v in data.get('idle_since', {}).items())
+        self.drain_started = dict((k, dateutil_parse(v)) for k, v in data.get('drain_started', {}).items())
+        self.operations = data.get('operations', {})
+        self.last_scaled = dict((pool, dict((d, dateutil_parse(t)) for d, t in times.items()))
+                                for pool, times in data.get('last_scaled', {}).items())
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warn('Failed to load the controller state from {}: {}'.format(self.path, e))
+            return
+        with self._lock:
+            self._update(data)
+        logger.info('Loaded the state of {} idle nodes, {} drains and {} operations from {}'.format(
+            len(self.idle_since), len(self.drain_started),
+            sum(len(ops) for ops in self.operations.values()), self.path))
+
+    def save(self):
+        """
+        writes the state to its file if it changed, atomically so that a crash
+        can't leave a truncated file behind
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = self.to_dict()
+            self._dirty = False
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.warn('Failed to save the controller state to {}: {}'.format(self.path, e))
+            with self._lock:
+                self._dirty = True
+
+    def set_idle(self, node_name, idle, now=None):
+        """
+        records whether the node is idle, returns the time since it has been idle or None
+        """
+        with self._lock:
+            if not idle:
+                if self.idle_since.pop(node_name, None) is not None:
+                    self._dirty = True
+                return None
+            if node_name not in self.idle_since:
+                self.idle_since[node_name] = now or _now()
+                self._dirty = True
+            return self.idle_since[node_name]
+
+    def idle_duration(self, node_name, now=None):
+        """
+        returns the number of seconds the node has been idle for, 0 if it is not idle
+        """
+        since = self.idle_since.get(node_name)
+        if since is None:
+            return 0
+        return ((now or _now()) - since).total_seconds()
+
+    def start_drain(self, node_name, now=None):
+        with self._lock:
+            self.drain_started.setdefault(node_name, now or _now())
+            self._dirty = True
+
+    def stop_drain(self, node_name):
+        with self._lock:
+            if self.drain_started.pop(node_name, None) is not None:
+                self._dirty = True
+
+    def start_operation(self, kind, key, details=None, now=None):
+        with self._lock:
+            operation = dict(details or {})
+            operation['started'] = (now or _now()).isoformat()
+            self.operations.setdefault(kind, {})[key] = operation
+            self._dirty = True
+        self.save()
+
+    def finish_operation(self, kind, key):
+        with self._lock:
+            if self.operations.get(kind, {}).pop(key, None) is not None:
+                self._dirty = True
+        self.save()
+
+    def record_scale(self, pool_name, direction, now=None):
+        """
+        direction - 'up' or 'down'
+        """
+        with self._lock:
+            self.last_scaled.setdefault(pool_name, {})[direction] = now or _now()
+            self._dirty = True
+
+    def last_scale(self, pool_name, direction):
+        with self._lock:
+            return self.last_scaled.get(pool_name, {}).get(direction)
+
+    def get_operations(self, kind):
+        with self._lock:
+            return dict(self.operations.get(kind, {}))
+
+    def retain(self, node_names):
+        """
+        forgets the nodes which are not part of the cluster anymore
+        """
+        node_names = set(node_names)
+        with self._lock:
+            for tracked in (self.idle_since, self.drain_started, self.operations.get('deletion', {})):
+                for name in list(tracked):
+                    if name not in node_names:
+                        del tracked[name]
+                        self._dirty = True
@@ -1,5 +1,15 @@
 from copy import deepcopy
 import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+_VARIABLE_REF_REGEX = re.compile(r"variables\('([^']+)'\)")
+_PARAMETER_REF_REGEX = re.compile(r"parameters\('([^']+)'\)")
+# matches "[concat('<type>/', <name args>)]" and "[resourceId('<type>', <name args>)]"
+_TYPED_REF_REGEX = re.compile(
+    r"^\[(?:concat\('([\w.]+/[\w/]+?)/'|resourceId\('([\w.]+/[\w/]+?)'),(.*)\)\]$")
 
 
 def unroll_vm(template, pool, new_pool_size):
@@ -111,7 +121,11 @@ def unroll_nic(template, pool, new_pool_size):
     return template
 
 
-def prepare_template_for_scale_out(template, pools, new_pool_sizes):
+def get_target_pools(pools, new_pool_sizes):
+    """
+    splits pools into the ones that need to be scaled out to reach new_pool_sizes
+    and the ones that don't
+    """
     target_pools = []
     unchanged_pools = []
     for pool in pools:
@@ -119,6 +133,11 @@ def prepare_template_for_scale_out(template, pools, new_pool_sizes):
             target_pools.append(pool)
         else:
             unchanged_pools.append(pool)
+    return target_pools, unchanged_pools
+
+
+def prepare_template_for_scale_out(template, pools, new_pool_sizes):
+    target_pools, unchanged_pools = get_target_pools(pools, new_pool_sizes)
     template = deepcopy(template)
 
     # Delete all resources which have no impact on the pools or are never changed, such as Master
@@ -129,8 +148,39 @@ def prepare_template_for_scale_out(template, pools, new_pool_sizes):
     template = delete_unchanged_pools(template, unchanged_pools)
     template = unroll_resources(template, target_pools, new_pool_sizes)
     template = delete_outputs_section(template)
+    # Only ship the new agents and what they depend on
+    template = minimize_template(template, target_pools)
     return template
 
+def set_count_parameters(parameters, pools, new_pool_sizes):
+    """
+    sets the Count parameters of the pools to their new sizes
+    """
+    for pool in pools:
+        if new_pool_sizes[pool.name] == 0:
+            # This is required as 0 is not an accepted value for the Count parameter,
+            # but setting the offset to 1 actually prevent the deployment
+            # from changing anything
+            parameters[pool.name + 'Count'] = {'value': 1}
+            parameters[pool.name + 'Offset'] = {'value': 1}
+        else:
+            # We don't need to set the offset parameter as we are directly specifying each
+            # resource in the template instead of using Count func
+            parameters[pool.name + 'Count'] = {'value': new_pool_sizes[pool.name]}
+    return parameters
+
+
+def render_scale_out(template, parameters, pools, new_pool_sizes):
+    """
+    returns the (template, parameters) of the deployment scaling pools out to new_pool_sizes.
+    Raises TemplateValidationError when ARM would reject the template
+    """
+    template = prepare_template_for_scale_out(template, pools, new_pool_sizes)
+    parameters = prune_parameters(template, parameters)
+    # fail now rather than after ARM accepted the deployment
+    validate_template(template, parameters)
+    return template, parameters
+
 def delete_outputs_section(template):
     template.pop('outputs')
     return template
@@ -238,16 +288,16 @@ def get_new_nodes_indexes(pool, new_pool_size):
     by scaling the specified pool to the specified size.
     For example, if pool currently has 2 agents with index 2 and 4
     With a new_pool_sizes of 5, the new indexes would be 0, 1 and 3
+    The nodes being created by a deployment in flight (reserved indexes) count towards the size
+    of the pool, and their indexes are skipped.
     """
+    occupied = pool.indexes | pool.reserved_indexes
+    count = new_pool_size - pool.actual_capacity - len(pool.reserved_indexes - pool.indexes)
     indexes = []
-    i = 0
     idx = 0
-    while i < new_pool_size - pool.actual_capacity:
-        if pool.has_node_with_index(idx):
-            idx += 1
-            continue
-        indexes.append(idx)
-        i += 1
+    while len(indexes) < count:
+        if idx not in occupied:
+            indexes.append(idx)
         idx += 1
     return indexes
 
@@ -261,3 +311,254 @@ def delete_master_vm_extension(template):
             break
     resources.pop(i)
     return template
+
+
+def _strip_whitespace(expression):
+    return re.sub(r'\s', '', expression)
+
+
+def _resource_key(resource_type, name_args):
+    return '{}|{}'.format(resource_type, _strip_whitespace(name_args))
+
+
+def _name_args(resource_name):
+    """
+    returns the arguments building the name of a resource, e.g.
+    "[concat(variables('x'), 'nic-', 0)]" -> "variables('x'), 'nic-', 0"
+    """
+    if resource_name.startswith('[concat(') and resource_name.endswith(')]'):
+        return resource_name[len('[concat('):-2]
+    if resource_name.startswith('[') and resource_name.endswith(']'):
+        return resource_name[1:-1]
+    return "'{}'".format(resource_name)
+
+
+def _parse_dependency(dependency, variables):
+    """
+    returns (resource type, name args) for a dependsOn entry, or (None, None)
+    if the dependency is not expressed as a typed resource reference.
+    Dependencies like "[variables('vnetID')]" are resolved through the variables section.
+    """
+    match = _TYPED_REF_REGEX.match(_strip_whitespace(dependency))
+    if not match:
+        var_match = re.match(r"^\[variables\('([^']+)'\)\]$", dependency)
+        if var_match and isinstance(variables.get(var_match.group(1)), str):
+            match = _TYPED_REF_REGEX.match(
+                _strip_whitespace(variables[var_match.group(1)]))
+    if not match:
+        return None, None
+    return match.group(1) or match.group(2), match.group(3)
+
+
+def resolve_dependencies(template):
+    """
+    maps each resource index to the indexes of the resources it depends on.
+    dependsOn entries that cannot be matched to a resource of the template are
+    returned separately as (resource index, dependency) tuples.
+    """
+    resources = template['resources']
+    variables = template.get('variables', {})
+    by_key = {}
+    by_name = {}
+    for i, resource in enumerate(resources):
+        by_key.setdefault(_resource_key(resource['type'], _name_args(resource['name'])), []).append(i)
+        by_name.setdefault(_strip_whitespace(resource['name']), []).append(i)
+
+    edges = {}
+    unresolved = []
+    for i, resource in enumerate(resources):
+        edges[i] = {}
+        for dependency in resource.get('dependsOn', []):
+            targets = by_name.get(_strip_whitespace(dependency))
+            if not targets:
+                dep_type, dep_args = _parse_dependency(dependency, variables)
+                if dep_type:
+                    targets = by_key.get(_resource_key(dep_type, dep_args))
+                    if not targets:
+                        # copy loops can't be matched on their name: fall back to any
+                        # resource of this type named from a subset of the same variables
+                        dep_vars = set(_VARIABLE_REF_REGEX.findall(dep_args))
+                        targets = [j for j, r in enumerate(resources)
+                                   if r['type'] == dep_type and 'copy' in r and
+                                   set(_VARIABLE_REF_REGEX.findall(r['name'])) <= dep_vars]
+            if targets:
+                edges[i][dependency] = targets
+            else:
+                unresolved.append((i, dependency))
+    return edges, unresolved
+
+
+def _reference_closure(roots, values, regex):
+    """
+    returns the names of values in `values` transitively referenced from `roots`.
+    References are case insensitive, like in ARM expressions.
+    """
+    names = dict((name.lower(), name) for name in values)
+    seen = set()
+    queue = list(roots)
+    while queue:
+        name = names.get(queue.pop().lower())
+        if name is None or name in seen:
+            continue
+        seen.add(name)
+        queue.extend(regex.findall(json.dumps(values[name])))
+    return seen
+
+
+def minimize_template(template, target_pools):
+    """
+    minimize_template prunes the template down to the resources added for the target pools
+    and their dependency closure (dependsOn graph) within these pools, then removes the
+    variables and parameters that are no longer referenced.
+    Dependencies on shared resources (vnet, route table, LB, master resources...) are removed
+    from dependsOn, as these already exist in the resource group.
+    """
+    size_before = len(json.dumps(template))
+    resources = template['resources']
+    pool_names = [pool.name for pool in target_pools]
+
+    def is_pool_resource(resource):
+        for var in _VARIABLE_REF_REGEX.findall(resource['name']):
+            for pool_name in pool_names:
+                if var.startswith(pool_name) and var[len(pool_name):][:1].isupper():
+                    return True
+        return False
+
+    prefixes = ["variables('{}VMNamePrefix')".format(name) for name in pool_names]
+    roots = [i for i, r in enumerate(resources)
+             if 'copyIndex' not in r['name'] and any(p in r['name'] for p in prefixes)]
+
+    edges, _ = resolve_dependencies(template)
+    kept = set()
+    queue = list(roots)
+    while queue:
+        i = queue.pop()
+        if i in kept:
+            continue
+        kept.add(i)
+        for targets in edges[i].values():
+            queue.extend(t for t in targets if is_pool_resource(resources[t]))
+
+    new_resources = []
+    for i, resource in enumerate(resources):
+        if i not in kept:
+            continue
+        if 'dependsOn' in resource:
+            resource['dependsOn'] = [
+                d for d in resource['dependsOn']
+                if d not in edges[i] or any(t in kept for t in edges[i][d])]
+        new_resources.append(resource)
+    template['resources'] = new_resources
+
+    variables = template.get('variables', {})
+    used_variables = _reference_closure(
+        _VARIABLE_REF_REGEX.findall(json.dumps(new_resources)), variables, _VARIABLE_REF_REGEX)
+    template['variables'] = dict((k, v) for k, v in variables.items() if k in used_variables)
+
+    referencing = json.dumps([new_resources, template['variables']])
+    used_parameters = set(name.lower() for name in _PARAMETER_REF_REGEX.findall(referencing))
+    template['parameters'] = dict((k, v) for k, v in template.get('parameters', {}).items()
+                                  if k.lower() in used_parameters)
+
+    logger.info('Minimized template: {} resources, {} variables, {} parameters ({} -> {} bytes)'.format(
+        len(new_resources), len(template['variables']), len(template['parameters']),
+        size_before, len(json.dumps(template))))
+    return template
+
+
+class TemplateValidationError(ValueError):
+    """
+    raised when a generated template would be rejected or fail on the ARM side
+    """
+
+    def __init__(self, errors):
+        ValueError.__init__(self, 'Invalid ARM template: {}'.format('; '.join(errors)))
+        self.errors = errors
+
+
+_COPY_INDEX_REGEX = re.compile(r"copyIndex\(\s*(?:'([^']*)')?")
+
+
+def _property_copy_names(value):
+    """
+    returns the names of the property copy loops (e.g. data disks) defined in a resource
+    """
+    names = set()
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k == 'copy' and isinstance(v, list):
+                names.update(c.get('name') for c in v if isinstance(c, dict))
+            names |= _property_copy_names(v)
+    elif isinstance(value, list):
+        for v in value:
+            names |= _property_copy_names(v)
+    return names
+
+
+def validate_template(template, parameters=None):
+    """
+    checks a template before it is deployed, raises a TemplateValidationError listing
+    the problems found:
+    - resources with the same type and name
+    - dependsOn entries that don't match any resource of the template
+    - copyIndex() used outside of a copy loop
+    - variables and parameters referenced but not defined
+    - when the deployment parameters are given, parameters without default value which
+      are missing, and parameters which are not declared by the template
+    """
+    errors = []
+    resources = template.get('resources', [])
+    variables = template.get('variables', {})
+    declared = template.get('parameters', {})
+
+    names = {}
+    for i, resource in enumerate(resources):
+        key = (resource['type'].lower(), _strip_whitespace(resource['name']).lower())
+        if key in names:
+            errors.append('resources #{} and #{} are both named {} {}'.format(
+                names[key], i, resource['type'], resource['name']))
+        names.setdefault(key, i)
+
+    _, unresolved = resolve_dependencies(template)
+    for i, dependency in unresolved:
+        errors.append('{} depends on {}, which is not part of the template'.format(
+            resources[i]['name'], dependency))
+
+    for resource in resources:
+        loops = _property_copy_names(resource.get('properties', {}))
+        for loop in _COPY_INDEX_REGEX.findall(json.dumps(resource)):
+            if not (loop in loops if loop else 'copy' in resource):
+                errors.append('{} uses copyIndex({}) outside of a copy loop'.format(
+                    resource['name'], "'{}'".format(loop) if loop else ''))
+                break
+
+    # names are case insensitive in ARM expressions
+    referencing = json.dumps([resources, variables])
+    defined = set(name.lower() for name in variables)
+    for name in sorted(set(_VARIABLE_REF_REGEX.findall(referencing))):
+        if name.lower() not in defined:
+            errors.append('variable {} is not defined'.format(name))
+    defined = set(name.lower() for name in declared)
+    for name in sorted(set(_PARAMETER_REF_REGEX.findall(referencing))):
+        if name.lower() not in defined:
+            errors.append('parameter {} is not declared'.format(name))
+
+    if parameters is not None:
+        for name in sorted(set(declared) - set(parameters)):
+            if 'defaultValue' not in declared[name]:
+                errors.append('parameter {} has no value'.format(name))
+        for name in sorted(set(parameters) - set(declared)):
+            errors.append('parameter {} is given but not declared'.format(name))
+
+    if errors:
+        raise TemplateValidationError(errors)
+
+
+def prune_parameters(template, parameters):
+    """
+    returns the subset of the deployment parameters declared by the template
+    """
+    pruned = dict((k, v) for k, v in parameters.items() if k in template.get('parameters', {}))
+    logger.info('Pruned deployment parameters: {} -> {} parameters ({} -> {} bytes)'.format(
+        len(parameters), len(pruned), len(json.dumps(parameters)), len(json.dumps(pruned))))
+    return pruned
@@ -1,7 +1,10 @@
 import json
+import logging
 import re
 import urllib.request
-from azure.cli.core.util import get_file_json
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 SI_suffix = {
     'y': 1e-24,  # yocto
@@ -99,6 +102,13 @@ def order_nodes(node_map):
 
         return ordered_nodes
 
+def get_file_json(file_path):
+    """
+    loads a JSON file, which may start with a byte order mark as files written on windows do
+    """
+    with open(file_path, encoding='utf-8-sig') as f:
+        return json.load(f)
+
 def get_arm_template(local_file_path, url):
     if local_file_path:
         return get_file_json(local_file_path)
@@ -118,4 +128,21 @@ def get_arm_parameters(local_file_path, url):
         return parameters
 
 
-        
\ No newline at end of file
+def run_concurrently(func, items, max_workers):
+    """
+    calls func on every item with at most max_workers concurrent calls.
+    returns a dict of item -> result. Exceptions are logged and
+    recorded as a False result so that one failure doesn't abort the batch.
+    """
+    results = {}
+    if not items:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = dict((item, executor.submit(func, item)) for item in items)
+        for item, future in futures.items():
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                logger.error('Concurrent call failed for {}: {}'.format(item, e))
+                results[item] = False
+    return results
@@ -0,0 +1,51 @@
+"""
+measures the cold start of the autoscaler: time to import its entry point,
+peak RSS after the import, and which azure modules got imported on the way.
+Each run happens in a fresh interpreter.
+
+$ python benchmarks/startup.py [--runs 5] [--module main]
+"""
+import argparse
+import json
+import os.path
+import statistics
+import subprocess
+import sys
+
+_PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': elapsed,
+    # kilobytes on linux
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'azure_modules': sorted(m for m in sys.modules if m.startswith(('azure', 'msrest'))),
+}}))
+'''
+
+
+def measure(module):
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', _PROBE.format(module=module)], cwd=root)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='autoscaler startup benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--module', default='main', help='module to import (default=main)')
+    args = parser.parse_args()
+
+    results = [measure(args.module) for _ in range(args.runs)]
+    print('import {}: {} runs'.format(args.module, args.runs))
+    print('  import time: median {:.3f}s, min {:.3f}s'.format(
+        statistics.median(r['seconds'] for r in results), min(r['seconds'] for r in results)))
+    print('  max RSS: median {:.1f}MB'.format(
+        statistics.median(r['max_rss_kb'] for r in results) / 1024))
+    print('  azure modules imported: {}'.format(len(results[0]['azure_modules'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,16 @@
+import functools
 import logging
 import sys
 import time
 
 import click
 
-from autoscaler.cluster import Cluster
+from autoscaler.cluster import Cluster, SCALE_UP, MAINTENANCE
+from autoscaler.config import Config
+from autoscaler.memory import MemoryWatchdog
+from autoscaler.multi_cluster import load_targets
 from autoscaler.notification import Notifier
+from autoscaler.scheduler import Scheduler
 
 logger = logging.getLogger('autoscaler')
 
@@ -18,8 +23,14 @@ DEBUG_LOGGING_MAP = {
 
 @click.command()
 @click.option("--resource-group", help='name of the resource group hosting the acs-engine cluster')
+@click.option("--clusters-config", default=None,
+              help='JSON file listing several clusters to autoscale, '
+                   'the other options are used as defaults for each cluster')
 @click.option("--acs-deployment", help='name of the deployment in acs (default=azuredeploy)', default='azuredeploy')
 @click.option("--sleep", default=60, help='time in seconds between successive checks')
+@click.option("--maintenance-sleep", default=0,
+              help='time in seconds between successive maintenance checks (drain and deletion of idle agents), '
+                   'which then run apart from the scale-up checks. 0 checks both every --sleep seconds')
 @click.option("--kubeconfig", default=None,
               help='Full path to kubeconfig file. If not provided, '
                    'we assume that we\'re running on kubernetes.')
@@ -35,6 +46,21 @@ DEBUG_LOGGING_MAP = {
 @click.option("--no-scale", is_flag=True)
 @click.option("--over-provision", default=0)
 @click.option("--no-maintenance", is_flag=True)
+@click.option("--consolidate", is_flag=True,
+              help='drain busy nodes when their pods can be rescheduled on the rest of their pool')
+@click.option("--record-file", default=None,
+              help='file where the inputs of each loop are recorded, to be replayed with replay.py')
+@click.option("--state-file", default=None,
+              help='file where the idle time of nodes and the operations in flight are saved, '
+                   'to be reloaded after a restart')
+@click.option("--policy-file", default=None,
+              help='JSON file of per pool scaling policies (min/max size, max step, cooldowns, spare agents)')
+@click.option("--memory-watch", is_flag=True,
+              help='periodically log the allocations and object types which grew the most')
+@click.option("--memory-budget", default=0, help='RSS (in MB) above which a warning is logged')
+@click.option("--exit-on-memory-budget", is_flag=True, help='exit after the loop which exceeded the memory budget')
+@click.option("--memory-report-port", default=None, type=int,
+              help='serve the last memory report on http://127.0.0.1:<port>/memory, implies --memory-watch')
 @click.option("--ignore-pools", default='', help='list of pools that should be ignored by the autoscaler, delimited by a comma')
 @click.option("--slack-hook", default=None, envvar='SLACK_HOOK',
               help='Slack webhook URL. If provided, post scaling messages '
@@ -47,14 +73,19 @@ DEBUG_LOGGING_MAP = {
               count=True, default=2)
 #Debug mode will explicitly surface erros
 @click.option("--debug", is_flag=True) 
-def main(resource_group, acs_deployment, sleep, kubeconfig,
+def main(resource_group, clusters_config, acs_deployment, sleep, maintenance_sleep, kubeconfig,
          service_principal_app_id, service_principal_secret, subscription_id, 
          client_private_key, ca_private_key,
          service_principal_tenant_id, spare_agents, idle_threshold,
-         no_scale, over_provision, no_maintenance, ignore_pools, slack_hook,
+         no_scale, over_provision, no_maintenance, consolidate, record_file, state_file,
+         policy_file, memory_watch, memory_budget, exit_on_memory_budget, memory_report_port, ignore_pools, slack_hook,
          dry_run, verbose, debug):
     logger_handler = logging.StreamHandler(sys.stderr)
-    logger_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    if clusters_config or maintenance_sleep:
+        # log lines are attributed to clusters and loops through the name of the thread running them
+        logger_handler.setFormatter(logging.Formatter('%(asctime)s - %(threadName)s - %(name)s - %(levelname)s - %(message)s'))
+    else:
+        logger_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
     logger.addHandler(logger_handler)
     logger.setLevel(DEBUG_LOGGING_MAP.get(verbose, logging.CRITICAL))
 
@@ -74,30 +105,55 @@ def main(resource_group, acs_deployment, sleep, kubeconfig,
         notifier = Notifier(slack_hook)
 
     instance_init_time = 600
-    
-    cluster = Cluster(kubeconfig=kubeconfig,
-                      instance_init_time=instance_init_time,
-                      spare_agents=spare_agents,
-                      idle_threshold=idle_threshold,
-                      resource_group=resource_group,
-                      acs_deployment=acs_deployment,
-                      service_principal_app_id=service_principal_app_id,
-                      service_principal_secret=service_principal_secret,
-                      service_principal_tenant_id=service_principal_tenant_id,
-                      subscription_id=subscription_id,
-                      client_private_key=client_private_key,
-                      ca_private_key=ca_private_key,
-                      scale_up=not no_scale,
-                      ignore_pools=ignore_pools,
-                      maintainance=not no_maintenance,
-                      over_provision=over_provision,
+
+    credentials = dict(service_principal_app_id=service_principal_app_id,
+                       service_principal_secret=service_principal_secret,
+                       service_principal_tenant_id=service_principal_tenant_id,
+                       subscription_id=subscription_id)
+    options = dict(kubeconfig=kubeconfig,
+                   spare_agents=spare_agents,
+                   idle_threshold=idle_threshold,
+                   resource_group=resource_group,
+                   acs_deployment=acs_deployment,
+                   client_private_key=client_private_key,
+                   ca_private_key=ca_private_key,
+                   scale_up=not no_scale,
+                   ignore_pools=ignore_pools,
+                   maintainance=not no_maintenance,
+                   consolidate=consolidate,
+                   record_file=record_file,
+                   state_file=state_file,
+                   policy_file=policy_file,
+                   over_provision=over_provision,
+                   dry_run=dry_run)
+
+    watchdog = None
+    if memory_watch or memory_budget or memory_report_port is not None:
+        # the budget alone is checked from the RSS, without tracing the allocations
+        watchdog = MemoryWatchdog(budget=memory_budget * 2**20 or None, port=memory_report_port,
+                                  trace=memory_watch or memory_report_port is not None)
+        watchdog.start()
+
+    if clusters_config:
+        run_clusters(clusters_config, options, credentials, notifier, instance_init_time,
+                     sleep, maintenance_sleep, debug, watchdog, exit_on_memory_budget)
+        return
+
+    cluster = Cluster(instance_init_time=instance_init_time,
                       notifier=notifier,
-                      dry_run=dry_run,
-                      )
+                      **dict(credentials, **options))
     cluster.login()
+    if maintenance_sleep:
+        scheduler = Scheduler(max_workers=3, fail_fast=debug)
+        add_cluster_loops(scheduler, None, cluster, debug, sleep, maintenance_sleep)
+        run_scheduler(scheduler, sleep, watchdog, exit_on_memory_budget)
+        return
     backoff = sleep
     while True:
         scaled = cluster.loop(debug)
+        if watchdog and not watchdog.check() and exit_on_memory_budget:
+            logger.error('Exiting as the memory budget is exceeded')
+            sys.exit(1)
         if scaled:
             time.sleep(sleep)
             backoff = sleep
@@ -107,5 +163,67 @@ def main(resource_group, acs_deployment, sleep, kubeconfig,
             time.sleep(backoff)
 
 
+def run_cluster_loop(cluster, debug, phases=None):
+    with cluster.lock:
+        if cluster.api is None:
+            cluster.login()
+    if phases is None:
+        return cluster.loop(debug)
+    return cluster.loop(debug, phases)
+
+
+def add_cluster_loops(scheduler, name, cluster, debug, sleep, maintenance_sleep):
+    """
+    adds the loop of the cluster to the scheduler, or its scale-up and maintenance loops
+    when maintenance has its own interval
+    """
+    if not maintenance_sleep:
+        scheduler.add(name, functools.partial(run_cluster_loop, cluster, debug), sleep)
+        return
+    for phase, interval in ((SCALE_UP, sleep), (MAINTENANCE, maintenance_sleep)):
+        task_name = '{}/{}'.format(name, phase) if name else phase
+        scheduler.add(task_name, functools.partial(run_cluster_loop, cluster, debug, (phase,)), interval)
+
+
+def run_scheduler(scheduler, sleep, watchdog, exit_on_memory_budget):
+    over_budget = []
+    if watchdog:
+        def check_memory():
+            if not watchdog.check() and exit_on_memory_budget:
+                over_budget.append(True)
+                scheduler.stop()
+        scheduler.add('memory-watchdog', check_memory, sleep, delay=sleep)
+
+    scheduler.run()
+    if over_budget:
+        logger.error('Exiting as the memory budget is exceeded')
+        sys.exit(1)
+
+
+def run_clusters(clusters_config, defaults, credentials, notifier, instance_init_time,
+                 sleep, maintenance_sleep, debug, watchdog, exit_on_memory_budget):
+    """
+    runs the loops of all the clusters listed in clusters_config on a shared scheduler.
+    Clusters share the Azure clients, and a cluster failing only delays its own next loop
+    """
+    try:
+        targets = load_targets(clusters_config, dict(defaults, sleep=sleep))
+    except (IOError, ValueError) as e:
+        logger.error('Invalid clusters config {}: {}'.format(clusters_config, e))
+        sys.exit(1)
+
+    loops_per_cluster = 2 if maintenance_sleep else 1
+    scheduler = Scheduler(max_workers=min(len(targets) * loops_per_cluster, Config.CLUSTER_CONCURRENCY) + 1,
+                          fail_fast=debug)
+    for name, options, cluster_sleep in targets:
+        cluster = Cluster(instance_init_time=instance_init_time,
+                          notifier=notifier,
+                          **dict(credentials, **options))
+        add_cluster_loops(scheduler, name, cluster, debug, cluster_sleep, maintenance_sleep)
+        logger.info('Autoscaling cluster {} every {}s'.format(name, cluster_sleep))
+
+    run_scheduler(scheduler, sleep, watchdog, exit_on_memory_budget)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+import cProfile
+import json
+import logging
+import os.path
+import pstats
+import sys
+
+import click
+
+from autoscaler.recorder import read_snapshots, template_path
+from autoscaler.replay import replay_snapshot
+
+logger = logging.getLogger('autoscaler')
+
+DEBUG_LOGGING_MAP = {
+    0: logging.CRITICAL,
+    1: logging.WARNING,
+    2: logging.INFO,
+    3: logging.DEBUG
+}
+
+@click.command()
+@click.argument("record-file")
+@click.option("--template", default=None,
+              help='ARM template of the cluster (default=<record-file>.template.json). '
+                   'Without it, snapshots are replayed in dry run mode')
+@click.option("--snapshot", default=None, type=int, help='index of the only snapshot to replay')
+@click.option("--spare-agents", default=None, type=int)
+@click.option("--idle-threshold", default=None, type=int)
+@click.option("--over-provision", default=None, type=int)
+@click.option("--consolidate/--no-consolidate", default=None)
+@click.option("--profile", is_flag=True, help='print the functions the replay spent the most time in')
+@click.option('--verbose', '-v',
+              help="Sets the debug noise level, specify multiple times "
+                   "for more verbosity.",
+              type=click.IntRange(0, 3, clamp=True),
+              count=True, default=0)
+def main(record_file, template, snapshot, spare_agents, idle_threshold, over_provision,
+         consolidate, profile, verbose):
+    """
+    replays the loop snapshots recorded with --record-file, with the Azure and Kubernetes
+    calls stubbed, and prints the actions the autoscaler would have taken for each of them
+    """
+    logger_handler = logging.StreamHandler(sys.stderr)
+    logger_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(logger_handler)
+    logger.setLevel(DEBUG_LOGGING_MAP.get(verbose, logging.CRITICAL))
+
+    template = template or template_path(record_file)
+    arm_template = None
+    if os.path.exists(template):
+        with open(template) as f:
+            arm_template = json.load(f)
+    else:
+        logger.warn('No ARM template found, replaying in dry run mode')
+
+    profiler = cProfile.Profile() if profile else None
+    for i, recorded in enumerate(read_snapshots(record_file)):
+        if snapshot is not None and i != snapshot:
+            continue
+        if profiler:
+            profiler.enable()
+        actions = replay_snapshot(recorded, arm_template,
+                                  spare_agents=spare_agents,
+                                  idle_threshold=idle_threshold,
+                                  over_provision=over_provision,
+                                  consolidate=consolidate)
+        if profiler:
+            profiler.disable()
+        click.echo(json.dumps({'snapshot': i, 'time': recorded['time'], 'actions': actions}))
+
+    if profiler:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from autoscaler.arm_budget import ArmBudget, TokenBucket, READ, WRITE, SCALE_UP, ROUTINE, CLEANUP
+
+
+class ThrottlingArm(object):
+    """
+    local stand-in for ARM: allows a number of writes, then answers 429
+    """
+
+    def __init__(self, writes, retry_after=1):
+        self.remaining_writes = writes
+        self.retry_after = retry_after
+        self.calls = []
+
+    def write(self, name):
+        self.calls.append(name)
+        if self.remaining_writes <= 0:
+            return 429, {'Retry-After': str(self.retry_after),
+                         'x-ms-ratelimit-remaining-subscription-writes': '0'}
+        self.remaining_writes -= 1
+        return 200, {'x-ms-ratelimit-remaining-subscription-writes': str(self.remaining_writes)}
+
+
+class TestArmBudget(unittest.TestCase):
+    def call(self, budget, arm, name, priority):
+        budget.acquire(WRITE, priority)
+        budget.observe(*arm.write(name))
+
+    def wait_for_waiting_calls(self, budget, count):
+        while budget.metrics()['arm_waiting_calls'] < count:
+            time.sleep(0.001)
+
+    def test_token_bucket(self):
+        now = [0]
+        bucket = TokenBucket(rate=2, capacity=3, clock=lambda: now[0])
+        for _ in range(3):
+            self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 0.5)
+        now[0] = 0.5
+        self.assertEqual(bucket.take(), 0)
+        # a slower rate can be asked for
+        self.assertAlmostEqual(bucket.take(rate=0.1), 10)
+
+    def test_scale_up_goes_first(self):
+        arm = ThrottlingArm(writes=100)
+        budget = ArmBudget(write_rate=4, burst=1, low_watermark=0)
+        self.call(budget, arm, 'first', ROUTINE)
+
+        cleanup = threading.Thread(target=self.call, args=(budget, arm, 'cleanup', CLEANUP))
+        cleanup.start()
+        self.wait_for_waiting_calls(budget, 1)
+        scale_up = threading.Thread(target=self.call, args=(budget, arm, 'scale-up', SCALE_UP))
+        scale_up.start()
+        cleanup.join()
+        scale_up.join()
+
+        self.assertEqual(arm.calls, ['first', 'scale-up', 'cleanup'])
+        self.assertEqual(budget.metrics()['arm_remaining_writes'], 97)
+
+    def test_throttled(self):
+        arm = ThrottlingArm(writes=1, retry_after=1)
+        budget = ArmBudget(write_rate=100, burst=10, low_watermark=0)
+        self.call(budget, arm, 'allowed', SCALE_UP)
+        self.call(budget, arm, 'throttled', SCALE_UP)
+        self.assertEqual(budget.metrics()['arm_throttled_writes'], 1)
+        self.assertEqual(budget.metrics()['arm_throttled_reads'], 0)
+
+        arm.remaining_writes = 10
+        start = time.time()
+        self.call(budget, arm, 'after', SCALE_UP)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+        # reads aren't paused
+        start = time.time()
+        budget.acquire(READ)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_low_budget_kept_for_scale_up(self):
+        arm = ThrottlingArm(writes=5)
+        budget = ArmBudget(write_rate=100, burst=10, low_watermark=10, window=100)
+        self.call(budget, arm, 'routine', ROUTINE)
+        self.assertEqual(budget.remaining[WRITE], 4)
+
+        # cleanup is spread over the window: 4 calls per 100s
+        start = time.time()
+        cleanup = threading.Thread(target=budget.acquire, args=(WRITE, CLEANUP))
+        cleanup.daemon = True
+        for _ in range(9):
+            budget.acquire(WRITE, SCALE_UP)
+        cleanup.start()
+        cleanup.join(0.2)
+        self.assertTrue(cleanup.is_alive())
+        self.assertLess(time.time() - start, 1)
+        # until ARM reports a larger budget
+        budget.observe(200, {'x-ms-ratelimit-remaining-subscription-writes': '1000'})
+        cleanup.join(1)
+        self.assertFalse(cleanup.is_alive())
@@ -6,10 +6,15 @@ import yaml
 import collections
 import json
 import copy
+import time
 from datetime import datetime, timedelta
 import pykube
-from autoscaler.kube import KubePod, KubeNode, KubeResource
+from autoscaler.kube import KubePod, KubeNode, KubeResource, cordon_nodes
 import autoscaler.capacity as capacity
+from autoscaler.agent_pool import AgentPool
+from autoscaler.deployments import Deployments
+from autoscaler.fingerprint import LoopSkipper
+from autoscaler.label_index import LabelIndex
 
 class TestCluster(unittest.TestCase):
     def setUp(self):
@@ -70,5 +75,168 @@ class TestCluster(unittest.TestCase):
 
         act = self.cluster.get_pending_pods([pod, pod2, pod3], [node])
         #only one should fit
-        self.assertEqual(len(act), 2)  
-    
+        self.assertEqual(len(act), 2)
+
+    def test_get_pending_pods_many_nodes(self):
+        nodes = []
+        for i in range(20):
+            dummy_node = copy.deepcopy(self.dummy_node)
+            dummy_node['metadata']['name'] = 'k8s-agentpool1-16334397-{}'.format(i)
+            node = KubeNode(pykube.Node(self.api, dummy_node))
+            node.capacity = capacity.get_capacity_for_instance_type(node.instance_type)
+            nodes.append(node)
+        pods = [KubePod(pykube.Pod(self.api, self.dummy_pod)) for _ in range(100)]
+        fits_per_node = 0
+        used = KubeResource()
+        while (nodes[0].capacity - (used + pods[0].resources)).possible:
+            used += pods[0].resources
+            fits_per_node += 1
+
+        act = self.cluster.get_pending_pods(pods, nodes)
+        self.assertEqual(len(act), max(0, 100 - 20 * fits_per_node))
+        for node in nodes:
+            self.assertTrue(node.used_capacity.get('cpu') <= node.capacity.get('cpu'))
+
+    def test_learn_capacity(self):
+        nodes = []
+        for i in range(2):
+            dummy_node = copy.deepcopy(self.dummy_node)
+            dummy_node['metadata']['name'] = 'k8s-agentpool1-16334397-{}'.format(i)
+            nodes.append(KubeNode(pykube.Node(self.api, dummy_node)))
+        ds_pod = copy.deepcopy(self.dummy_ds_pod)
+        ds_pod['spec']['containers'][0]['resources'] = {'requests': {'cpu': '500m'}}
+        ds_pod = KubePod(pykube.Pod(self.api, ds_pod))
+        pod = KubePod(pykube.Pod(self.api, self.dummy_pod))
+
+        learner = capacity.CapacityLearner()
+        learner.learn(nodes, {nodes[0].name: [ds_pod, pod], nodes[1].name: [pod]})
+
+        learned = learner.get('Standard_D2_v2')
+        # the DaemonSet pod is accounted for, the workload pod isn't
+        self.assertEqual(learned.get('cpu'), 1.5)
+        self.assertEqual(learned.get('pods'), 29)
+        self.assertEqual(learned.get('memory'), nodes[0].allocatable.get('memory'))
+        # pools without nodes fall back to the capacity data
+        self.assertEqual(learner.get('Standard_NC6').raw,
+                         capacity.get_capacity_for_instance_type('Standard_NC6').raw)
+
+        pool = AgentPool('agentpool1', 'Standard_D2_v2', nodes, learned)
+        self.assertEqual(pool.unit_capacity.get('cpu'), 1.5)
+
+    def test_loop_skipper(self):
+        node = KubeNode(pykube.Node(self.api, copy.deepcopy(self.dummy_node)))
+        pod = KubePod(pykube.Pod(self.api, self.dummy_pod))
+        deployments = Deployments()
+        skipper = LoopSkipper(bucket=300)
+        now = datetime(2017, 1, 1, 0, 0, 10)
+
+        def should_skip(nodes, pods, now):
+            skip, fingerprint = skipper.should_skip(nodes, pods, deployments, now)
+            if not skip:
+                skipper.done(fingerprint)
+            return skip
+
+        self.assertFalse(should_skip([node], [pod], now))
+        self.assertTrue(should_skip([node], [pod], now + timedelta(seconds=60)))
+        # a new pending pod
+        other_pod = copy.deepcopy(self.dummy_pod)
+        other_pod['metadata']['uid'] = 'other'
+        other_pod = KubePod(pykube.Pod(self.api, other_pod))
+        self.assertFalse(should_skip([node], [pod, other_pod], now))
+        self.assertTrue(should_skip([node], [other_pod, pod], now))
+        # a cordoned node
+        cordoned = copy.deepcopy(self.dummy_node)
+        cordoned['spec']['unschedulable'] = True
+        self.assertFalse(should_skip([KubeNode(pykube.Node(self.api, cordoned))], [pod, other_pod], now))
+        self.assertFalse(should_skip([node], [pod, other_pod], now))
+        # a deployment in flight
+        deployments.requested_pool_sizes = {'agentpool1': 2}
+        self.assertFalse(should_skip([node], [pod, other_pod], now))
+        # time based transitions are checked at least once per bucket
+        self.assertFalse(should_skip([node], [pod, other_pod], now + timedelta(seconds=300)))
+        self.assertEqual((skipper.skipped, skipper.loops), (2, 8))
+        self.assertEqual(skipper.skip_rate, 0.25)
+
+    def test_get_pending_pods_with_selectors(self):
+        dummy_node = copy.deepcopy(self.dummy_node)
+        node = KubeNode(pykube.Node(self.api, dummy_node))
+        node.capacity = capacity.get_capacity_for_instance_type(node.instance_type)
+        pools = [AgentPool('agentpool1', 'Standard_D2_v2', [node]),
+                 AgentPool('agentpool2', 'Standard_NC6', [])]
+        label_index = LabelIndex([node], pools)
+
+        gpu_pod = copy.deepcopy(self.dummy_pod)
+        gpu_pod['spec']['nodeSelector'] = {'agentpool': 'agentpool2'}
+        pod = KubePod(pykube.Pod(self.api, self.dummy_pod))
+        gpu_pod = KubePod(pykube.Pod(self.api, gpu_pod))
+
+        self.assertEqual(label_index.matching_nodes(pod.selectors), set([node]))
+        self.assertEqual(label_index.matching_nodes(gpu_pod.selectors), set())
+        self.assertEqual(label_index.matching_pools(gpu_pod.selectors), set(['agentpool2']))
+        self.assertEqual(label_index.matching_pools({'role': 'agent'}), set(['agentpool1']))
+
+        act = self.cluster.get_pending_pods([pod, gpu_pod], [node], label_index)
+        self.assertEqual(act, [gpu_pod])
+
+    def test_standard_labels_of_empty_pools(self):
+        node = KubeNode(pykube.Node(self.api, copy.deepcopy(self.dummy_node)))
+        empty_pool = AgentPool('agentpool2', 'Standard_NC6', [])
+        empty_pool.location = 'southcentralus'
+        label_index = LabelIndex([node], [AgentPool('agentpool1', 'Standard_D2_v2', [node]), empty_pool])
+
+        # labels derived from the pool
+        self.assertEqual(label_index.matching_pools({'beta.kubernetes.io/arch': 'amd64'}),
+                         set(['agentpool1', 'agentpool2']))
+        self.assertEqual(label_index.matching_pools({'failure-domain.beta.kubernetes.io/region': 'westus'}),
+                         set())
+        # the zone of the nodes of an empty pool isn't known yet, it might match
+        selectors = {'agentpool': 'agentpool2', 'failure-domain.beta.kubernetes.io/zone': '1'}
+        self.assertEqual(label_index.matching_pools(selectors), set(['agentpool2']))
+
+        pod = copy.deepcopy(self.dummy_pod)
+        pod['spec']['nodeSelector'] = selectors
+        pod = KubePod(pykube.Pod(self.api, pod))
+        self.assertTrue(capacity.is_possible(pod, [empty_pool], label_index))
+
+    def test_fetch(self):
+        def slow_list(resource_group):
+            time.sleep(1)
+            return []
+
+        def failing_list(resource_group):
+            raise Exception('throttled')
+
+        with mock.patch('autoscaler.cluster.pykube') as kube, \
+                mock.patch('autoscaler.cluster.list_running_deployments', slow_list), \
+                mock.patch('autoscaler.cluster.list_virtual_machines', failing_list):
+            kube.Node.objects.return_value = ['node']
+            kube.Pod.objects.return_value = ['pod']
+            start = time.time()
+            results = self.cluster.fetch(deadline=0.2)
+            self.assertTrue(time.time() - start < 1)
+
+        self.assertEqual(results, {'nodes': ['node'], 'pods': ['pod']})
+
+    def test_cordon_nodes(self):
+        nodes = []
+        for i in range(3):
+            dummy_node = copy.deepcopy(self.dummy_node)
+            dummy_node['metadata']['name'] = 'k8s-agentpool1-16334397-{}'.format(i)
+            node = KubeNode(pykube.Node(self.api, dummy_node))
+            patched = copy.deepcopy(dummy_node)
+            patched['spec']['unschedulable'] = True
+            patched['metadata']['labels']['openai/cordoned-by-autoscaler'] = 'true'
+            node.original.api = mock.MagicMock()
+            node.original.api.patch.return_value.json.return_value = patched
+            node.original.reload = mock.MagicMock()
+            nodes.append(node)
+
+        results = cordon_nodes(nodes)
+        for node in nodes:
+            self.assertTrue(results[node])
+            self.assertTrue(node.unschedulable)
+            # a single PATCH, without reloading the node first
+            self.assertEqual(node.original.api.patch.call_count, 1)
+            node.original.reload.assert_not_called()
+            patch = json.loads(node.original.api.patch.call_args[1]['data'])
+            self.assertEqual(patch['spec'], {'unschedulable': True})
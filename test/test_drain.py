@@ -0,0 +1,42 @@
+import unittest
+import mock
+from unittest.mock import MagicMock
+
+from autoscaler.drain import drain_nodes
+
+
+class TestDrain(unittest.TestCase):
+    def create_pod(self, statuses, drainable=True, mirrored=False):
+        pod = MagicMock()
+        pod.is_drainable.return_value = drainable
+        pod.is_mirrored.return_value = mirrored
+        pod.evict.side_effect = statuses
+        pod.is_terminated.return_value = True
+        return pod
+
+    @mock.patch('autoscaler.drain.time.sleep')
+    def test_drain_nodes(self, sleep):
+        blocked_pod = self.create_pod([429, 429, 201])
+        pod = self.create_pod([201])
+        ds_pod = self.create_pod([201], mirrored=True)
+        critical_pod = self.create_pod([201], drainable=False)
+
+        results = drain_nodes({'node-0': [blocked_pod, ds_pod], 'node-1': [pod, critical_pod]})
+
+        # retried while the disruption budget blocked the eviction
+        self.assertEqual(blocked_pod.evict.call_count, 3)
+        self.assertEqual(pod.evict.call_count, 1)
+        ds_pod.evict.assert_not_called()
+        critical_pod.evict.assert_not_called()
+        self.assertListEqual(results['node-0'].evicted, [blocked_pod])
+        self.assertListEqual(results['node-1'].evicted, [pod])
+        self.assertTrue(results['node-0'].success)
+
+    @mock.patch('autoscaler.drain.time.sleep')
+    def test_drain_nodes_deadline(self, sleep):
+        pod = self.create_pod([201])
+        pod.is_terminated.return_value = False
+
+        results = drain_nodes({'node-0': [pod]}, timeout=0)
+        self.assertListEqual(results['node-0'].failed, [pod])
+        self.assertFalse(results['node-0'].success)
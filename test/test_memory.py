@@ -0,0 +1,49 @@
+import json
+import tracemalloc
+import unittest
+import urllib.request
+
+from autoscaler.memory import MemoryWatchdog
+
+
+class Leak(object):
+    pass
+
+
+class TestMemoryWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = MemoryWatchdog(interval=0, top=50, port=0)
+        self.watchdog.start()
+
+    def tearDown(self):
+        self.watchdog.stop()
+
+    def test_report(self):
+        leak = [Leak() for _ in range(10000)]
+        self.assertTrue(self.watchdog.check())
+
+        report = self.watchdog.report
+        self.assertTrue(report['rss'] > 0)
+        types = dict((t['type'], t['count_diff']) for t in report['top_types'])
+        self.assertTrue(types['Leak'] >= 10000)
+        self.assertTrue(any(__file__.rstrip('c') in a['location'] and a['size_diff'] > 0
+                            for a in report['top_allocations']))
+
+        url = 'http://127.0.0.1:{}/memory'.format(self.watchdog._server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(json.loads(response.read().decode())['rss'], report['rss'])
+        del leak
+
+    def test_budget(self):
+        self.watchdog.budget = 1
+        self.assertFalse(self.watchdog.check())
+        self.watchdog.budget = 2**50
+        self.assertTrue(self.watchdog.check())
+
+    def test_budget_without_tracing(self):
+        self.watchdog.stop()
+        self.watchdog = MemoryWatchdog(budget=1, interval=0, trace=False)
+        self.watchdog.start()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertFalse(self.watchdog.check())
+        self.assertIsNone(self.watchdog.report)
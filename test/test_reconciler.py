@@ -0,0 +1,50 @@
+import unittest
+
+import mock
+
+from autoscaler.reconciler import Reconciler, find_orphans
+
+
+class Resource(object):
+    def __init__(self, name, managed_by=None):
+        self.name = name
+        self.managed_by = managed_by
+
+
+class TestReconciler(unittest.TestCase):
+    def setUp(self):
+        self.vms = [Resource('k8s-agentpool1-16334397-0'), Resource('k8s-master-16334397-0')]
+        self.nics = ['k8s-agentpool1-16334397-nic-0', 'k8s-agentpool1-16334397-nic-1',
+                     'k8s-master-16334397-nic-1', 'k8s-agentpool2-16334397-nic-0']
+        self.disks = [
+            Resource('k8s-agentpool1-16334397-0-osdisk', managed_by='/subscriptions/vm0'),
+            Resource('k8s-agentpool1-16334397-1-osdisk'),
+            Resource('k8s-agentpool1-16334397-2_OsDisk_1_0a1b2c'),
+            Resource('k8s-agentpool1-16334397-3-osdisk', managed_by='/subscriptions/vm3'),
+            Resource('data-disk'),
+        ]
+
+    def test_find_orphans(self):
+        nics, disks = find_orphans([vm.name for vm in self.vms], self.nics, self.disks,
+                                   set(['agentpool1']))
+        self.assertEqual(nics, ['k8s-agentpool1-16334397-nic-1'])
+        self.assertEqual(disks, ['k8s-agentpool1-16334397-1-osdisk',
+                                 'k8s-agentpool1-16334397-2_OsDisk_1_0a1b2c'])
+
+    @mock.patch('autoscaler.reconciler.azure_api')
+    def test_reconcile(self, azure_api):
+        azure_api.list_network_interfaces.return_value = self.nics
+        azure_api.list_managed_disks.return_value = self.disks
+        reconciler = Reconciler('my-rg', interval=0)
+
+        # orphans are only deleted once confirmed by a second reconciliation
+        self.assertEqual(reconciler.reconcile(self.vms, [], set(['agentpool1'])), [])
+        azure_api.delete_network_interface.assert_not_called()
+
+        deleted = reconciler.reconcile(self.vms, [], set(['agentpool1']))
+        self.assertEqual(deleted, ['k8s-agentpool1-16334397-1-osdisk',
+                                   'k8s-agentpool1-16334397-2_OsDisk_1_0a1b2c',
+                                   'k8s-agentpool1-16334397-nic-1'])
+        azure_api.delete_network_interface.assert_called_once_with(
+            'my-rg', 'k8s-agentpool1-16334397-nic-1')
+        self.assertEqual(azure_api.delete_managed_disk.call_count, 2)
@@ -0,0 +1,228 @@
+import copy
+import datetime
+import json
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import pykube
+import yaml
+from dateutil.parser import parse as dateutil_parse
+
+from autoscaler.cluster import SCALE_UP, MAINTENANCE
+from autoscaler.deployments import Deployments
+from autoscaler.engine_scaler import EngineScaler
+from autoscaler.equivalence import group_pods
+from autoscaler.kube import KubeNode, KubePod
+from autoscaler.recorder import LoopRecorder, read_snapshots, REDACTED
+from autoscaler.replay import create_cluster, replay_snapshot, stubbed_calls
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(dir_path, 'data/busybox.yaml'), 'r') as f:
+            self.dummy_pod = yaml.load(f.read())
+        with open(os.path.join(dir_path, 'data/node.yaml'), 'r') as f:
+            self.dummy_node = yaml.load(f.read())
+            # match the JSON returned by the kubernetes API
+            self.dummy_node = json.loads(json.dumps(self.dummy_node, default=str))
+        with open(os.path.join(dir_path, 'data/azuredeploy.cluster.json'), 'r') as f:
+            self.template = json.load(f)
+        with open(os.path.join(dir_path, 'data/azuredeploy.cluster.parameters.json'), 'r') as f:
+            self.parameters = json.load(f)
+        self.parameters['servicePrincipalClientSecret'] = {'value': 'secret'}
+        self.tolerations = [{'key': 'gpu', 'operator': 'Exists', 'effect': 'NoSchedule'}]
+        self.dir = tempfile.mkdtemp()
+        self.config = {
+            'spare_agents': 1,
+            'idle_threshold': 60,
+            'over_provision': 0,
+            'ignore_pools': '',
+            'scale_up': False,
+            'maintainance': True,
+            'consolidate': False,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, path, pods=None, **kwargs):
+        nodes = []
+        for i in range(2):
+            node = copy.deepcopy(self.dummy_node)
+            node['metadata']['name'] = 'k8s-agentpool1-16334397-{}'.format(i)
+            node['spec'].pop('unschedulable', None)
+            nodes.append(node)
+        if pods is None:
+            pod = copy.deepcopy(self.dummy_pod)
+            pod['spec'].pop('nodeName')
+            pod['status']['phase'] = 'Succeeded'
+            pod['status']['conditions'] = [
+                {'type': 'PodScheduled', 'status': 'True', 'lastTransitionTime': '2016-08-23T21:22:30Z',
+                 'lastProbeTime': None},
+            ]
+            tolerating = copy.deepcopy(pod)
+            tolerating['metadata']['name'] = 'busybox-gpu'
+            tolerating['metadata']['uid'] = 'uid-gpu'
+            tolerating['spec']['tolerations'] = self.tolerations
+            pods = [pod, tolerating]
+
+        recorder = LoopRecorder(path, **kwargs)
+        recorder.record(nodes, pods, self.parameters, Deployments(), self.config,
+                        now=datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def test_record(self):
+        path = os.path.join(self.dir, 'loops.jsonl')
+        for _ in range(3):
+            self.record(path, max_bytes=1, backup_count=5)
+        self.assertTrue(os.path.exists(path + '.2'))
+
+        snapshots = list(read_snapshots(path))
+        self.assertEqual(len(snapshots), 3)
+        snapshot = snapshots[0]
+        self.assertEqual(len(snapshot['nodes']), 2)
+        self.assertEqual(snapshot['pods'][0]['spec']['containers'],
+                         [{'resources': {'requests': {'cpu': '1500m'}}}])
+        self.assertNotIn('volumes', snapshot['pods'][0]['spec'])
+        self.assertEqual(snapshot['pods'][1]['spec']['tolerations'], self.tolerations)
+        # the conditions the scheduling time and readiness of nodes are computed from
+        self.assertEqual(snapshot['pods'][0]['status']['conditions'], [
+            {'type': 'PodScheduled', 'status': 'True', 'lastTransitionTime': '2016-08-23T21:22:30Z'},
+        ])
+        node = KubeNode(pykube.Node(None, snapshot['nodes'][0]))
+        self.assertEqual(node.ready_time, dateutil_parse('2016-08-25T05:13:07Z'))
+        self.assertEqual([c['type'] for c in snapshot['nodes'][0]['status']['conditions']], ['Ready'])
+        # replays keep the tolerating pod in its own class, like the live autoscaler
+        pods = [KubePod(pykube.Pod(None, obj)) for obj in snapshot['pods']]
+        self.assertEqual(pods[0].scheduled_time, dateutil_parse('2016-08-23T21:22:30Z'))
+        self.assertEqual([len(c) for c in group_pods(pods)], [1, 1])
+        self.assertEqual(snapshot['arm_parameters']['servicePrincipalClientSecret']['value'], REDACTED)
+        self.assertFalse(snapshot['deployments']['in_progress'])
+
+    def test_replay_snapshot(self):
+        path = os.path.join(self.dir, 'loops.jsonl')
+        self.record(path)
+        snapshot = next(read_snapshots(path))
+
+        # one idle node is drained, the other one is kept as spare agent
+        actions = replay_snapshot(snapshot, self.template)
+        self.assertEqual(actions, [
+            ('cordon', ['k8s-agentpool1-16334397-0']),
+            ('drain', ['k8s-agentpool1-16334397-0']),
+        ])
+
+        # nothing is changed in dry run mode
+        self.assertEqual(replay_snapshot(snapshot), [])
+
+        # both nodes are kept as spare agents
+        self.assertEqual(replay_snapshot(snapshot, self.template, spare_agents=2), [])
+
+        # pool policies override the options
+        policies = {'pools': {'agentpool1': {'spare_agents': 0}}}
+        self.assertEqual(replay_snapshot(snapshot, self.template, policies=policies), [
+            ('cordon', ['k8s-agentpool1-16334397-0', 'k8s-agentpool1-16334397-1']),
+            ('drain', ['k8s-agentpool1-16334397-0', 'k8s-agentpool1-16334397-1']),
+        ])
+        policies = {'pools': {'agentpool1': {'spare_agents': 0, 'min_size': 2}}}
+        self.assertEqual(replay_snapshot(snapshot, self.template, policies=policies), [])
+
+    def test_loop_phases(self):
+        path = os.path.join(self.dir, 'loops.jsonl')
+        self.record(path)
+        snapshot = next(read_snapshots(path))
+        cluster = create_cluster(snapshot, self.template)
+        nodes = [pykube.Node(None, obj) for obj in snapshot['nodes']]
+        pods = [pykube.Pod(None, obj) for obj in snapshot['pods']]
+        now = dateutil_parse(snapshot['time'])
+
+        actions = []
+        with stubbed_calls(actions):
+            # scale-up loops leave idle nodes alone
+            self.assertTrue(cluster.process(nodes, pods, now=now, phases=(SCALE_UP,)))
+            self.assertEqual(actions, [])
+            self.assertTrue(cluster.process(nodes, pods, now=now, phases=(MAINTENANCE,)))
+        self.assertEqual(actions, [
+            ('cordon', ['k8s-agentpool1-16334397-0']),
+            ('drain', ['k8s-agentpool1-16334397-0']),
+        ])
+        # each phase is compared with its own previous loop
+        self.assertEqual(cluster.loop_skippers[(SCALE_UP,)].loops, 1)
+        self.assertEqual(cluster.loop_skippers[(MAINTENANCE,)].skipped, 0)
+
+    def test_maintenance_during_deployment(self):
+        path = os.path.join(self.dir, 'loops.jsonl')
+        self.config['scale_up'] = True
+        pods = []
+        for i in range(3):
+            pod = copy.deepcopy(self.dummy_pod)
+            pod['metadata']['name'] = 'busybox-{}'.format(i)
+            pod['metadata']['uid'] = 'uid-{}'.format(i)
+            pod['spec'].pop('nodeName')
+            pod['status'] = {'phase': 'Pending'}
+            pods.append(pod)
+        self.record(path, pods=pods)
+        snapshot = next(read_snapshots(path))
+        cluster = create_cluster(snapshot, self.template)
+        nodes = [pykube.Node(None, obj) for obj in snapshot['nodes']]
+        pods = [pykube.Pod(None, obj) for obj in snapshot['pods']]
+        now = dateutil_parse(snapshot['time'])
+
+        submitted = threading.Event()
+        finish = threading.Event()
+
+        def deploy_pools(scaler, new_pool_sizes):
+            submitted.set()
+            finish.wait(10)
+
+        def run(phase):
+            thread = threading.Thread(target=cluster.process, args=(nodes, pods),
+                                      kwargs={'now': now, 'phases': (phase,)})
+            thread.start()
+            return thread
+
+        actions = []
+        with stubbed_calls(actions), mock.patch.object(EngineScaler, 'deploy_pools', deploy_pools):
+            scale_up = run(SCALE_UP)
+            self.assertTrue(submitted.wait(10))
+            # the deployment is in flight, with the indexes of its nodes reserved
+            self.assertTrue(cluster.deployments.is_in_progress())
+            self.assertTrue(cluster.deployments.get_reserved_indexes('agentpool1'))
+
+            # maintenance isn't blocked by the deployment
+            maintenance = run(MAINTENANCE)
+            maintenance.join(10)
+            self.assertFalse(maintenance.is_alive())
+            self.assertTrue(scale_up.is_alive())
+            self.assertEqual(cluster.loop_skippers[(MAINTENANCE,)].loops, 1)
+
+            finish.set()
+            scale_up.join(10)
+        self.assertFalse(scale_up.is_alive())
+        self.assertFalse(cluster.deployments.is_in_progress())
+        self.assertEqual(cluster.deployments.get_reserved_indexes('agentpool1'), set())
+
+    def test_fill_min_size(self):
+        path = os.path.join(self.dir, 'loops.jsonl')
+        self.config['scale_up'] = True
+        self.record(path)
+        snapshot = next(read_snapshots(path))
+        nodes = [pykube.Node(None, obj) for obj in snapshot['nodes']]
+        pods = [pykube.Pod(None, obj) for obj in snapshot['pods']]
+        now = dateutil_parse(snapshot['time'])
+
+        # no pod is pending, the pool is still brought up to its min_size
+        deployed = []
+        policies = {'pools': {'agentpool1': {'min_size': 4}}}
+        cluster = create_cluster(snapshot, self.template, policies=policies)
+        with stubbed_calls([]), mock.patch.object(EngineScaler, 'deploy_pools',
+                                                  lambda scaler, sizes: deployed.append(sizes)):
+            cluster.process(nodes, pods, now=now, phases=(SCALE_UP,))
+            self.assertEqual([sizes['agentpool1'] for sizes in deployed], [4])
+
+            # nothing to do once the nodes are being created
+            cluster.process(nodes, pods, now=now + datetime.timedelta(seconds=600), phases=(SCALE_UP,))
+            self.assertEqual(len(deployed), 1)
@@ -10,6 +10,15 @@ import pykube
 from unittest.mock import MagicMock
 
 from autoscaler.kube import KubePod, KubeNode, KubeResource
+from autoscaler.scaler import ClusterNodeState
+from autoscaler.consolidation import plan_consolidation
+from autoscaler.state import ControllerState
+from autoscaler.deployments import Deployments
+from autoscaler.ledger import CapacityLedger
+from autoscaler.equivalence import group_pods, fit_count
+from autoscaler.template_processing import get_new_nodes_indexes
+from autoscaler.policy import PolicySet, PoolPolicy
+import autoscaler.capacity as capacity
 from utils import create_scaler
 
 class TestScaler(unittest.TestCase):
@@ -75,12 +84,265 @@ class TestScaler(unittest.TestCase):
         pod_2 = KubePod(pykube.Pod(self.api, dummy_pod_2))
         scaler.fulfill_pending([pod, pod_2])
         scaler.scale_pools.assert_called_with({'agentpool1': 3, 'agentpool2': 1})
-    
 
+    def test_fulfill_pending_pod_classes(self):
+        nodes = self.create_nodes(2,1)
+        scaler = create_scaler(nodes)
+        scaler.scale_pools = MagicMock()
+        scaler.tracker = MagicMock()
 
+        def create_pod(uid, cpu, tolerations=None):
+            dummy_pod = copy.deepcopy(self.dummy_pod)
+            dummy_pod['metadata']['uid'] = uid
+            dummy_pod['spec']['containers'][0]['resources']['requests']['cpu'] = cpu
+            if tolerations:
+                dummy_pod['spec']['tolerations'] = tolerations
+            return KubePod(pykube.Pod(self.api, dummy_pod))
 
-        
-        
+        small = [create_pod('small-{}'.format(i), '400m') for i in range(100)]
+        tolerating = [create_pod('tolerating-{}'.format(i), '400m', [{'key': 'gpu', 'operator': 'Exists'}])
+                      for i in range(3)]
+        large = [create_pod('large-{}'.format(i), '1500m') for i in range(2)]
+        pods = small + large + tolerating
+        classes = group_pods(pods)
+        self.assertEqual([len(c) for c in classes], [100, 2, 3])
+        self.assertEqual(fit_count({'cpu': 2.0, 'pods': 10}, {'cpu': 0.4, 'pods': 1}, 100), 5)
+        self.assertEqual(fit_count({'cpu': 2.0, 'pods': 3}, {'cpu': 0.4, 'pods': 1}, 100), 3)
+
+        scaler.fulfill_pending(pods)
+        self.assertEqual(fit_count(scaler.agent_pools[0].unit_capacity.raw, small[0].resources.raw, 1000), 5)
+        # 20 nodes for the small pods, 2 for the large ones, which also take 2 of the tolerating pods,
+        # and one for the last tolerating pod
+        scaler.scale_pools.assert_called_with({'agentpool1': 24, 'agentpool2': 1})
+        decisions = scaler.tracker.scale_decided.call_args[0][0]
+        self.assertEqual(len(decisions), len(pods))
+
+    def test_fulfill_pending_policies(self):
+        nodes = self.create_nodes(2,1)
+        scaler = create_scaler(nodes)
+        scaler.scale_pools = MagicMock()
+        scaler.state = ControllerState()
+        scaler.now = datetime.now(nodes[0].creation_time.tzinfo)
+        scaler.policies = PolicySet(pools={
+            'agentpool1': PoolPolicy(max_step_up=1),
+            'agentpool2': PoolPolicy(scale_up_cooldown=600),
+        })
+        scaler.state.record_scale('agentpool2', 'up', scaler.now - timedelta(seconds=60))
+
+        # each pod needs its own node, agentpool1 can only grow by one and agentpool2 is cooling down
+        pods = []
+        for i in range(3):
+            dummy_pod = copy.deepcopy(self.dummy_pod)
+            dummy_pod['metadata']['uid'] = 'pod-{}'.format(i)
+            pods.append(KubePod(pykube.Pod(self.api, dummy_pod)))
+        scaler.fulfill_pending(pods)
+        scaler.scale_pools.assert_called_with({'agentpool1': 2, 'agentpool2': 1})
+        self.assertEqual(sorted((c['pool'], c['policy']) for c in scaler.clamped),
+                         [('agentpool1', 'max_step_up'), ('agentpool2', 'scale_up_cooldown')])
+
+    def test_fulfill_pending_in_flight(self):
+        nodes = self.create_nodes(2,1)
+        now = nodes[0].creation_time + timedelta(days=1)
+        ledger = CapacityLedger(ttl=600)
+        ledger.request('agentpool1', [1], now)
+        scaler = create_scaler(nodes)
+        scaler.ledger = ledger
+        scaler.agent_pools, scaler.scalable_pools = scaler.get_agent_pools(nodes)
+        scaler.scale_pools = MagicMock()
+
+        # the pod fits on the node being created
+        pod = KubePod(pykube.Pod(self.api, self.dummy_pod))
+        scaler.fulfill_pending([pod])
+        scaler.scale_pools.assert_called_with({'agentpool1': 1, 'agentpool2': 1})
+
+        # the second pod needs one more node
+        dummy_pod_2 = copy.deepcopy(self.dummy_pod)
+        dummy_pod_2['metadata']['uid'] = 'fake'
+        pod_2 = KubePod(pykube.Pod(self.api, dummy_pod_2))
+        scaler.fulfill_pending([pod, pod_2])
+        scaler.scale_pools.assert_called_with({'agentpool1': 3, 'agentpool2': 1})
+        self.assertEqual(get_new_nodes_indexes(scaler.agent_pools[0], 3), [2])
+
+        # the node registered
+        ledger.settle(self.create_nodes(1, 2), now)
+        self.assertEqual(ledger.requested_indexes('agentpool1'), set())
+        # requests expire
+        ledger.request('agentpool1', [5], now)
+        ledger.settle(nodes, now + timedelta(seconds=601))
+        self.assertEqual(ledger.summary(), {})
+
+    def test_retry_failed_deployment(self):
+        nodes = self.create_nodes(2,1)
+        deployments = Deployments()
+        ledger = CapacityLedger()
+
+        def create():
+            scaler = create_scaler(nodes)
+            scaler.deployments = deployments
+            scaler.ledger = ledger
+            scaler.agent_pools, scaler.scalable_pools = scaler.get_agent_pools(nodes)
+            scaler.scale_pools({'agentpool1': 3, 'agentpool2': 1})
+            return scaler
+
+        scaler = create()
+        self.assertEqual(scaler.scale_out, {'agentpool1': 3, 'agentpool2': 1})
+        self.assertEqual(ledger.requested_indexes('agentpool1'), set([1, 2]))
+        scaler.deploy_pools = MagicMock(side_effect=ValueError('deployment failed'))
+        with self.assertRaises(ValueError):
+            scaler.apply_scale_up()
+        self.assertEqual(ledger.summary(), {})
+
+        # the next loop requests the nodes again
+        scaler = create()
+        self.assertEqual(scaler.scale_out, {'agentpool1': 3, 'agentpool2': 1})
+        self.assertEqual(scaler.in_flight_count(scaler.agent_pools[0]), 0)
+
+    def test_skipped_scale_up(self):
+        nodes = self.create_nodes(2,1)
+        scaler = create_scaler(nodes)
+        scaler.deployments = Deployments()
+        scaler.state = ControllerState()
+        scaler.now = nodes[0].creation_time + timedelta(days=1)
+
+        # the same pool sizes were requested already, the cooldowns don't restart
+        scaler.deployments.requested_pool_sizes = {'agentpool1': 2, 'agentpool2': 1}
+        scaler.scale_pools({'agentpool1': 2, 'agentpool2': 1})
+        self.assertIsNone(scaler.scale_out)
+        self.assertIsNone(scaler.state.last_scale('agentpool1', 'up'))
+
+        scaler.scale_pools({'agentpool1': 3, 'agentpool2': 1})
+        self.assertEqual(scaler.scale_out, {'agentpool1': 3, 'agentpool2': 1})
+        self.assertEqual(scaler.state.last_scale('agentpool1', 'up'), scaler.now)
+
+    def test_delete_node(self):
+        nodes = self.create_nodes(2,1)
+        scaler = create_scaler(nodes)
+        scaler.deployments = Deployments()
+        scaler.ledger = CapacityLedger()
+        with mock.patch('autoscaler.engine_scaler.delete_resources_for_node') as delete:
+            scaler.delete_node(scaler.agent_pools[0], nodes[0], mock.MagicMock())
+        delete.assert_called_once()
+        # the pool of the node is the one shrinking
+        self.assertEqual(scaler.deployments.requested_pool_sizes, {'agentpool1': 0, 'agentpool2': 1})
+        self.assertTrue(scaler.ledger.is_removing(nodes[0]))
+        self.assertEqual(scaler.ledger.summary(), {'agentpool1': {'adding': 0, 'removing': 1}})
+        # until the node is gone
+        scaler.ledger.settle(nodes[1:])
+        self.assertFalse(scaler.ledger.is_removing(nodes[0]))
+
+    def test_pool_policy(self):
+        now = datetime.now()
+        policy = PoolPolicy(min_size=1, max_size=5, max_step_up=2, max_step_down=1,
+                            scale_up_cooldown=300, scale_down_cooldown=600)
+        self.assertEqual(policy.clamp_scale_up(0, 0), (1, 'min_size'))
+        self.assertEqual(policy.clamp_scale_up(2, 3), (3, None))
+        self.assertEqual(policy.clamp_scale_up(2, 8), (4, 'max_step_up'))
+        self.assertEqual(policy.clamp_scale_up(4, 8), (5, 'max_size'))
+        self.assertEqual(policy.clamp_scale_up(2, 3, now - timedelta(seconds=60), now),
+                         (2, 'scale_up_cooldown'))
+        self.assertEqual(policy.clamp_scale_up(2, 3, now - timedelta(seconds=301), now), (3, None))
+        # topping up to min_size bypasses the cooldown and max_step_up
+        floor = PoolPolicy(min_size=4, max_size=10, max_step_up=1, scale_up_cooldown=300)
+        self.assertEqual(floor.clamp_scale_up(0, 2, now - timedelta(seconds=60), now), (4, 'min_size'))
+        self.assertEqual(floor.clamp_scale_up(0, 4, now - timedelta(seconds=60), now), (4, None))
+        self.assertEqual(floor.clamp_scale_up(0, 8, now - timedelta(seconds=60), now), (5, 'max_step_up'))
+        self.assertEqual(floor.clamp_scale_up(4, 8, now - timedelta(seconds=60), now),
+                         (4, 'scale_up_cooldown'))
+
+        self.assertEqual(policy.allowed_scale_down(4), (1, 'max_step_down'))
+        self.assertEqual(policy.allowed_scale_down(1), (0, 'min_size'))
+        self.assertEqual(policy.allowed_scale_down(4, None, now - timedelta(seconds=60), now),
+                         (0, 'scale_down_cooldown'))
+
+        policies = PolicySet.from_dict({'default': {'max_step_up': 3},
+                                        'pools': {'gpupool': {'max_size': 4}}})
+        self.assertEqual(policies.get('gpupool').max_step_up, 3)
+        self.assertEqual(policies.get('gpupool').max_size, 4)
+        self.assertEqual(policies.get('cpupool').max_size, 100)
+        with self.assertRaises(ValueError):
+            PolicySet.from_dict({'pools': {'gpupool': {'max': 4}}})
+
+    def test_get_pool_node_states(self):
+        nodes = self.create_nodes(1, 3)
+        for node in nodes:
+            node.capacity = capacity.get_capacity_for_instance_type(node.instance_type)
+        scaler = create_scaler(nodes)
+        pool = scaler.agent_pools[0]
+
+        busy_pod = copy.deepcopy(self.dummy_pod)
+        busy_pod['spec']['nodeName'] = nodes[0].name
+        small_pod = copy.deepcopy(self.dummy_pod)
+        small_pod['metadata']['uid'] = 'small'
+        small_pod['spec']['nodeName'] = nodes[1].name
+        small_pod['spec']['containers'][0]['resources']['requests']['cpu'] = '100m'
+        pods_by_node = {
+            nodes[0].name: [KubePod(pykube.Pod(self.api, busy_pod))],
+            nodes[1].name: [KubePod(pykube.Pod(self.api, small_pod))],
+        }
+
+        states = scaler.get_pool_node_states(pool, pods_by_node, [])
+        self.assertEqual(states[nodes[0]], ClusterNodeState.BUSY)
+        # busybox isn't replicated, so it can't be drained
+        self.assertEqual(states[nodes[1]], ClusterNodeState.UNDER_UTILIZED_UNDRAINABLE)
+        self.assertEqual(states[nodes[2]], ClusterNodeState.UNDER_UTILIZED_DRAINABLE)
+        for node in nodes:
+            self.assertEqual(states[node], scaler.get_node_state(
+                node, pods_by_node.get(node.name, []), []))
+
+    def test_idle_time(self):
+        nodes = self.create_nodes(1, 1)
+        for node in nodes:
+            node.capacity = capacity.get_capacity_for_instance_type(node.instance_type)
+        scaler = create_scaler(nodes)
+        scaler.idle_threshold = 600
+        scaler.state = ControllerState()
+        pool = scaler.agent_pools[0]
+        now = datetime.now(nodes[0].creation_time.tzinfo)
+
+        # the node is old, but only started being idle now
+        scaler.now = now
+        states = scaler.get_pool_node_states(pool, {}, [])
+        self.assertEqual(states[nodes[0]], ClusterNodeState.GRACE_PERIOD)
+
+        # the idle time survives a restart
+        state = ControllerState.from_dict(scaler.state.to_dict())
+        self.assertEqual(state.idle_since, {nodes[0].name: now})
+        scaler.state = state
+        scaler.now = now + timedelta(seconds=601)
+        states = scaler.get_pool_node_states(pool, {}, [])
+        self.assertEqual(states[nodes[0]], ClusterNodeState.UNDER_UTILIZED_DRAINABLE)
+
+        # busy nodes are not idle anymore
+        busy_pod = copy.deepcopy(self.dummy_pod)
+        busy_pod['spec']['nodeName'] = nodes[0].name
+        pods_by_node = {nodes[0].name: [KubePod(pykube.Pod(self.api, busy_pod))]}
+        states = scaler.get_pool_node_states(pool, pods_by_node, [])
+        self.assertEqual(states[nodes[0]], ClusterNodeState.BUSY)
+        self.assertEqual(state.idle_since, {})
+
+    def test_plan_consolidation(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(dir_path, 'data/rc-pod.yaml'), 'r') as f:
+            dummy_rc_pod = yaml.load(f.read())
+        nodes = self.create_nodes(1, 3)
+        pods_by_node = {}
+        for i, cpu in enumerate(['1000m', '500m', '600m']):
+            node = nodes[i]
+            node.capacity = capacity.get_capacity_for_instance_type(node.instance_type)
+            rc_pod = copy.deepcopy(dummy_rc_pod)
+            rc_pod['metadata']['uid'] = 'rc-{}'.format(i)
+            rc_pod['spec']['nodeName'] = node.name
+            rc_pod['spec'].pop('nodeSelector')
+            rc_pod['spec']['containers'][0]['resources']['requests']['cpu'] = cpu
+            pod = KubePod(pykube.Pod(self.api, rc_pod))
+            node.count_pod(pod)
+            pods_by_node[node.name] = [pod]
+        scaler = create_scaler(nodes)
+        pool = scaler.agent_pools[0]
 
+        # the 500m pod fits next to the 1000m one, then the 600m pod doesn't fit anywhere
+        removable = plan_consolidation(pool, nodes, pods_by_node, 2)
+        self.assertListEqual(removable, [nodes[1]])
 
-        
\ No newline at end of file
+        removable = plan_consolidation(pool, nodes, pods_by_node, 0)
+        self.assertListEqual(removable, [])
@@ -0,0 +1,92 @@
+import json
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+from autoscaler.multi_cluster import load_targets
+from autoscaler.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_run(self):
+        scheduler = Scheduler(max_workers=2)
+        calls = {'ok': 0, 'failing': 0}
+        done = threading.Event()
+
+        def ok():
+            calls['ok'] += 1
+            if calls['ok'] == 5:
+                done.set()
+            return True
+
+        def failing():
+            calls['failing'] += 1
+            raise Exception('cluster unreachable')
+
+        scheduler.add('ok', ok, 0.01)
+        failing_task = scheduler.add('failing', failing, 0.01, max_backoff=10)
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        self.assertTrue(done.wait(5))
+        scheduler.stop()
+        thread.join()
+
+        # the failing task backs off without preventing the other one from running
+        self.assertTrue(calls['ok'] >= 5)
+        self.assertTrue(1 <= calls['failing'] < calls['ok'])
+        self.assertEqual(failing_task.failures, calls['failing'])
+        self.assertTrue(failing_task.delay > 0.01)
+        self.assertEqual(scheduler.tasks['ok'].consecutive_failures, 0)
+
+    def test_fail_fast(self):
+        scheduler = Scheduler(max_workers=2, fail_fast=True)
+        calls = {'ok': 0}
+
+        def ok():
+            calls['ok'] += 1
+
+        def failing():
+            raise ValueError('cluster unreachable')
+
+        scheduler.add('ok', ok, 0.01)
+        scheduler.add('failing', failing, 0.01, delay=0.05)
+        # the first exception stops the scheduler, like --debug in the single cluster loop
+        with self.assertRaises(ValueError):
+            scheduler.run()
+        self.assertTrue(calls['ok'] >= 1)
+
+
+class TestMultiCluster(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'clusters.json')
+        self.defaults = {'resource_group': None, 'kubeconfig': None, 'spare_agents': 1, 'sleep': 60}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, config):
+        with open(self.path, 'w') as f:
+            json.dump(config, f)
+        return load_targets(self.path, self.defaults)
+
+    def test_load_targets(self):
+        targets = self.load({'clusters': [
+            {'resource_group': 'k8s-eu', 'kubeconfig': '/etc/kube/eu'},
+            {'name': 'us', 'resource_group': 'k8s-us', 'kubeconfig': '/etc/kube/us',
+             'spare_agents': 2, 'sleep': 10},
+        ]})
+        self.assertEqual(targets, [
+            ('k8s-eu', {'resource_group': 'k8s-eu', 'kubeconfig': '/etc/kube/eu', 'spare_agents': 1}, 60),
+            ('us', {'resource_group': 'k8s-us', 'kubeconfig': '/etc/kube/us', 'spare_agents': 2}, 10),
+        ])
+
+        with self.assertRaises(ValueError):
+            self.load({'clusters': [{'resource_group': 'k8s-eu'}]})
+        with self.assertRaises(ValueError):
+            self.load({'clusters': [{'resource_group': 'k8s-eu', 'kubeconfig': 'a', 'spare_agent': 2}]})
+        with self.assertRaises(ValueError):
+            self.load({'clusters': [{'resource_group': 'k8s-eu', 'kubeconfig': 'a', 'state_file': 's'},
+                                    {'resource_group': 'k8s-us', 'kubeconfig': 'b', 'state_file': 's'}]})
@@ -0,0 +1,106 @@
+import copy
+import os.path
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import pykube
+import yaml
+
+from autoscaler.deployments import Deployments
+from autoscaler.kube import KubePod, KubeNode
+from autoscaler.slo import Histogram, SchedulingTracker
+
+
+def iso(time):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class TestSchedulingTracker(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(dir_path, 'data/busybox.yaml'), 'r') as f:
+            self.dummy_pod = yaml.load(f.read())
+        with open(os.path.join(dir_path, 'data/node.yaml'), 'r') as f:
+            self.dummy_node = yaml.load(f.read())
+        self.api = pykube.HTTPClient(pykube.KubeConfig.from_file(os.path.join(dir_path, './data/kube_config.yaml')))
+        self.start = datetime(2017, 1, 1, tzinfo=timezone.utc)
+
+    def at(self, seconds):
+        return self.start + timedelta(seconds=seconds)
+
+    def create_pod(self, node_name=None, scheduled=None):
+        pod = copy.deepcopy(self.dummy_pod)
+        pod['metadata']['creationTimestamp'] = iso(self.start)
+        pod['spec']['nodeName'] = node_name
+        pod['status']['phase'] = 'Running' if node_name else 'Pending'
+        pod['status']['conditions'] = []
+        if scheduled is not None:
+            pod['status']['conditions'].append(
+                {'type': 'PodScheduled', 'status': 'True', 'lastTransitionTime': iso(scheduled)})
+        return KubePod(pykube.Pod(self.api, pod))
+
+    def create_node(self, name, created, ready):
+        node = copy.deepcopy(self.dummy_node)
+        node['metadata']['name'] = name
+        node['metadata']['creationTimestamp'] = iso(created)
+        node['status']['conditions'] = [
+            {'type': 'Ready', 'status': 'True', 'lastTransitionTime': iso(ready)}]
+        return KubeNode(pykube.Node(self.api, node))
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(10, 60, float('inf')))
+        for value in (1, 2, 30, 100):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.percentile(50), 10)
+        self.assertEqual(histogram.percentile(75), 60)
+        self.assertEqual(histogram.percentile(99), float('inf'))
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_scale_up(self):
+        tracker = SchedulingTracker()
+        deployments = Deployments(tracker=tracker)
+        existing = self.create_node('k8s-agentpool1-16334397-0', self.at(-3600), self.at(-3600))
+
+        pod = self.create_pod()
+        self.assertEqual(tracker.observe([pod], [existing], self.at(20)), 0)
+        tracker.scale_decided({pod: 'agentpool1'})
+        tracker.now = self.at(25)
+
+        def deploy():
+            tracker.now = self.at(100)
+        deployments.deploy(deploy, {'agentpool1': 2})
+        self.assertEqual(tracker.report()['agentpool1']['deployment']['sum'], 75)
+
+        # the new node registers, is ready and the pod is scheduled on it
+        new = self.create_node('k8s-agentpool1-16334397-1', self.at(200), self.at(290))
+        scheduled = self.create_pod(new.name, self.at(300))
+        self.assertEqual(tracker.observe([scheduled], [existing, new], self.at(320)), 1)
+
+        report = tracker.report()['agentpool1']
+        self.assertEqual(report['detection']['sum'], 20)
+        self.assertEqual(report['decision']['sum'], 0)
+        self.assertEqual(report['submission']['sum'], 5)
+        self.assertEqual(report['registration']['sum'], 175)
+        self.assertEqual(report['bootstrap']['sum'], 90)
+        self.assertEqual(report['binding']['sum'], 10)
+        self.assertEqual(report['total']['sum'], 300)
+
+    def test_existing_capacity(self):
+        tracker = SchedulingTracker()
+        node = self.create_node('k8s-agentpool1-16334397-0', self.at(-3600), self.at(-3600))
+        tracker.observe([self.create_pod()], [node], self.at(10))
+        tracker.observe([self.create_pod(node.name, self.at(12))], [node], self.at(40))
+
+        report = tracker.report()['agentpool1']
+        self.assertEqual(report['binding']['sum'], 2)
+        self.assertEqual(report['total']['sum'], 12)
+        self.assertNotIn('registration', report)
+
+    def test_forget_deleted_pods(self):
+        tracker = SchedulingTracker()
+        node = self.create_node('k8s-agentpool1-16334397-0', self.at(0), self.at(0))
+        tracker.observe([self.create_pod()], [node], self.at(10))
+        tracker.observe([], [node], self.at(40))
+        tracker.observe([self.create_pod(node.name, self.at(50))], [node], self.at(60))
+        self.assertEqual(tracker.report(), {})
@@ -0,0 +1,60 @@
+import datetime
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from autoscaler.deployments import Deployments
+from autoscaler.state import ControllerState
+
+
+class TestControllerState(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_checkpoint(self):
+        now = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+        state = ControllerState(self.path)
+        state.set_idle('k8s-agentpool1-16334397-0', True, now)
+        state.set_idle('k8s-agentpool1-16334397-1', True, now)
+        state.start_drain('k8s-agentpool1-16334397-1', now)
+        state.start_operation('deletion', 'k8s-agentpool1-16334397-2', {'pool': 'agentpool1'}, now)
+        state.retain(['k8s-agentpool1-16334397-0', 'k8s-agentpool1-16334397-1'])
+        state.save()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        reloaded = ControllerState(self.path)
+        self.assertEqual(reloaded.idle_since, {
+            'k8s-agentpool1-16334397-0': now,
+            'k8s-agentpool1-16334397-1': now,
+        })
+        self.assertEqual(reloaded.drain_started, {'k8s-agentpool1-16334397-1': now})
+        self.assertEqual(reloaded.get_operations('deletion'), {})
+        self.assertEqual(reloaded.idle_duration('k8s-agentpool1-16334397-0',
+                                                now + datetime.timedelta(seconds=60)), 60)
+
+    def test_in_flight_deployment(self):
+        state = ControllerState(self.path)
+        deployments = Deployments(state)
+        deployments.deploy(lambda: ControllerState(self.path).get_operations('deployment'),
+                           {'agentpool1': 3})
+        # the deployment was checkpointed while in flight
+        self.assertIn('scale-out', deployments._current_deployment)
+        self.assertEqual(state.get_operations('deployment'), {})
+
+        state.start_operation('deployment', 'scale-out', {'pool_sizes': {'agentpool1': 4}})
+        state = ControllerState(self.path)
+        deployments = Deployments(state)
+        self.assertEqual(deployments.requested_pool_sizes, {'agentpool1': 4})
+        # the restored deployment, without reserved indexes, finishes once ARM doesn't list it
+        deployments.set_running_deployments(['autoscaler-deployment-1234'])
+        self.assertTrue(deployments.is_in_progress())
+        self.assertEqual(deployments.requested_pool_sizes, {'agentpool1': 4})
+        deployments.set_running_deployments([])
+        self.assertFalse(deployments.is_in_progress())
+        self.assertIsNone(deployments.requested_pool_sizes)
+        self.assertEqual(state.get_operations('deployment'), {})
@@ -11,6 +11,8 @@ from autoscaler.utils import get_arm_template
 import autoscaler.template_processing as template_processing
 from autoscaler.kube import KubeNode
 from autoscaler.scaler import Scaler
+from autoscaler.deployments import Deployments
+from autoscaler.prerender import TemplatePrerenderer
 from utils import create_scaler
 
 class TestTemplateProcessing(unittest.TestCase):
@@ -86,4 +88,134 @@ class TestTemplateProcessing(unittest.TestCase):
         pools, _ = scaler.get_agent_pools([node2])
         pool = pools[0]
         new_idxs = template_processing.get_new_nodes_indexes(pool, 5)
-        self.assertListEqual(new_idxs, [0, 1, 3, 4])
\ No newline at end of file
+        self.assertListEqual(new_idxs, [0, 1, 3, 4])
+
+    def test_get_new_node_indexes_with_reservations(self):
+        deployments = Deployments()
+        scaler = create_scaler([])
+        scaler.deployments = deployments
+        node0 = self.create_node('agentpool1', 0)
+        node2 = self.create_node('agentpool1', 2)
+
+        # node 1 is being created, it counts towards the size of the pool
+        deployments.reserve_indexes('agentpool1', [1])
+        pools, _ = scaler.get_agent_pools([node0, node2])
+        pool = pools[0]
+        self.assertListEqual(template_processing.get_new_nodes_indexes(pool, 3), [])
+        self.assertListEqual(template_processing.get_new_nodes_indexes(pool, 5), [3, 4])
+
+        # node 1 registered, but the deployment is still running
+        pools, _ = scaler.get_agent_pools([node0, self.create_node('agentpool1', 1), node2])
+        pool = pools[0]
+        self.assertListEqual(template_processing.get_new_nodes_indexes(pool, 5), [3, 4])
+
+        # reservations are released whether the deployment succeeds or fails
+        deployments.deploy(lambda: None, {'agentpool1': 3})
+        self.assertEqual(deployments.get_reserved_indexes('agentpool1'), set())
+        deployments.reserve_indexes('agentpool1', [1])
+
+        def fail():
+            raise ValueError('deployment failed')
+        with self.assertRaises(ValueError):
+            deployments.deploy(fail, {'agentpool1': 4})
+        self.assertEqual(deployments.get_reserved_indexes('agentpool1'), set())
+        # the same sizes can be requested again
+        self.assertEqual(deployments.requested_pool_sizes, {'agentpool1': 3})
+
+    def test_minimize_template(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        template = get_arm_template(os.path.join(dir_path, './data/azuredeploy.cluster.json'), None)
+        parameters = get_arm_template(os.path.join(dir_path, './data/azuredeploy.cluster.parameters.json'), None)
+        scaler = create_scaler([])
+        node0 = self.create_node('agentpool1', 0)
+        pools, _ = scaler.get_agent_pools([node0])
+
+        new_template = template_processing.prepare_template_for_scale_out(
+            template, pools, {'agentpool1': 3, 'agentpool2': 0})
+        types = sorted(r['type'] for r in new_template['resources'])
+        self.assertListEqual(types, [
+            'Microsoft.Compute/availabilitySets',
+            'Microsoft.Compute/virtualMachines',
+            'Microsoft.Compute/virtualMachines',
+            'Microsoft.Compute/virtualMachines/extensions',
+            'Microsoft.Compute/virtualMachines/extensions',
+            'Microsoft.Network/networkInterfaces',
+            'Microsoft.Network/networkInterfaces',
+            'Microsoft.Storage/storageAccounts'])
+        for resource in new_template['resources']:
+            for dependency in resource.get('dependsOn', []):
+                self.assertNotIn('vnetID', dependency)
+                self.assertNotIn('masterPublicIPAddressName', dependency)
+        self.assertNotIn('masterLbName', new_template['variables'])
+        self.assertNotIn('agentpool2Count', new_template['parameters'])
+
+        new_parameters = template_processing.prune_parameters(new_template, parameters)
+        self.assertIn('agentpool1Count', new_parameters)
+        self.assertNotIn('agentpool2Count', new_parameters)
+        self.assertNotIn('masterVMSize', new_parameters)
+        # variables are referenced case insensitively (tenantID vs tenantId)
+        self.assertIn('tenantId', new_template['variables'])
+        template_processing.validate_template(new_template, new_parameters)
+
+    def test_validate_template(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        template = get_arm_template(os.path.join(dir_path, './data/azuredeploy.cluster.json'), None)
+        parameters = get_arm_template(os.path.join(dir_path, './data/azuredeploy.cluster.parameters.json'), None)
+        scaler = create_scaler([])
+        pools, _ = scaler.get_agent_pools([self.create_node('agentpool1', 0)])
+        new_template = template_processing.prepare_template_for_scale_out(
+            template, pools, {'agentpool1': 3, 'agentpool2': 0})
+        new_parameters = template_processing.prune_parameters(new_template, parameters)
+
+        broken = deepcopy(new_template)
+        vms = [r for r in broken['resources'] if r['type'] == 'Microsoft.Compute/virtualMachines']
+        vms[1]['name'] = vms[0]['name']
+        nic = [r for r in broken['resources'] if r['type'] == 'Microsoft.Network/networkInterfaces'][0]
+        nic['dependsOn'] = ["[concat('Microsoft.Network/networkSecurityGroups/', variables('nsgName'))]"]
+        nic['properties']['primary'] = "[equals(copyIndex(), 0)]"
+        broken['variables'].pop('agentpool1VMNamePrefix')
+        parameters = dict(new_parameters)
+        parameters.pop('linuxAdminUsername')
+        parameters['masterVMSize'] = {'value': 'Standard_D2_v2'}
+
+        with self.assertRaises(template_processing.TemplateValidationError) as context:
+            template_processing.validate_template(broken, parameters)
+        errors = context.exception.errors
+        self.assertIn('are both named', errors[0])
+        # the extension of the renamed VM and the NIC depend on missing resources
+        self.assertIn('/cse', errors[1])
+        self.assertIn('networkSecurityGroups', errors[2])
+        self.assertIn('copyIndex() outside of a copy loop', errors[3])
+        self.assertEqual(errors[4:], [
+            'variable agentpool1VMNamePrefix is not defined',
+            'parameter linuxAdminUsername has no value',
+            'parameter masterVMSize is given but not declared'])
+
+    def test_prerender_templates(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        template = get_arm_template(os.path.join(dir_path, './data/azuredeploy.cluster.json'), None)
+        parameters = get_arm_template(os.path.join(dir_path, './data/azuredeploy.cluster.parameters.json'), None)
+        scaler = create_scaler([self.create_node('agentpool1', 0)])
+        prerenderer = TemplatePrerenderer(template, parameters, steps=[1, 2])
+        self.assertEqual(prerenderer.get_jobs(scaler.agent_pools, scaler.scalable_pools), [
+            {'agentpool1': 2, 'agentpool2': 0}, {'agentpool1': 3, 'agentpool2': 0},
+            {'agentpool1': 1, 'agentpool2': 1}, {'agentpool1': 1, 'agentpool2': 2}])
+
+        prerenderer.schedule(scaler.agent_pools, scaler.scalable_pools)
+        self.assertTrue(prerenderer.wait(60))
+        self.assertEqual(prerenderer.stats()['prerender_cached'], 4)
+
+        new_pool_sizes = {'agentpool1': 3, 'agentpool2': 0}
+        expected = template_processing.render_scale_out(
+            template, template_processing.set_count_parameters(dict(parameters), scaler.scalable_pools, new_pool_sizes),
+            scaler.agent_pools, new_pool_sizes)
+        self.assertEqual(prerenderer.get(scaler.agent_pools, new_pool_sizes), expected)
+        self.assertIsNone(prerenderer.get(scaler.agent_pools, {'agentpool1': 5, 'agentpool2': 0}))
+
+        # a new node invalidates the renders
+        scaler = create_scaler([self.create_node('agentpool1', 0), self.create_node('agentpool1', 1)])
+        self.assertIsNone(prerenderer.get(scaler.agent_pools, {'agentpool1': 3, 'agentpool2': 0}))
+        prerenderer.schedule(scaler.agent_pools, scaler.scalable_pools)
+        self.assertTrue(prerenderer.wait(60))
+        self.assertIsNotNone(prerenderer.get(scaler.agent_pools, {'agentpool1': 3, 'agentpool2': 0}))
+        self.assertEqual(prerenderer.stats(), {'prerender_cached': 3, 'prerender_hits': 2, 'prerender_misses': 2})
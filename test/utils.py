@@ -1,6 +1,6 @@
 import os
 from autoscaler.engine_scaler import EngineScaler
-from azure.cli.core.util import get_file_json
+from autoscaler.utils import get_file_json
 
 def create_scaler(nodes):
     dir_path = os.path.dirname(os.path.realpath(__file__))